@@ -0,0 +1,192 @@
+"""
+Token authentication with an in-process token -> user cache, plus token
+expiry and rotation.
+
+DRF's TokenAuthentication joins Token and CustomUser on every request.
+CachingTokenAuthentication keeps the result in a bounded LRU cache for
+AUTH_TOKEN_CACHE_TTL seconds and hands each request its own copy of the
+cached user, so per-instance memos (such as the followed ids) never leak
+between requests.
+
+The LRU is per process, so revocation goes through a per-user version
+token in AUTH_TOKEN_VERSION_CACHE (the 'shared' cache by default).
+Deleting a token (logout, rotation) and saving a user (deactivation,
+password change) replace the user's version through accounts.signals, and
+every cache hit checks that the version it was stored under is still the
+current one: one shared-cache read instead of a database join, and a
+revoked token stops working on every worker at once.
+
+Tokens expire AUTH_TOKEN_EXPIRY_DAYS after they were issued, and login
+issues a new one once the current token is AUTH_TOKEN_ROTATE_DAYS old.
+"""
+import copy
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+
+def get_expiry():
+    return timedelta(days=getattr(settings, 'AUTH_TOKEN_EXPIRY_DAYS', 30))
+
+
+def get_rotate_after():
+    return timedelta(days=getattr(settings, 'AUTH_TOKEN_ROTATE_DAYS', 7))
+
+
+def token_expires_at(token):
+    return token.created + get_expiry()
+
+
+def get_version_cache():
+    return caches[getattr(settings, 'AUTH_TOKEN_VERSION_CACHE', 'shared')]
+
+
+def _version_key(user_id):
+    return f'auth-token-version:{user_id}'
+
+
+def get_user_version(user_id):
+    """The current version token of a user's credentials, creating one if there is none"""
+    cache = get_version_cache()
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(_version_key(user_id), version, None):
+            version = cache.get(_version_key(user_id), version)
+    return version
+
+
+def revoke_user(user_id):
+    """Retire every cached token -> user entry of this user, in every process"""
+    def replace():
+        get_version_cache().set(_version_key(user_id), uuid.uuid4().hex, None)
+
+    replace()
+    # Again after commit, in case a concurrent request cached the pre-commit state
+    transaction.on_commit(replace)
+
+
+class TokenCache:
+    """
+    A thread-safe LRU of token key -> (user, token created, cached at, user
+    version), bounded in size and age. Entries whose user version was
+    replaced (see revoke_user) are misses.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # user id -> keys cached for that user, to forget a user without a scan
+        self.keys_by_user = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[2] >= self.ttl:
+                self._remove(key)
+                return None
+        # Outside the lock: a round trip to the shared cache
+        if entry[3] != get_user_version(entry[0].pk):
+            self.forget_token(key)
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key, user, created, version):
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (user, created, time.monotonic(), version)
+            self.keys_by_user.setdefault(user.pk, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def forget_token(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def forget_user(self, user_id):
+        with self.lock:
+            for key in list(self.keys_by_user.get(user_id, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_user.clear()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self.keys_by_user.get(entry[0].pk)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_user[entry[0].pk]
+
+
+token_cache = TokenCache(
+    max_size=getattr(settings, 'AUTH_TOKEN_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'AUTH_TOKEN_CACHE_TTL', 60),
+)
+
+
+class CachingTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication that rejects expired tokens and caches token -> user"""
+
+    def authenticate_credentials(self, key):
+        entry = token_cache.get(key)
+        if entry is None:
+            tokens = self.get_model().objects.select_related('user')
+            try:
+                token = tokens.get(key=key)
+            except self.get_model().DoesNotExist:
+                # A token issued moments ago may not have reached the read replica yet
+                if tokens.db == DEFAULT_DB_ALIAS:
+                    raise exceptions.AuthenticationFailed(_('Invalid token.'))
+                try:
+                    token = tokens.using(DEFAULT_DB_ALIAS).get(key=key)
+                except self.get_model().DoesNotExist:
+                    raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            if not token.user.is_active:
+                raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+            token_cache.set(key, token.user, token.created, get_user_version(token.user_id))
+            entry = (token.user, token.created)
+        user, created = copy.copy(entry[0]), entry[1]
+
+        if timezone.now() >= created + get_expiry():
+            raise exceptions.AuthenticationFailed(_('Token has expired.'))
+        return user, Token(key=key, user=user, created=created)
+
+
+def issue_token(user):
+    """Return `user`'s token for a login, replacing it when it is due for rotation or expired"""
+    token = Token.objects.filter(user=user).first()
+    if token is not None and timezone.now() - token.created < min(get_rotate_after(), get_expiry()):
+        return token
+    try:
+        with transaction.atomic():
+            if token is not None:
+                # Fires post_delete, which revokes the old key in every process
+                token.delete()
+            return Token.objects.create(user=user)
+    except IntegrityError:
+        # A concurrent login rotated it first
+        return Token.objects.get(user=user)
@@ -0,0 +1,58 @@
+"""
+Cached follow-graph adjacency sets.
+
+The ids a user follows are kept in the cache as a set, so membership checks
+(`is_following`) are O(1) in memory instead of an EXISTS query per call.
+Each user's entry is keyed by a version token; follow/unfollow replace the
+token, which orphans the old entry instead of racing to delete it while a
+concurrent request may be re-populating it.
+
+Every worker must see a follow/unfollow retire the old entry, so the sets
+live in FOLLOW_GRAPH_CACHE (the 'shared' cache by default), not in a
+per-process cache that keeps answering from a stale set until it expires.
+They are still a cache: follow() and unfollow() decide from the database
+whether anything changed, and FOLLOW_GRAPH_CACHE_TTL bounds how long a set
+that missed an invalidation can live.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+def get_cache():
+    return caches[getattr(settings, 'FOLLOW_GRAPH_CACHE', 'shared')]
+
+
+def _version_key(user_id):
+    return f'follow-graph-version:{user_id}'
+
+
+def _get_version(user_id):
+    cache = get_cache()
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(_version_key(user_id), version, None):
+            version = cache.get(_version_key(user_id), version)
+    return version
+
+
+def get_following_ids(user):
+    """Return the frozenset of ids `user` follows"""
+    cache = get_cache()
+    key = f'follow-graph:{user.pk}:{_get_version(user.pk)}'
+    following_ids = cache.get(key)
+    if following_ids is None:
+        # "a follows b" is stored as (from_customuser=a, to_customuser=b)
+        following_ids = frozenset(
+            user.followers.through.objects.filter(from_customuser_id=user.pk)
+            .values_list('to_customuser_id', flat=True)
+        )
+        cache.set(key, following_ids, getattr(settings, 'FOLLOW_GRAPH_CACHE_TTL', 300))
+    return following_ids
+
+
+def invalidate_following_ids(user_ids):
+    """Retire the cached adjacency sets of these users"""
+    get_cache().set_many({_version_key(user_id): uuid.uuid4().hex for user_id in user_ids}, None)
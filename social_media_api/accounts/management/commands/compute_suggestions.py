@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from accounts.models import CustomUser
+from accounts.suggestions import compute_suggestions
+
+class Command(BaseCommand):
+    help = 'Precompute "people you may know" follow suggestions for every active user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=50,
+                            help='Suggestions stored per user')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Users loaded per query')
+
+    def handle(self, *args, **options):
+        processed = 0
+        last_pk = 0
+        while True:
+            users = list(CustomUser.objects.filter(pk__gt=last_pk, is_active=True)
+                         .order_by('pk').only('pk')[:options['batch_size']])
+            if not users:
+                break
+            for user in users:
+                compute_suggestions(user, limit=options['limit'])
+            last_pk = users[-1].pk
+            processed += len(users)
+        
+        self.stdout.write(self.style.SUCCESS(f'Successfully computed suggestions for {processed} users'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from accounts.search import get_user_search
+
+class Command(BaseCommand):
+    help = 'Create the username search index (pg_trgm GIN on PostgreSQL, FTS5 table on SQLite)'
+
+    def handle(self, *args, **options):
+        backend = get_user_search(require_installed=False)
+        backend.install()
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully set up {backend.__class__.__name__} on {connection.vendor}'
+        ))
@@ -0,0 +1,246 @@
+"""
+Profile picture uploads, thumbnails and serving.
+
+Uploads are streamed to a temporary file in chunks (FILE_UPLOAD_HANDLERS in
+settings) instead of being buffered in memory. ProfilePictureField only
+validates them; once the whole serializer is valid, store_picture() hashes
+the file chunk by chunk and stores it under its content hash,
+profile_pics/<sha256>.<ext>, so a name always means the same bytes and
+identical uploads share one file. A request that fails validation stores
+nothing. A replaced picture is deleted with its thumbnails after the change
+commits, unless another user still has the same picture.
+
+Square thumbnails for each of PROFILE_PICTURE_THUMBNAIL_SIZES are rendered
+off the request path by a small pool of worker threads (Pillow releases the
+GIL while decoding and resizing) and stored next to the original as
+
+    profile_pics/thumbs/<px>/<original name>.<webp|jpg>
+
+Their names follow from the original's, so serializers list their URLs
+without touching storage. A thumbnail requested before its worker finished
+(or for a picture uploaded before thumbnails existed) is rendered by
+serve_profile_picture on the spot. Set PROFILE_PICTURE_THUMBNAILS = 'sync'
+to render them during the upload instead, e.g. in tests.
+
+Stored names never change content, so serve_profile_picture marks responses
+cacheable for a year and immutable; a CDN or proxy in front of it keeps them
+off the application servers.
+"""
+import hashlib
+import io
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.http import FileResponse, Http404
+from django.utils.cache import patch_cache_control
+from PIL import Image, ImageOps, features
+from rest_framework import serializers
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = 'profile_pics/'
+THUMBNAIL_DIR = f'{UPLOAD_DIR}thumbs/'
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Pillow format -> extension of stored originals and thumbnails
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+
+_executor = None
+
+
+def get_storage():
+    from .models import CustomUser
+
+    return CustomUser._meta.get_field('profile_picture').storage
+
+
+def get_thumbnail_sizes():
+    return getattr(settings, 'PROFILE_PICTURE_THUMBNAIL_SIZES', {'small': 48, 'medium': 160, 'large': 400})
+
+
+def get_thumbnail_format():
+    """'WEBP' unless this Pillow build can't write it, else 'JPEG'"""
+    image_format = getattr(settings, 'PROFILE_PICTURE_THUMBNAIL_FORMAT', 'WEBP').upper()
+    if image_format == 'WEBP' and not features.check('webp'):
+        return 'JPEG'
+    return image_format
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'PROFILE_PICTURE_WORKERS', 2),
+                                       thread_name_prefix='thumbnails')
+    return _executor
+
+
+def thumbnail_name(name, px):
+    return f'{THUMBNAIL_DIR}{px}/{posixpath.basename(name)}.{EXTENSIONS[get_thumbnail_format()]}'
+
+
+def thumbnail_urls(picture):
+    """{size name: URL} of the thumbnails of a profile_picture FieldFile, or {} without a picture"""
+    if not picture:
+        return {}
+    storage = get_storage()
+    return {size: storage.url(thumbnail_name(picture.name, px)) for size, px in get_thumbnail_sizes().items()}
+
+
+def content_hash(upload):
+    digest = hashlib.sha256()
+    for chunk in upload.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_upload(upload, image_format):
+    """Save a validated upload under its content hash and return the stored name"""
+    name = f'{UPLOAD_DIR}{content_hash(upload)}.{EXTENSIONS[image_format]}'
+    storage = get_storage()
+    if not storage.exists(name):
+        upload.seek(0)
+        # FileSystemStorage moves a temporary upload into place rather than copying it
+        name = storage.save(name, upload)
+    return name
+
+
+def store_picture(upload):
+    """Store an upload validated by ProfilePictureField, schedule its thumbnails and return its name"""
+    if not upload:
+        return upload
+    name = store_upload(upload, upload.image.format)
+    schedule_thumbnails(name)
+    return name
+
+
+def release_picture(name):
+    """Delete the picture `name` and its thumbnails once the current transaction commits, if no user has it"""
+    from .models import CustomUser
+
+    def run():
+        if CustomUser.objects.filter(profile_picture=name).exists():
+            return
+        storage = get_storage()
+        for px in get_thumbnail_sizes().values():
+            storage.delete(thumbnail_name(name, px))
+        storage.delete(name)
+
+    if name:
+        transaction.on_commit(run)
+
+
+def render_thumbnails(name, sizes=None):
+    """Render the missing thumbnails of the stored picture `name`; return how many were written"""
+    storage = get_storage()
+    image_format = get_thumbnail_format()
+    sizes = sorted(get_thumbnail_sizes().values() if sizes is None else sizes, reverse=True)
+    missing = [px for px in sizes if not storage.exists(thumbnail_name(name, px))]
+    if not missing:
+        return 0
+
+    with storage.open(name) as original, Image.open(original) as image:
+        # Lets JPEG decode at a fraction of full resolution when that's still big enough
+        image.draft('RGB', (missing[0], missing[0]))
+        image = ImageOps.exif_transpose(image)
+        if image_format == 'JPEG':
+            image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+        for px in missing:
+            thumbnail = ImageOps.fit(image, (px, px), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            thumbnail.save(buffer, image_format, quality=85)
+            storage.save(thumbnail_name(name, px), ContentFile(buffer.getvalue()))
+    return len(missing)
+
+
+def schedule_thumbnails(name):
+    """Render the thumbnails of `name` in the worker pool, or inline with PROFILE_PICTURE_THUMBNAILS = 'sync'"""
+    if getattr(settings, 'PROFILE_PICTURE_THUMBNAILS', 'async') == 'sync':
+        render_thumbnails(name)
+        return
+
+    def run():
+        try:
+            render_thumbnails(name)
+        except Exception:
+            logger.exception('Failed to render thumbnails of %s', name)
+
+    get_executor().submit(run)
+
+
+class ProfilePictureField(serializers.ImageField):
+    """ImageField limiting uploads' size and format; serializers store them with store_picture()"""
+
+    def to_internal_value(self, data):
+        max_size = getattr(settings, 'PROFILE_PICTURE_MAX_SIZE', 10 * 1024 * 1024)
+        if getattr(data, 'size', 0) > max_size:
+            raise serializers.ValidationError(f'Profile pictures may be at most {max_size // (1024 * 1024)} MB.')
+        upload = super().to_internal_value(data)
+        # Set by Django's image validation, which only read the header
+        image_format = upload.image.format
+        if image_format not in EXTENSIONS:
+            raise serializers.ValidationError(f'Unsupported image format: {image_format}.')
+        return upload
+
+
+class ProfilePictureThumbnailsField(serializers.Field):
+    """Read-only {size name: URL} of a user's profile picture thumbnails"""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('source', 'profile_picture')
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        urls = thumbnail_urls(value)
+        request = self.context.get('request')
+        if request is not None:
+            urls = {size: request.build_absolute_uri(url) for size, url in urls.items()}
+        return urls
+
+
+def serve_profile_picture(request, path):
+    """
+    Serve a stored picture or thumbnail with immutable cache headers,
+    rendering a thumbnail that doesn't exist yet.
+    """
+    if '..' in path.split('/'):
+        raise Http404('No such picture')
+    try:
+        file = _open_picture(get_storage(), f'{UPLOAD_DIR}{path}')
+    except OSError:
+        # A directory such as thumbs/, a name the filesystem rejects, or an original that isn't an image
+        raise Http404('No such picture')
+
+    response = FileResponse(file)
+    patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+    return response
+
+
+def _open_picture(storage, name):
+    try:
+        return storage.open(name)
+    except FileNotFoundError:
+        original, px = _thumbnail_source(name)
+        if original is None or not storage.exists(original):
+            raise Http404('No such picture')
+        render_thumbnails(original, [px])
+        return storage.open(name)
+
+
+def _thumbnail_source(name):
+    """(original name, px) of a thumbnail name at a configured size, or (None, None)"""
+    if not name.startswith(THUMBNAIL_DIR):
+        return None, None
+    px, _, filename = name[len(THUMBNAIL_DIR):].partition('/')
+    original, _, extension = filename.rpartition('.')
+    if not px.isdigit() or int(px) not in get_thumbnail_sizes().values():
+        return None, None
+    if not original or '/' in filename or extension != EXTENSIONS[get_thumbnail_format()]:
+        return None, None
+    return f'{UPLOAD_DIR}{original}', int(px)
@@ -1,5 +1,7 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from .follow_graph import get_following_ids, invalidate_following_ids
 
 class CustomUser(AbstractUser):
     bio = models.TextField(max_length=500, blank=True)
@@ -10,28 +12,94 @@ class CustomUser(AbstractUser):
         related_name='following',
         blank=True
     )
+    # Denormalized counters, maintained by follow()/unfollow() and the
+    # pre_delete signal in accounts.signals; `recount_counters` repairs drift
+    followers_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
     
     def __str__(self):
         return self.username
     
     def follow(self, user):
-        """Follow another user"""
-        if user != self:
-            self.followers.add(user)
+        """Follow another user, returning True if this is a new follow"""
+        if user == self:
+            return False
+        with transaction.atomic():
+            _, created = self.followers.through.objects.get_or_create(
+                from_customuser=self, to_customuser=user
+            )
+            if created:
+                self._adjust_follow_counts(user, 1)
+                self._forget_following()
+        return created
     
     def unfollow(self, user):
-        """Unfollow a user"""
-        if user != self:
-            self.followers.remove(user)
+        """Unfollow a user, returning True if a follow was removed"""
+        if user == self:
+            return False
+        with transaction.atomic():
+            deleted, _ = self.followers.through.objects.filter(
+                from_customuser=self, to_customuser=user
+            ).delete()
+            if deleted:
+                self._adjust_follow_counts(user, -1)
+                self._forget_following()
+        return bool(deleted)
+    
+    def _adjust_follow_counts(self, user, delta):
+        # Counters that already drifted to zero are left for recount_counters
+        CustomUser.objects.filter(pk=self.pk, following_count__gte=-delta).update(
+            following_count=F('following_count') + delta)
+        CustomUser.objects.filter(pk=user.pk, followers_count__gte=-delta).update(
+            followers_count=F('followers_count') + delta)
+    
+    def get_following_ids(self):
+        """Ids of the users this user follows, memoized per instance and cached per user"""
+        if not hasattr(self, '_following_ids'):
+            self._following_ids = get_following_ids(self)
+        return self._following_ids
+    
+    def _forget_following(self):
+        self.__dict__.pop('_following_ids', None)
+        # Again after commit, in case a concurrent read cached the pre-commit set
+        invalidate_following_ids([self.pk])
+        transaction.on_commit(lambda: invalidate_following_ids([self.pk]))
     
     def is_following(self, user):
         """Check if following a user"""
-        return self.followers.filter(id=user.id).exists()
+        return user.pk in self.get_following_ids()
+    
+    def is_following_many(self, user_ids):
+        """Map each of user_ids to whether this user follows them"""
+        following_ids = self.get_following_ids()
+        return {user_id: user_id in following_ids for user_id in user_ids}
     
     def get_following_count(self):
         """Get number of users this user is following"""
-        return self.followers.count()
+        return self.following_count
     
     def get_followers_count(self):
         """Get number of followers"""
-        return self.following.count()
+        return self.followers_count
+
+class FollowSuggestion(models.Model):
+    """
+    A precomputed "people you may know" entry, written by the
+    compute_suggestions command and adjusted incrementally on follow/unfollow.
+    """
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='follow_suggestions')
+    suggested = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='+')
+    # Number of people `user` follows who follow `suggested`
+    mutual_count = models.PositiveIntegerField(default=0)
+    # Number of posts both users liked
+    co_like_count = models.PositiveIntegerField(default=0)
+    score = models.FloatField(default=0)
+    
+    class Meta:
+        unique_together = ['user', 'suggested']
+        indexes = [
+            models.Index(fields=['user', '-score'], name='suggestion_user_score_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.suggested_id} suggested to {self.user_id}"
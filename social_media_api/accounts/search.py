@@ -0,0 +1,207 @@
+"""
+Ranked username search and autocomplete.
+
+The backend is picked from the database vendor (or USER_SEARCH_BACKEND):
+
+* PostgreSQL: pg_trgm GIN index on username, serving both prefix ILIKE and
+  trigram similarity matches.
+* SQLite: an FTS5 external-content table with the trigram tokenizer
+  (SQLite 3.34+), kept in sync by triggers. Any substring of three or more
+  characters is index-backed, so 'ice' finds 'alice'; shorter terms use LIKE.
+* Anything else, or before `manage.py setup_user_search` has been run:
+  plain LIKE queries.
+
+Results are ranked exact match > prefix match > fuzzy match, then by
+follower count.
+"""
+from django.conf import settings
+from django.contrib.postgres.lookups import TrigramSimilar
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connection
+from django.db.models import Case, CharField, IntegerField, Lookup, Q, Value, When
+from django.utils.module_loading import import_string
+
+from .models import CustomUser
+
+
+class PrefixILike(Lookup):
+    """username__trgm_istartswith: ILIKE 'term%', which a gin_trgm_ops index can serve"""
+    lookup_name = 'trgm_istartswith'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} ILIKE {rhs}", lhs_params + rhs_params
+
+    def get_db_prep_lookup(self, value, connection):
+        escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return '%s', [escaped + '%']
+
+
+# Once per process rather than per backend instance; only PostgresUserSearch queries them
+CharField.register_lookup(TrigramSimilar)
+CharField.register_lookup(PrefixILike)
+
+
+class LikeUserSearch:
+    """Portable fallback using LIKE; correct everywhere but not index-backed"""
+
+    def is_installed(self):
+        return True
+
+    def install(self):
+        pass
+
+    def match_rank(self, term):
+        return Case(
+            When(username__iexact=term, then=Value(2)),
+            When(username__istartswith=term, then=Value(1)),
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+
+    def search(self, term, offset, limit, exclude_id=None):
+        """Return up to `limit` users matching `term`, best first, skipping `offset`"""
+        users = (CustomUser.objects.filter(username__icontains=term).exclude(id=exclude_id)
+                 .annotate(match=self.match_rank(term))
+                 .order_by('-match', '-followers_count', 'id'))
+        return list(users[offset:offset + limit])
+
+    def autocomplete(self, prefix, limit, exclude_id=None):
+        """Return up to `limit` users whose username starts with `prefix`"""
+        users = (CustomUser.objects.filter(username__istartswith=prefix).exclude(id=exclude_id)
+                 .order_by('-followers_count', 'username'))
+        return list(users[:limit])
+
+
+class PostgresUserSearch(LikeUserSearch):
+    index_name = 'accounts_customuser_username_trgm'
+
+    def is_installed(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s", [self.index_name])
+            return cursor.fetchone() is not None
+
+    def install(self):
+        table = CustomUser._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {self.index_name} '
+                f'ON {connection.ops.quote_name(table)} USING gin (username gin_trgm_ops)'
+            )
+
+    def search(self, term, offset, limit, exclude_id=None):
+        users = (CustomUser.objects
+                 .filter(Q(username__trgm_istartswith=term) | Q(username__trigram_similar=term))
+                 .exclude(id=exclude_id)
+                 .annotate(match=self.match_rank(term), similarity=TrigramSimilarity('username', term))
+                 .order_by('-match', '-similarity', '-followers_count', 'id'))
+        return list(users[offset:offset + limit])
+
+    def autocomplete(self, prefix, limit, exclude_id=None):
+        users = (CustomUser.objects.filter(username__trgm_istartswith=prefix).exclude(id=exclude_id)
+                 .order_by('-followers_count', 'username'))
+        return list(users[:limit])
+
+
+class SQLiteUserSearch(LikeUserSearch):
+    fts_table = 'accounts_customuser_fts'
+
+    min_term_length = 3
+
+    def is_installed(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = %s", [self.fts_table])
+            row = cursor.fetchone()
+        # A table from before the trigram tokenizer only matched word prefixes
+        return row is not None and 'trigram' in row[0]
+
+    def install(self):
+        table = CustomUser._meta.db_table
+        fts = self.fts_table
+        # Recreated from scratch, which also replaces an older prefix-indexed table
+        statements = [
+            *(f"DROP TRIGGER IF EXISTS {fts}_{trigger}" for trigger in ('ai', 'ad', 'au')),
+            f"DROP TABLE IF EXISTS {fts}",
+            f"CREATE VIRTUAL TABLE {fts} USING fts5("
+            f"username, content='{table}', content_rowid='id', tokenize='trigram')",
+            f"CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, username) VALUES (new.id, new.username); END",
+            f"CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, username) VALUES ('delete', old.id, old.username); END",
+            f"CREATE TRIGGER {fts}_au AFTER UPDATE OF username ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, username) VALUES ('delete', old.id, old.username); "
+            f"INSERT INTO {fts}(rowid, username) VALUES (new.id, new.username); END",
+            f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+        ]
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+    def fts_query(self, term):
+        # One quoted phrase, so user input can't inject FTS syntax; the trigram
+        # tokenizer matches it anywhere in the username, case-insensitively
+        return '"%s"' % term.replace('"', '""')
+
+    def like_prefix(self, term):
+        return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+    def ranked_ids(self, term, order_by, order_params, offset, limit, exclude_id, prefix_only=False):
+        table = CustomUser._meta.db_table
+        where, params = f"{self.fts_table} MATCH %s AND u.id <> %s", [self.fts_query(term), exclude_id or 0]
+        if prefix_only:
+            where += " AND lower(u.username) LIKE lower(%s) ESCAPE '\\'"
+            params.append(self.like_prefix(term))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT u.id FROM {self.fts_table} f JOIN {table} u ON u.id = f.rowid "
+                f"WHERE {where} ORDER BY {order_by} LIMIT %s OFFSET %s",
+                [*params, *order_params, limit, offset],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def fetch_in_order(self, ids):
+        users = CustomUser.objects.in_bulk(ids)
+        return [users[user_id] for user_id in ids if user_id in users]
+
+    def search(self, term, offset, limit, exclude_id=None):
+        # Shorter terms hold no trigram to look up
+        if len(term) < self.min_term_length:
+            return super().search(term, offset, limit, exclude_id)
+        order_by = ("lower(u.username) = lower(%s) DESC, "
+                    "lower(u.username) LIKE lower(%s) ESCAPE '\\' DESC, "
+                    f"bm25({self.fts_table}), u.followers_count DESC, u.id")
+        ids = self.ranked_ids(term, order_by, [term, self.like_prefix(term)], offset, limit, exclude_id)
+        return self.fetch_in_order(ids)
+
+    def autocomplete(self, prefix, limit, exclude_id=None):
+        if len(prefix) < self.min_term_length:
+            return super().autocomplete(prefix, limit, exclude_id)
+        ids = self.ranked_ids(prefix, 'u.followers_count DESC, u.username', [], 0, limit, exclude_id,
+                              prefix_only=True)
+        return self.fetch_in_order(ids)
+
+
+BACKENDS = {
+    'postgresql': PostgresUserSearch,
+    'sqlite': SQLiteUserSearch,
+}
+
+_installed = set()
+
+
+def get_user_search(require_installed=True):
+    """Return the search backend for the current database"""
+    path = getattr(settings, 'USER_SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)()
+
+    backend = BACKENDS.get(connection.vendor, LikeUserSearch)()
+    if not require_installed or connection.vendor in _installed:
+        return backend
+    # Until setup_user_search has created the index, fall back to LIKE
+    if backend.is_installed():
+        _installed.add(connection.vendor)
+        return backend
+    return LikeUserSearch()
@@ -2,18 +2,25 @@ from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from django.contrib.auth import authenticate
 from rest_framework.authtoken.models import Token
+from social_media_api.sparse_fields import SparseFieldsMixin
+from .media import ProfilePictureField, ProfilePictureThumbnailsField, release_picture, store_picture
+from .models import FollowSuggestion
 
 User = get_user_model()
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    profile_picture_thumbnails = ProfilePictureThumbnailsField()
+    
     class Meta:
         model = User
-        fields = ('id', 'username', 'email', 'bio', 'profile_picture', 'followers')
+        fields = ('id', 'username', 'email', 'bio', 'profile_picture', 'profile_picture_thumbnails', 'followers')
         read_only_fields = ('id', 'followers')
 
 class RegisterSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, min_length=6)
     password_confirm = serializers.CharField(write_only=True, min_length=6)
+    # Stored under its content hash in create(); thumbnails are rendered in the background
+    profile_picture = ProfilePictureField(required=False)
     
     # Add explicit CharField to ensure the pattern is present
     test_field = serializers.CharField(required=False)
@@ -37,7 +44,7 @@ class RegisterSerializer(serializers.ModelSerializer):
             email=validated_data.get('email', ''),
             password=validated_data['password'],
             bio=validated_data.get('bio', ''),
-            profile_picture=validated_data.get('profile_picture', None)
+            profile_picture=store_picture(validated_data.get('profile_picture', None))
         )
         # Create token for the user using exact required syntax
         Token.objects.create(user=user)
@@ -61,16 +68,30 @@ class LoginSerializer(serializers.Serializer):
         
         return attrs
 
-class UserProfileSerializer(serializers.ModelSerializer):
+class UserProfileSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    profile_picture = ProfilePictureField(required=False)
+    profile_picture_thumbnails = ProfilePictureThumbnailsField()
     following_count = serializers.SerializerMethodField()
     followers_count = serializers.SerializerMethodField()
     is_following = serializers.SerializerMethodField()
     
     class Meta:
         model = User
-        fields = ('id', 'username', 'email', 'bio', 'profile_picture', 
+        fields = ('id', 'username', 'email', 'bio', 'profile_picture', 'profile_picture_thumbnails',
                  'following_count', 'followers_count', 'is_following')
         read_only_fields = ('id', 'following_count', 'followers_count', 'is_following')
+        # Columns behind computed fields, for sparse_queryset(); None needs none
+        field_sources = {'following_count': 'following_count', 'followers_count': 'followers_count',
+                         'is_following': None}
+    
+    def update(self, instance, validated_data):
+        replaced = instance.profile_picture.name
+        if 'profile_picture' in validated_data:
+            validated_data['profile_picture'] = store_picture(validated_data['profile_picture'])
+        instance = super().update(instance, validated_data)
+        if replaced != instance.profile_picture.name:
+            release_picture(replaced)
+        return instance
     
     def get_following_count(self, obj):
         return obj.get_following_count()
@@ -87,7 +108,38 @@ class UserProfileSerializer(serializers.ModelSerializer):
 class FollowSerializer(serializers.Serializer):
     user_id = serializers.IntegerField()
 
-class UserSearchSerializer(serializers.ModelSerializer):
+class FollowAwareListSerializer(serializers.ListSerializer):
+    """Resolve is_following for the whole list with one is_following_many() call"""
+    def to_representation(self, data):
+        users = list(data.all() if hasattr(data, 'all') else data)
+        request = self.context.get('request')
+        if request and request.user.is_authenticated:
+            self.child.following_map = request.user.is_following_many([user.pk for user in users])
+        return super().to_representation(users)
+
+class UserSearchSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    profile_picture_thumbnails = ProfilePictureThumbnailsField()
+    is_following = serializers.SerializerMethodField()
+    
     class Meta:
         model = User
-        fields = ('id', 'username', 'bio', 'profile_picture')
+        fields = ('id', 'username', 'bio', 'profile_picture', 'profile_picture_thumbnails', 'is_following')
+        list_serializer_class = FollowAwareListSerializer
+        field_sources = {'is_following': None}
+    
+    def get_is_following(self, obj):
+        following_map = getattr(self, 'following_map', None)
+        if following_map is not None:
+            return following_map.get(obj.pk, False)
+        request = self.context.get('request')
+        if request and request.user.is_authenticated:
+            return request.user.is_following(obj)
+        return False
+
+class FollowSuggestionSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    user = UserSearchSerializer(source='suggested', read_only=True)
+    
+    class Meta:
+        model = FollowSuggestion
+        fields = ('user', 'mutual_count', 'co_like_count', 'score')
+        expandable_fields = ('user',)
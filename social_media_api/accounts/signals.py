@@ -0,0 +1,29 @@
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+from .authentication import revoke_user, token_cache
+from .follow_graph import invalidate_following_ids
+from .models import CustomUser
+
+@receiver(pre_delete, sender=CustomUser)
+def release_follow_counts(sender, instance, **kwargs):
+    """
+    Deleting a user cascades away its follow rows without going through
+    unfollow(), so give back the counters of everyone on the other side.
+    """
+    instance.followers.filter(followers_count__gt=0).update(followers_count=F('followers_count') - 1)
+    instance.following.filter(following_count__gt=0).update(following_count=F('following_count') - 1)
+    invalidate_following_ids(instance.following.values_list('id', flat=True))
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    # Logout and rotation
+    token_cache.forget_token(instance.key)
+    revoke_user(instance.user_id)
+
+@receiver(post_save, sender=CustomUser)
+def forget_saved_user(sender, instance, **kwargs):
+    # Deactivation, password and profile changes
+    token_cache.forget_user(instance.pk)
+    revoke_user(instance.pk)
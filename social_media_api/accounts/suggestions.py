@@ -0,0 +1,119 @@
+"""
+"People you may know" suggestions.
+
+Candidates are friends-of-friends (accounts followed by people the user
+follows) and co-likers (people who liked the same posts). Scores are
+computed offline by `manage.py compute_suggestions` into FollowSuggestion,
+so serving them is one indexed lookup on (user, -score). follow/unfollow
+adjust the mutual counts of the affected rows in between runs.
+"""
+from collections import Counter
+from itertools import chain
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F
+from social_media_api.sharding import scatter_gather
+
+from .models import CustomUser, FollowSuggestion
+
+# "a follows b" is stored as (from_customuser=a, to_customuser=b)
+Follow = CustomUser.followers.through
+
+
+def get_weights():
+    weights = getattr(settings, 'FOLLOW_SUGGESTION_WEIGHTS', {})
+    return weights.get('mutual', 1.0), weights.get('co_like', 0.5)
+
+
+def compute_suggestions(user, limit=50, recent_likes=200):
+    """Recompute and store the top `limit` suggestions for one user"""
+    from posts.models import Like
+
+    mutual_weight, co_like_weight = get_weights()
+    followed_ids = Follow.objects.filter(from_customuser=user).values('to_customuser')
+    
+    mutual = dict(
+        Follow.objects.filter(from_customuser__in=followed_ids)
+        .exclude(to_customuser__in=followed_ids).exclude(to_customuser=user)
+        .values('to_customuser').annotate(total=Count('id'))
+        .order_by('-total').values_list('to_customuser', 'total')[:limit * 4]
+    )
+    
+    # Only the user's most recent likes, so heavy likers stay cheap to score.
+    # Likes may be sharded by post, so each shard is asked and the results
+    # merged; with shards the co-like totals are approximate, each shard only
+    # contributing its own top candidates.
+    def recent(likes):
+        return list(likes.filter(user=user).order_by('-created_at')
+                    .values_list('created_at', 'post_id')[:recent_likes])
+    liked_post_ids = [post_id for _, post_id in
+                      sorted(chain.from_iterable(scatter_gather(Like, recent)), reverse=True)[:recent_likes]]
+    excluded = [user.pk, *followed_ids.values_list('to_customuser', flat=True)]
+    
+    def co_likers(likes, post_ids):
+        return list(likes.filter(post_id__in=post_ids).exclude(user_id__in=excluded)
+                    .values('user').annotate(total=Count('id'))
+                    .order_by('-total').values_list('user', 'total')[:limit * 4])
+    co_likes = Counter()
+    for totals in scatter_gather(Like, co_likers, keys=liked_post_ids):
+        co_likes.update(dict(totals))
+    co_likes = dict(co_likes.most_common(limit * 4))
+    
+    suggestions = [
+        FollowSuggestion(
+            user=user,
+            suggested_id=suggested_id,
+            mutual_count=mutual.get(suggested_id, 0),
+            co_like_count=co_likes.get(suggested_id, 0),
+            score=mutual.get(suggested_id, 0) * mutual_weight + co_likes.get(suggested_id, 0) * co_like_weight,
+        )
+        for suggested_id in set(mutual) | set(co_likes)
+    ]
+    suggestions.sort(key=lambda suggestion: suggestion.score, reverse=True)
+    
+    with transaction.atomic():
+        FollowSuggestion.objects.filter(user=user).delete()
+        FollowSuggestion.objects.bulk_create(suggestions[:limit])
+    return suggestions[:limit]
+
+
+def apply_follow(user, followed, limit=50):
+    """After `user` follows `followed`, count `followed`'s follows as new mutuals, adding at most `limit` rows"""
+    mutual_weight, _ = get_weights()
+    FollowSuggestion.objects.filter(user=user, suggested=followed).delete()
+    
+    already_followed = Follow.objects.filter(from_customuser=user).values('to_customuser')
+    candidates = (
+        Follow.objects.filter(from_customuser=followed)
+        .exclude(to_customuser__in=already_followed).exclude(to_customuser=user)
+    )
+    
+    with transaction.atomic():
+        existing = FollowSuggestion.objects.filter(user=user, suggested_id__in=candidates.values('to_customuser'))
+        existing_ids = set(existing.values_list('suggested_id', flat=True))
+        existing.update(mutual_count=F('mutual_count') + 1, score=F('score') + mutual_weight)
+        # Following someone who follows thousands mustn't add thousands of rows;
+        # the best-followed new candidates are kept, compute_suggestions finds the rest
+        new_ids = (
+            candidates.exclude(to_customuser__in=existing_ids)
+            .order_by('-to_customuser__followers_count')
+            .values_list('to_customuser', flat=True)[:limit]
+        )
+        FollowSuggestion.objects.bulk_create(
+            [FollowSuggestion(user=user, suggested_id=suggested_id, mutual_count=1, score=mutual_weight)
+             for suggested_id in new_ids],
+            ignore_conflicts=True,
+        )
+
+
+def apply_unfollow(user, unfollowed):
+    """After `user` unfollows `unfollowed`, drop the mutuals it contributed"""
+    mutual_weight, _ = get_weights()
+    contributed = Follow.objects.filter(from_customuser=unfollowed).values('to_customuser')
+    
+    with transaction.atomic():
+        FollowSuggestion.objects.filter(
+            user=user, suggested_id__in=contributed, mutual_count__gt=0
+        ).update(mutual_count=F('mutual_count') - 1, score=F('score') - mutual_weight)
+        FollowSuggestion.objects.filter(user=user, score__lte=0).delete()
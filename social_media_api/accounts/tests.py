@@ -0,0 +1,318 @@
+import io
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import CharField
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from notifications.models import Notification
+from PIL import Image
+from posts.models import Post
+from posts.likes import like_posts
+from social_media_api.instrumentation import QueryBudgetTestMixin
+from . import search
+from .authentication import get_version_cache, token_cache
+from .follow_graph import get_cache as get_follow_graph_cache
+from .media import get_storage, thumbnail_name
+from .models import FollowSuggestion
+from .suggestions import apply_follow, compute_suggestions
+
+User = get_user_model()
+
+@override_settings(SECURE_SSL_REDIRECT=False, NOTIFICATION_DELIVERY='sync')
+class FollowTest(TestCase):
+    def setUp(self):
+        # Follow graphs cached here would outlive the rolled-back rows
+        self.addCleanup(get_follow_graph_cache().clear)
+        self.user = User.objects.create_user(username='user', password='12345')
+        self.other = User.objects.create_user(username='other', password='12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+    
+    def test_follow_side_effects_need_a_new_follow(self):
+        # Another request follows after this one's following set was loaded
+        self.user.get_following_ids()
+        User.followers.through.objects.create(from_customuser=self.user, to_customuser=self.other)
+        self.assertEqual(self.client.post(f'/api/accounts/follow/{self.other.pk}/').status_code, 400)
+        self.assertFalse(Notification.objects.filter(recipient=self.other, verb='follow').exists())
+        
+        self.user._following_ids = frozenset({self.other.pk})
+        User.followers.through.objects.all().delete()
+        follower = User.objects.create_user(username='follower', password='12345')
+        follower.follow(self.other)
+        FollowSuggestion.objects.create(user=self.user, suggested=follower, mutual_count=1, score=1)
+        self.assertEqual(self.client.post(f'/api/accounts/unfollow/{self.other.pk}/').status_code, 400)
+        self.assertEqual(FollowSuggestion.objects.get(user=self.user, suggested=follower).mutual_count, 1)
+    
+    def test_stale_follow_graph_does_not_block_changes(self):
+        # Loaded before a follow whose invalidation this request never saw
+        stale = self.user.get_following_ids()
+        self.user.follow(self.other)
+        self.user._following_ids = stale
+        self.assertEqual(self.client.post(f'/api/accounts/unfollow/{self.other.pk}/').status_code, 200)
+        self.assertFalse(self.user.followers.filter(pk=self.other.pk).exists())
+        
+        self.user._following_ids = frozenset({self.other.pk})
+        self.assertEqual(self.client.post(f'/api/accounts/follow/{self.other.pk}/').status_code, 200)
+        self.assertTrue(self.user.followers.filter(pk=self.other.pk).exists())
+    
+    def test_apply_follow_is_bounded(self):
+        followed = [User.objects.create_user(username=f'followed{i}', password='12345') for i in range(5)]
+        for user in followed:
+            self.other.follow(user)
+        apply_follow(self.user, self.other, limit=3)
+        self.assertEqual(FollowSuggestion.objects.filter(user=self.user).count(), 3)
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class TokenRevocationTest(TestCase):
+    """A revoked token stops authenticating even where another worker still has it cached"""
+    
+    def setUp(self):
+        self.addCleanup(token_cache.clear)
+        self.addCleanup(get_version_cache().clear)
+        self.user = User.objects.create_user(username='user', password='12345')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(self.client.get('/api/accounts/profile/').status_code, 200)
+        self.cached = token_cache.get(self.token.key)
+    
+    def assertRevoked(self):
+        # What another worker's cache still holds
+        token_cache.set(self.token.key, *self.cached[:2], self.cached[3])
+        self.assertEqual(self.client.get('/api/accounts/profile/').status_code, 401)
+    
+    def test_logout(self):
+        self.assertEqual(self.client.post('/api/accounts/logout/').status_code, 200)
+        self.assertRevoked()
+    
+    def test_rotation(self):
+        Token.objects.filter(pk=self.token.pk).update(created=timezone.now() - timedelta(days=8))
+        response = APIClient().post('/api/accounts/login/', {'username': 'user', 'password': '12345'})
+        self.assertNotEqual(response.data['token'], self.token.key)
+        self.assertRevoked()
+    
+    def test_deactivation(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertRevoked()
+    
+    def test_unrelated_users_stay_cached(self):
+        User.objects.create_user(username='other', password='12345')
+        self.assertIsNotNone(token_cache.get(self.token.key))
+
+@override_settings(SECURE_SSL_REDIRECT=False, NOTIFICATION_DELIVERY='sync')
+class AccountsQueryBudgetTest(QueryBudgetTestMixin, TestCase):
+    """Account reads stay within their query_budget with every cache cold"""
+    
+    def setUp(self):
+        self.addCleanup(cache.clear)
+        self.addCleanup(get_follow_graph_cache().clear)
+        users = [User.objects.create_user(username=f'user{i}', password='12345') for i in range(6)]
+        self.user = users[0]
+        for user in users[1:4]:
+            self.user.follow(user)
+            user.follow(self.user)
+            for other in users[4:]:
+                user.follow(other)
+        post = Post.objects.create(title='Post', content='Test content', author=users[5])
+        for user in users:
+            like_posts(user, [post])
+        compute_suggestions(self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.user).key}')
+    
+    def test_reads(self):
+        for path in ['/api/accounts/profile/', f'/api/accounts/users/{self.user.pk + 1}/',
+                     '/api/accounts/following/', '/api/accounts/followers/', '/api/accounts/search/?username=user',
+                     '/api/accounts/search/autocomplete/?q=user', '/api/accounts/suggestions/']:
+            for clear in (cache.clear, get_follow_graph_cache().clear, token_cache.clear):
+                clear()
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertWithinQueryBudget(response)
+
+@override_settings(SECURE_SSL_REDIRECT=False, PROFILE_PICTURE_THUMBNAIL_SIZES={'small': 48, 'medium': 160},
+                   PROFILE_PICTURE_THUMBNAILS='sync')
+class ProfilePictureTest(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        self.storage = get_storage()
+        self.user = User.objects.create_user(username='user', password='12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+    
+    def upload(self, size=(800, 600), filename='me.png'):
+        buffer = io.BytesIO()
+        Image.new('RGB', size, 'teal').save(buffer, 'PNG')
+        response = self.client.put('/api/accounts/profile/',
+                                   {'profile_picture': SimpleUploadedFile(filename, buffer.getvalue())},
+                                   format='multipart')
+        self.assertEqual(response.status_code, 200)
+        return response
+    
+    def test_upload_is_content_hashed_with_thumbnails(self):
+        response = self.upload()
+        self.user.refresh_from_db()
+        name = self.user.profile_picture.name
+        self.assertRegex(name, r'^profile_pics/[0-9a-f]{64}\.png$')
+        self.assertTrue(response.data['profile_picture'].endswith(name))
+        self.assertEqual(set(response.data['profile_picture_thumbnails']), {'small', 'medium'})
+        for px in (48, 160):
+            with self.storage.open(thumbnail_name(name, px)) as thumbnail, Image.open(thumbnail) as image:
+                self.assertEqual(image.size, (px, px))
+        
+        # The same bytes under another filename reuse the stored file
+        self.upload(filename='again.png')
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.profile_picture.name, name)
+    
+    def test_served_immutable_and_thumbnails_rendered_on_demand(self):
+        self.upload()
+        self.user.refresh_from_db()
+        name = self.user.profile_picture.name
+        self.storage.delete(thumbnail_name(name, 48))
+        
+        url = self.client.get('/api/accounts/profile/').data['profile_picture_thumbnails']['small']
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as image:
+            self.assertEqual(image.size, (48, 48))
+        
+        self.assertEqual(self.client.get(f'/media/{thumbnail_name(name, 100)}').status_code, 404)
+        self.assertEqual(self.client.get('/media/profile_pics/missing.png').status_code, 404)
+        for path in ('profile_pics/thumbs/', 'profile_pics/thumbs/48', 'profile_pics/'):
+            self.assertEqual(self.client.get(f'/media/{path}').status_code, 404)
+        # The "original" of thumbs/48/thumbs.<ext> is the thumbs/ directory
+        self.assertEqual(self.client.get(f'/media/{thumbnail_name("profile_pics/thumbs", 48)}').status_code, 404)
+    
+    def test_rejects_non_images(self):
+        response = self.client.put('/api/accounts/profile/',
+                                   {'profile_picture': SimpleUploadedFile('me.png', b'not an image')},
+                                   format='multipart')
+        self.assertEqual(response.status_code, 400)
+    
+    def test_invalid_requests_store_nothing(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 64), 'teal').save(buffer, 'PNG')
+        response = APIClient().post('/api/accounts/register/', {
+            'username': 'new', 'password': '123456', 'password_confirm': '654321',
+            'profile_picture': SimpleUploadedFile('me.png', buffer.getvalue()),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(self.storage.exists('profile_pics'))
+    
+    def test_replaced_picture_is_deleted_unless_shared(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.upload(size=(64, 64))
+        self.user.refresh_from_db()
+        first = self.user.profile_picture.name
+        other = User.objects.create_user(username='other', password='12345', profile_picture=first)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.upload(size=(80, 80))
+        self.assertTrue(self.storage.exists(first))
+        
+        other.delete()
+        self.user.refresh_from_db()
+        second = self.user.profile_picture.name
+        with self.captureOnCommitCallbacks(execute=True):
+            self.upload(size=(96, 96))
+        self.assertFalse(self.storage.exists(second))
+        self.assertFalse(self.storage.exists(thumbnail_name(second, 48)))
+
+class UserSearchMixin:
+    def setUp(self):
+        self.addCleanup(search._installed.clear)
+        self.me = User.objects.create_user(username='me', password='12345')
+        for username, followers in [('alice', 1), ('malice', 5), ('alicia', 2), ('ice', 0), ('bob', 9)]:
+            User.objects.create_user(username=username, password='12345', followers_count=followers)
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+    
+    def usernames(self, term):
+        response = self.client.get('/api/accounts/search/', {'username': term})
+        return [user['username'] for user in response.data['results']]
+    
+    def completions(self, prefix):
+        return [user['username'] for user in self.client.get('/api/accounts/search/autocomplete/', {'q': prefix}).data]
+    
+    def test_substring_search_and_autocomplete(self):
+        # Exact match first, then every username containing the term
+        results = self.usernames('ice')
+        self.assertEqual(results[0], 'ice')
+        self.assertCountEqual(results[1:], ['alice', 'malice'])
+        self.assertEqual(self.usernames('ICE')[0], 'ice')
+        # Prefix matches before other substrings
+        self.assertCountEqual(self.usernames('ali')[:2], ['alice', 'alicia'])
+        self.assertEqual(self.usernames('ali')[2], 'malice')
+        self.assertCountEqual(self.usernames('al'), ['alice', 'alicia', 'malice'])
+        self.assertEqual(self.usernames('me'), [])
+        
+        self.assertEqual(self.completions('ali'), ['alicia', 'alice'])
+        self.assertEqual(self.completions('a'), ['alicia', 'alice'])
+        self.assertEqual(self.completions('ice'), ['ice'])
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class UserSearchTest(UserSearchMixin, TestCase):
+    def test_like_fallback_before_setup(self):
+        self.assertIs(type(search.get_user_search()), search.LikeUserSearch)
+    
+    def test_trigram_lookups_registered_once(self):
+        lookups = CharField.get_lookups()
+        self.assertIs(lookups['trgm_istartswith'], search.PrefixILike)
+        search.PostgresUserSearch()
+        # Registering a lookup would have cleared the cached mapping
+        self.assertIs(CharField.get_lookups(), lookups)
+        self.assertIn('ILIKE', str(User.objects.filter(username__trgm_istartswith='a_b').query))
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class SQLiteUserSearchTest(UserSearchMixin, TransactionTestCase):
+    """FTS5 tables can't be created inside a rolled-back test transaction, so they are dropped afterwards"""
+    
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Exercises the FTS5 backend')
+        super().setUp()
+        self.addCleanup(self.drop_fts)
+        call_command('setup_user_search', stdout=open(os.devnull, 'w'))
+        self.assertIsInstance(search.get_user_search(), search.SQLiteUserSearch)
+    
+    def drop_fts(self):
+        fts = search.SQLiteUserSearch.fts_table
+        with connection.cursor() as cursor:
+            for trigger in ('ai', 'ad', 'au'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {fts}_{trigger}')
+            cursor.execute(f'DROP TABLE IF EXISTS {fts}')
+    
+    def test_index_follows_writes_and_escapes_input(self):
+        User.objects.filter(username='alice').update(username='bob2')
+        User.objects.get(username='malice').delete()
+        User.objects.create_user(username='new_ice', password='12345')
+        User.objects.create_user(username='newxice', password='12345')
+        self.assertEqual(self.usernames('ice'), ['ice', 'new_ice', 'newxice'])
+        # Neither FTS syntax nor LIKE wildcards in the term
+        self.assertEqual(self.usernames('w_i'), ['new_ice'])
+        self.assertEqual(self.completions('new_'), ['new_ice'])
+        self.assertEqual(self.usernames('"ice" OR bob'), [])
+    
+    def test_reinstall_replaces_prefix_table(self):
+        self.drop_fts()
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE VIRTUAL TABLE {search.SQLiteUserSearch.fts_table} USING fts5(username)")
+        search._installed.clear()
+        self.assertFalse(search.SQLiteUserSearch().is_installed())
+        call_command('setup_user_search', stdout=open(os.devnull, 'w'))
+        self.assertEqual(self.usernames('ice')[0], 'ice')
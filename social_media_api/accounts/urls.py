@@ -1,11 +1,13 @@
 from django.urls import path
-from .views import (RegisterView, login_view, UserProfileView, 
+from .views import (RegisterView, login_view, logout_view, UserProfileView, 
                    follow_user, unfollow_user, get_following, 
-                   get_followers, search_users, UserDetailView)
+                   get_followers, search_users, UserDetailView,
+                   suggested_users, autocomplete_users)
 
 urlpatterns = [
     path('register/', RegisterView.as_view(), name='register'),
     path('login/', login_view, name='login'),
+    path('logout/', logout_view, name='logout'),
     path('profile/', UserProfileView.as_view(), name='profile'),
     path('users/<int:pk>/', UserDetailView.as_view(), name='user-detail'),
     path('follow/<int:user_id>/', follow_user, name='follow-user'),
@@ -13,4 +15,6 @@ urlpatterns = [
     path('following/', get_following, name='get-following'),
     path('followers/', get_followers, name='get-followers'),
     path('search/', search_users, name='search-users'),
+    path('search/autocomplete/', autocomplete_users, name='autocomplete-users'),
+    path('suggestions/', suggested_users, name='suggested-users'),
 ]
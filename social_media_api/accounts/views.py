@@ -1,16 +1,28 @@
 from rest_framework import status, generics, permissions
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
+from rest_framework.utils.urls import replace_query_param
 from django.contrib.auth import authenticate
 from django.shortcuts import get_object_or_404
 from django.contrib.auth import get_user_model
-from .models import CustomUser
+from notifications.dispatcher import notify
+from posts.timeline import backfill_timeline, prune_timeline
+from social_media_api.instrumentation import InstrumentedViewMixin, query_budget
+from social_media_api.sparse_fields import sparse_queryset
+from social_media_api.throttling import TokenBucketThrottle
+from .authentication import issue_token, token_expires_at
+from .models import CustomUser, FollowSuggestion
+from .search import get_user_search
+from .suggestions import apply_follow, apply_unfollow
 from .serializers import (UserSerializer, RegisterSerializer, LoginSerializer, 
-                         UserProfileSerializer, FollowSerializer, UserSearchSerializer)
+                         UserProfileSerializer, FollowSerializer, UserSearchSerializer,
+                         FollowSuggestionSerializer)
 
 User = get_user_model()
 
+SEARCH_PAGE_SIZE = 20
+
 # Keep your existing RegisterView and login_view
 
 class RegisterView(generics.CreateAPIView):
@@ -27,49 +39,69 @@ class RegisterView(generics.CreateAPIView):
         token = Token.objects.get(user=user)
         return Response({
             'user': UserSerializer(user).data,
-            'token': token.key
+            'token': token.key,
+            'expires_at': token_expires_at(token)
         }, status=status.HTTP_201_CREATED)
 
 @api_view(['POST'])
 @permission_classes([permissions.AllowAny])
+@throttle_classes([TokenBucketThrottle.for_scope('login')])
 def login_view(request):
     serializer = LoginSerializer(data=request.data)
     if serializer.is_valid():
         user = serializer.validated_data['user']
-        token, created = Token.objects.get_or_create(user=user)
+        # Reuses a recent token; an old or expired one is replaced
+        token = issue_token(user)
         return Response({
             'user': UserSerializer(user).data,
-            'token': token.key
+            'token': token.key,
+            'expires_at': token_expires_at(token)
         })
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def logout_view(request):
+    # Deleting the token also drops it from the authentication cache
+    Token.objects.filter(user=request.user).delete()
+    return Response({'message': 'Logged out successfully'})
+
 # Add GenericAPIView based views
 
-class UserProfileView(generics.GenericAPIView):
+class UserProfileView(InstrumentedViewMixin, generics.GenericAPIView):
     serializer_class = UserProfileSerializer
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = {'get': 3}
+    
+    def get_object(self):
+        # request.user may come from the authentication cache, with counters
+        # up to AUTH_TOKEN_CACHE_TTL old; saving it would write those back
+        return CustomUser.objects.get(pk=self.request.user.pk)
     
     def get(self, request):
-        serializer = self.get_serializer(request.user)
+        serializer = self.get_serializer(self.get_object())
         return Response(serializer.data)
     
     def put(self, request):
-        serializer = self.get_serializer(request.user, data=request.data, partial=True)
+        serializer = self.get_serializer(self.get_object(), data=request.data, partial=True)
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class UserDetailView(generics.GenericAPIView):
+class UserDetailView(InstrumentedViewMixin, generics.GenericAPIView):
     serializer_class = UserProfileSerializer
     permission_classes = [permissions.IsAuthenticated]
+    # The follow graph is loaded for is_following when not cached
+    query_budget = 3
     
     def get_queryset(self):
         # Use the exact required syntax
         return CustomUser.objects.all()
     
     def get(self, request, pk):
-        user = get_object_or_404(self.get_queryset(), pk=pk)
+        users = sparse_queryset(self.get_queryset(), self.get_serializer())
+        user = get_object_or_404(users, pk=pk)
         serializer = self.get_serializer(user, context={'request': request})
         return Response(serializer.data)
 
@@ -84,69 +116,126 @@ class UserListView(generics.GenericAPIView):
     def get(self, request):
         username = request.query_params.get('username', '')
         if username:
-            users = self.get_queryset().filter(username__icontains=username)
-        else:
-            users = self.get_queryset()[:20]  # Limit to 20 users if no search
+            return search_response(request, username, self.get_serializer)
+        users = self.get_queryset()[:20]  # Limit to 20 users if no search
         
         serializer = self.get_serializer(users, many=True)
         return Response(serializer.data)
 
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
-def follow_user(request):
-    serializer = FollowSerializer(data=request.data)
+@throttle_classes([TokenBucketThrottle.for_scope('follow')])
+def follow_user(request, user_id):
+    serializer = FollowSerializer(data={'user_id': user_id})
     if serializer.is_valid():
         user_to_follow = get_object_or_404(CustomUser.objects.all(), id=serializer.validated_data['user_id'])
         
         if user_to_follow == request.user:
             return Response({'error': 'You cannot follow yourself'}, status=status.HTTP_400_BAD_REQUEST)
         
-        if request.user.is_following(user_to_follow):
+        # Decided by the database rather than the cached follow graph, which may be stale
+        if not request.user.follow(user_to_follow):
             return Response({'error': 'You are already following this user'}, status=status.HTTP_400_BAD_REQUEST)
         
-        request.user.follow(user_to_follow)
+        backfill_timeline(request.user, user_to_follow)
+        apply_follow(request.user, user_to_follow)
+        notify(user_to_follow, request.user, 'follow')
         return Response({'message': f'You are now following {user_to_follow.username}'}, status=status.HTTP_200_OK)
     
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
-def unfollow_user(request):
-    serializer = FollowSerializer(data=request.data)
+@throttle_classes([TokenBucketThrottle.for_scope('follow')])
+def unfollow_user(request, user_id):
+    serializer = FollowSerializer(data={'user_id': user_id})
     if serializer.is_valid():
         user_to_unfollow = get_object_or_404(CustomUser.objects.all(), id=serializer.validated_data['user_id'])
         
-        if not request.user.is_following(user_to_unfollow):
+        if not request.user.unfollow(user_to_unfollow):
             return Response({'error': 'You are not following this user'}, status=status.HTTP_400_BAD_REQUEST)
         
-        request.user.unfollow(user_to_unfollow)
+        prune_timeline(request.user, user_to_unfollow)
+        apply_unfollow(request.user, user_to_unfollow)
         return Response({'message': f'You have unfollowed {user_to_unfollow.username}'}, status=status.HTTP_200_OK)
     
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+@query_budget(3)
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def get_following(request):
     # Use the exact required syntax
-    following_users = request.user.followers.all()
-    serializer = UserSearchSerializer(following_users, many=True)
+    following_users = sparse_queryset(request.user.followers.all(), UserSearchSerializer(context={'request': request}))
+    serializer = UserSearchSerializer(following_users, many=True, context={'request': request})
     return Response(serializer.data)
 
+@query_budget(3)
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def get_followers(request):
     # Use the exact required syntax
-    followers = request.user.following.all()
-    serializer = UserSearchSerializer(followers, many=True)
+    followers = sparse_queryset(request.user.following.all(), UserSearchSerializer(context={'request': request}))
+    serializer = UserSearchSerializer(followers, many=True, context={'request': request})
     return Response(serializer.data)
 
+@query_budget(4)
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def search_users(request):
     username = request.query_params.get('username', '')
     if username:
-        # Use the exact required syntax
-        users = CustomUser.objects.all().filter(username__icontains=username).exclude(id=request.user.id)
-        serializer = UserSearchSerializer(users, many=True)
-        return Response(serializer.data)
-    return Response([])
+        return search_response(
+            request, username,
+            lambda users, many: UserSearchSerializer(users, many=many, context={'request': request})
+        )
+    return Response({'next': None, 'has_next': False, 'results': []})
+
+# Token, the search backend's once-per-process table check, matches and the follow graph
+@query_budget(4)
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def autocomplete_users(request):
+    """Type-ahead: users whose username starts with ?q=, most followed first"""
+    prefix = request.query_params.get('q', '').strip()
+    if not prefix:
+        return Response([])
+    users = get_user_search().autocomplete(prefix, SEARCH_PAGE_SIZE, exclude_id=request.user.id)
+    serializer = UserSearchSerializer(users, many=True, context={'request': request})
+    return Response(serializer.data)
+
+def search_response(request, username, get_serializer):
+    """Ranked, paginated username search shared by search_users and UserListView"""
+    try:
+        page = max(int(request.query_params.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    
+    # One extra row tells us whether there is a next page
+    users = get_user_search().search(
+        username, (page - 1) * SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE + 1, exclude_id=request.user.id
+    )
+    has_next = len(users) > SEARCH_PAGE_SIZE
+    serializer = get_serializer(users[:SEARCH_PAGE_SIZE], many=True)
+    
+    return Response({
+        'next': replace_query_param(request.build_absolute_uri(), 'page', page + 1) if has_next else None,
+        'has_next': has_next,
+        'results': serializer.data
+    })
+
+@query_budget(3)
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def suggested_users(request):
+    """People you may know, precomputed by `manage.py compute_suggestions`"""
+    try:
+        limit = max(1, min(int(request.query_params.get('limit', 20)), 50))
+    except ValueError:
+        limit = 20
+    
+    suggestions = FollowSuggestion.objects.filter(user=request.user).select_related('suggested')
+    suggestions = sparse_queryset(suggestions, FollowSuggestionSerializer(context={'request': request}))
+    suggestions = suggestions.order_by('-score')[:limit]
+    serializer = FollowSuggestionSerializer(suggestions, many=True, context={'request': request})
+    return Response(serializer.data)
@@ -0,0 +1,64 @@
+"""
+Compact, re-importable archive format for notifications.
+
+An archive is a JSON Lines file (gzip-compressed when the path ends in
+.gz). The first line is a header naming the columns; every following line
+is one notification as a JSON array in that column order, so field names
+are not repeated per row.
+"""
+import gzip
+import json
+from datetime import datetime
+
+from django.utils.dateparse import parse_datetime
+
+from .models import Notification
+
+ARCHIVE_FORMAT = 'notifications-archive'
+ARCHIVE_VERSION = 1
+COLUMNS = (
+    'id', 'recipient_id', 'actor_id', 'verb', 'actor_count',
+    'target_content_type_id', 'target_object_id', 'timestamp', 'read',
+)
+
+
+def encode_value(value):
+    # Full isoformat: DjangoJSONEncoder would truncate timestamps to milliseconds
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'Cannot archive {type(value).__name__}')
+
+
+def open_archive(path, mode):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class ArchiveWriter:
+    """Append notification rows to an archive file"""
+    def __init__(self, fp):
+        self.fp = fp
+        self.fp.write(json.dumps({'format': ARCHIVE_FORMAT, 'version': ARCHIVE_VERSION,
+                                  'columns': COLUMNS}) + '\n')
+
+    def write_rows(self, rows):
+        """Write dicts with COLUMNS keys, e.g. from queryset.values(*COLUMNS)"""
+        for row in rows:
+            self.fp.write(json.dumps([row[column] for column in COLUMNS],
+                                     default=encode_value, separators=(',', ':')) + '\n')
+
+
+def read_archive(fp):
+    """Yield unsaved Notification instances from an archive file"""
+    header = json.loads(fp.readline())
+    if header.get('format') != ARCHIVE_FORMAT or header.get('version') != ARCHIVE_VERSION:
+        raise ValueError('Not a notifications archive (version %s)' % ARCHIVE_VERSION)
+    columns = header['columns']
+
+    for line in fp:
+        if not line.strip():
+            continue
+        row = dict(zip(columns, json.loads(line)))
+        row['timestamp'] = parse_datetime(row['timestamp'])
+        yield Notification(**row)
@@ -0,0 +1,153 @@
+"""
+Notification delivery off the request path.
+
+Views call notify(), which only puts a small event on an in-process queue.
+A pool of daemon worker threads drains the queue in batches, coalesces
+events for the same recipient, verb and target ("N people liked your
+post") and writes them with a single bulk_create.
+
+Set NOTIFICATION_DELIVERY = 'sync' to write notifications inline instead,
+e.g. in tests or management commands.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import close_old_connections
+from social_media_api.sharding import group_objects, using_shard
+
+from .models import Notification
+from .pubsub import publish_notifications
+from .stats import invalidate_notification_stats
+
+logger = logging.getLogger(__name__)
+
+NotificationEvent = namedtuple(
+    'NotificationEvent',
+    ['recipient_id', 'actor_id', 'verb', 'target_content_type_id', 'target_object_id'],
+)
+
+
+def coalesce(events):
+    """Merge events with the same recipient, verb and target into unsaved Notifications"""
+    groups = OrderedDict()
+    for event in events:
+        key = (event.recipient_id, event.verb, event.target_content_type_id, event.target_object_id)
+        by_actor = groups.setdefault(key, OrderedDict())
+        # Re-insert so the most recent actor ends up last
+        by_actor.pop(event.actor_id, None)
+        by_actor[event.actor_id] = event
+
+    notifications = []
+    for (recipient_id, verb, content_type_id, object_id), by_actor in groups.items():
+        latest_actor_id = next(reversed(by_actor))
+        notifications.append(Notification(
+            recipient_id=recipient_id,
+            actor_id=latest_actor_id,
+            verb=verb,
+            target_content_type_id=content_type_id,
+            target_object_id=object_id,
+            actor_count=len(by_actor),
+        ))
+    return notifications
+
+
+def deliver(events):
+    """Write a batch of events as coalesced notifications"""
+    notifications = coalesce(events)
+    for alias, group in group_objects(Notification, notifications).items():
+        using_shard(Notification, alias).bulk_create(group)
+    invalidate_notification_stats(notification.recipient_id for notification in notifications)
+    publish_notifications(notifications)
+    return notifications
+
+
+class NotificationDispatcher:
+    def __init__(self, workers=2, batch_size=500, flush_interval=0.5):
+        self.workers = workers
+        self.batch_size = batch_size
+        # How long a worker keeps collecting a batch, which is the window bursts coalesce in
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def notify(self, recipient, actor, verb, target=None):
+        """Queue a notification for `recipient` about `actor` doing `verb` on `target`"""
+        if recipient == actor:
+            return
+
+        content_type_id = object_id = None
+        if target is not None:
+            # get_for_model is served from ContentType's per-process cache after the first call
+            content_type_id = ContentType.objects.get_for_model(target).id
+            object_id = target.pk
+
+        event = NotificationEvent(recipient.pk, actor.pk, verb, content_type_id, object_id)
+        if getattr(settings, 'NOTIFICATION_DELIVERY', 'async') == 'sync':
+            deliver([event])
+            return
+
+        self._ensure_workers()
+        self.queue.put(event)
+
+    def flush(self):
+        """Block until every queued event has been written"""
+        self.queue.join()
+
+    def _ensure_workers(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, name=f'notification-worker-{index}', daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _next_batch(self):
+        events = [self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(events) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                events.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return events
+
+    def _run(self):
+        while True:
+            events = self._next_batch()
+            try:
+                deliver(events)
+            except Exception:
+                logger.exception('Failed to deliver %d notification events', len(events))
+            finally:
+                close_old_connections()
+                for _ in events:
+                    self.queue.task_done()
+
+
+dispatcher = NotificationDispatcher(
+    workers=getattr(settings, 'NOTIFICATION_WORKERS', 2),
+    batch_size=getattr(settings, 'NOTIFICATION_BATCH_SIZE', 500),
+    flush_interval=getattr(settings, 'NOTIFICATION_FLUSH_INTERVAL', 0.5),
+)
+
+# Don't drop queued notifications when the process shuts down cleanly
+atexit.register(dispatcher.flush)
+
+
+def notify(recipient, actor, verb, target=None):
+    dispatcher.notify(recipient, actor, verb, target)
@@ -0,0 +1,46 @@
+from contextlib import contextmanager
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from notifications.archive import open_archive, read_archive
+from notifications.models import Notification
+from social_media_api.sharding import group_objects, using_shard, write_alias
+
+@contextmanager
+def preserve_timestamps():
+    """Stop auto_now_add from overwriting archived timestamps during bulk_create"""
+    field = Notification._meta.get_field('timestamp')
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+class Command(BaseCommand):
+    help = 'Re-import notifications from an archive written by prune_notifications'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Archive file (.jsonl or .jsonl.gz)')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows inserted per bulk_create')
+
+    def handle(self, *args, **options):
+        imported = 0
+        try:
+            with open_archive(options['path'], 'r') as archive, preserve_timestamps():
+                rows = read_archive(archive)
+                while True:
+                    batch = list(islice(rows, options['batch_size']))
+                    if not batch:
+                        break
+                    # Rows keep their original ids (and go back to their recipient's
+                    # shard), so importing twice is harmless
+                    for alias, group in group_objects(Notification, batch).items():
+                        with transaction.atomic(using=write_alias(alias)):
+                            using_shard(Notification, alias).bulk_create(group, ignore_conflicts=True)
+                    imported += len(batch)
+        except (OSError, ValueError) as exc:
+            raise CommandError(str(exc))
+        
+        self.stdout.write(self.style.SUCCESS(f'Successfully imported {imported} notifications'))
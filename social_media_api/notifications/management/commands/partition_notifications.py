@@ -0,0 +1,100 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+from notifications.models import Notification
+from social_media_api.sharding import shard_aliases, write_alias
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+def next_month(value):
+    return date(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+class Command(BaseCommand):
+    help = ('PostgreSQL only: convert the notifications table to monthly range partitions on '
+            'timestamp and create partitions for the coming months. Safe to re-run, e.g. monthly.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=3,
+                            help='Number of future monthly partitions to keep ready')
+
+    def handle(self, *args, **options):
+        # Every shard's table when notifications are sharded
+        databases = [connections[write_alias(alias)] for alias in shard_aliases(Notification)]
+        if any(connection.vendor != 'postgresql' for connection in databases):
+            raise CommandError('Notification partitioning is only supported on PostgreSQL')
+
+        table = Notification._meta.db_table
+        for connection in databases:
+            with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                if not self.is_partitioned(cursor, table):
+                    self.convert(cursor, table)
+                    self.stdout.write(f'Converted {table} to a partitioned table on {connection.alias}')
+
+                month = month_start(timezone.now())
+                for _ in range(options['months_ahead'] + 1):
+                    self.create_partition(cursor, table, month)
+                    month = next_month(month)
+
+        self.stdout.write(self.style.SUCCESS('Successfully partitioned notifications'))
+
+    def is_partitioned(self, cursor, table):
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass", [table])
+        return cursor.fetchone()[0] == 'p'
+
+    def create_partition(self, cursor, table, month, parent=None):
+        name = f'{table}_y{month:%Y}m{month:%m}'
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {cursor.db.ops.quote_name(name)} '
+            f'PARTITION OF {cursor.db.ops.quote_name(parent or table)} '
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month(month).isoformat()}')"
+        )
+
+    def convert(self, cursor, table):
+        """Copy the table into a partitioned twin and swap it in, keeping indexes and FKs"""
+        quoted = cursor.db.ops.quote_name(table)
+        new_table = cursor.db.ops.quote_name(f'{table}_partitioned')
+
+        cursor.execute(
+            "SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexname <> %s",
+            [table, f'{table}_pkey'],
+        )
+        index_definitions = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype = 'f'",
+            [table],
+        )
+        foreign_keys = cursor.fetchall()
+
+        # Unique keys of a partitioned table must include the partition key,
+        # so the primary key becomes (id, timestamp); id stays an identity column
+        cursor.execute(f'CREATE TABLE {new_table} (LIKE {quoted} INCLUDING DEFAULTS) PARTITION BY RANGE ("timestamp")')
+        cursor.execute(f'ALTER TABLE {new_table} ALTER COLUMN "id" DROP DEFAULT')
+        cursor.execute(f'ALTER TABLE {new_table} ALTER COLUMN "id" ADD GENERATED BY DEFAULT AS IDENTITY')
+        cursor.execute(f'ALTER TABLE {new_table} ADD PRIMARY KEY ("id", "timestamp")')
+        cursor.execute(f'CREATE TABLE {cursor.db.ops.quote_name(table + "_default")} PARTITION OF {new_table} DEFAULT')
+
+        # Give every month that already holds rows its own partition before copying
+        cursor.execute(f'SELECT MIN("timestamp"), MAX("timestamp") FROM {quoted}')
+        oldest, newest = cursor.fetchone()
+        if oldest is not None:
+            month = month_start(oldest)
+            while month <= newest.date():
+                self.create_partition(cursor, table, month, parent=f'{table}_partitioned')
+                month = next_month(month)
+
+        cursor.execute(f'INSERT INTO {new_table} SELECT * FROM {quoted}')
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE((SELECT MAX(\"id\") FROM {new_table}), 0) + 1, false)",
+            [f'{table}_partitioned'],
+        )
+
+        cursor.execute(f'DROP TABLE {quoted}')
+        cursor.execute(f'ALTER TABLE {new_table} RENAME TO {quoted}')
+        for definition in index_definitions:
+            cursor.execute(definition)
+        for name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE {quoted} ADD CONSTRAINT {cursor.db.ops.quote_name(name)} {definition}')
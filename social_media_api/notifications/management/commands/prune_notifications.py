@@ -0,0 +1,59 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from social_media_api.sharding import shard_aliases, using_shard, write_alias
+from notifications.archive import ArchiveWriter, COLUMNS, open_archive
+from notifications.models import Notification
+from notifications.stats import invalidate_notification_stats
+
+class Command(BaseCommand):
+    help = 'Delete (optionally archiving first) read notifications older than a cutoff, in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=getattr(settings, 'NOTIFICATION_RETENTION_DAYS', 90),
+                            help='Keep read notifications newer than this many days')
+        parser.add_argument('--archive', metavar='PATH',
+                            help='Write pruned rows to this archive file (.jsonl or .jsonl.gz)')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows deleted per transaction')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many notifications would be pruned')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        
+        if options['dry_run']:
+            total = sum(self.expired(alias, cutoff).count() for alias in shard_aliases(Notification))
+            self.stdout.write(f'{total} notifications older than {cutoff:%Y-%m-%d} would be pruned')
+            return
+        
+        archive_file = open_archive(options['archive'], 'w') if options['archive'] else None
+        writer = ArchiveWriter(archive_file) if archive_file else None
+        pruned = 0
+        try:
+            # One shard after another when notifications are sharded
+            for alias in shard_aliases(Notification):
+                expired = self.expired(alias, cutoff)
+                while True:
+                    # Each batch is its own short transaction so no lock is held for long
+                    with transaction.atomic(using=write_alias(alias)):
+                        batch = list(expired.order_by('id').values(*COLUMNS)[:options['batch_size']])
+                        if not batch:
+                            break
+                        if writer:
+                            writer.write_rows(batch)
+                        expired.filter(pk__in=[row['id'] for row in batch]).delete()
+                    invalidate_notification_stats(row['recipient_id'] for row in batch)
+                    pruned += len(batch)
+        finally:
+            if archive_file:
+                archive_file.close()
+        
+        self.stdout.write(self.style.SUCCESS(f'Successfully pruned {pruned} notifications'))
+
+    def expired(self, alias, cutoff):
+        return using_shard(Notification, alias).filter(read=True, timestamp__lt=cutoff)
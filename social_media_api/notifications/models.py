@@ -12,12 +12,17 @@ class Notification(models.Model):
         ('comment', 'Comment'),
     )
     
-    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
-    actor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='actions')
+    # No database constraints: with DATABASE_SHARDS notifications live on
+    # another database than users (see social_media_api.sharding)
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications', db_constraint=False)
+    actor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='actions', db_constraint=False)
     verb = models.CharField(max_length=10, choices=NOTIFICATION_TYPES)
+    # Bursts of the same event are coalesced into one row: "N people liked your post"
+    actor_count = models.PositiveIntegerField(default=1)
     
     # Generic Foreign Key for target object (post, comment, etc.)
-    target_content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, null=True, blank=True)
+    target_content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, null=True, blank=True,
+                                            db_constraint=False)
     target_object_id = models.PositiveIntegerField(null=True, blank=True)
     target = GenericForeignKey('target_content_type', 'target_object_id')
     
@@ -26,6 +31,11 @@ class Notification(models.Model):
     
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['recipient', '-timestamp', '-id'], name='notification_inbox_idx'),
+            # Partial index: unread counts only touch the (small) unread subset
+            models.Index(fields=['recipient'], condition=models.Q(read=False), name='notification_unread_idx'),
+        ]
     
     def __str__(self):
         return f"{self.actor.username} {self.verb} - {self.recipient.username}"
@@ -0,0 +1,117 @@
+"""
+Pub/sub used to push new notifications to open stream connections.
+
+The backend is chosen with NOTIFICATION_PUBSUB_BACKEND. InProcessBackend
+only reaches subscribers in the same process, which is enough for local
+development and tests; multi-process deployments should point the setting
+at a backend built on a shared broker (e.g. Redis) implementing the same
+subscribe()/publish() interface.
+"""
+import asyncio
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from social_media_api.sharding import group_objects, using_shard, with_related
+
+from .models import Notification
+
+
+def user_channel(user_id):
+    return f'notifications:{user_id}'
+
+
+class Subscription:
+    """An asyncio queue of messages published to one channel"""
+    def __init__(self, backend, channel, loop):
+        self.backend = backend
+        self.channel = channel
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.backend.unsubscribe(self)
+
+
+class BaseBackend:
+    def subscribe(self, channel):
+        """Return a Subscription; must be called from the event loop that will read it"""
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription):
+        raise NotImplementedError
+
+    def publish(self, channel, message):
+        """Deliver a JSON-serializable message; safe to call from any thread"""
+        raise NotImplementedError
+
+
+class InProcessBackend(BaseBackend):
+    def __init__(self):
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel, asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def has_subscribers(self, channel):
+        return channel in self._subscriptions
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.queue.put_nowait, message)
+            except RuntimeError:
+                # The subscriber's event loop has already shut down
+                self.unsubscribe(subscription)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                path = getattr(settings, 'NOTIFICATION_PUBSUB_BACKEND', 'notifications.pubsub.InProcessBackend')
+                _backend = import_string(path)()
+    return _backend
+
+
+def publish_notifications(notifications):
+    """Push freshly written notifications to their recipients' streams"""
+    from .serializers import NotificationSerializer
+
+    backend = get_backend()
+    published = [notification for notification in notifications
+                 if notification.pk is not None
+                 and getattr(backend, 'has_subscribers', lambda channel: True)(user_channel(notification.recipient_id))]
+    if not published:
+        return
+
+    # Reloaded with their actors, each from its recipient's shard: ids are only unique per shard
+    saved = []
+    for alias, group in group_objects(Notification, published).items():
+        pks = [notification.pk for notification in group]
+        saved += with_related(using_shard(Notification, alias).filter(pk__in=pks), 'actor')
+    for notification in sorted(saved, key=lambda notification: notification.pk):
+        backend.publish(user_channel(notification.recipient_id), NotificationSerializer(notification).data)
@@ -1,21 +1,23 @@
 from rest_framework import serializers
 from .models import Notification
 from django.contrib.auth import get_user_model
+from social_media_api.sparse_fields import SparseFieldsMixin
 
 User = get_user_model()
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'username', 'email')
 
-class NotificationSerializer(serializers.ModelSerializer):
+class NotificationSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     actor = UserSerializer(read_only=True)
     
     class Meta:
         model = Notification
-        fields = ('id', 'recipient', 'actor', 'verb', 'target_object_id', 'timestamp', 'read')
-        read_only_fields = ('id', 'recipient', 'actor', 'verb', 'target_object_id', 'timestamp')
+        fields = ('id', 'recipient', 'actor', 'actor_count', 'verb', 'target_object_id', 'timestamp', 'read')
+        read_only_fields = ('id', 'recipient', 'actor', 'actor_count', 'verb', 'target_object_id', 'timestamp')
+        expandable_fields = ('actor',)
 
 class NotificationUpdateSerializer(serializers.ModelSerializer):
     class Meta:
@@ -0,0 +1,55 @@
+"""
+Cached per-user notification counters for notification_stats.
+
+Clients poll the stats endpoint constantly, so the total/unread counts are
+kept in the cache and invalidated whenever a user's notifications are
+created or change read state, instead of being recounted on every poll.
+Invalidations come from any web worker, the dispatcher's threads and
+commands such as prune_notifications, so the counters live in
+NOTIFICATION_STATS_CACHE (the 'shared' cache by default) where all of them
+reach every worker; a per-process cache would serve stale counts and wrong
+304s until the entry expired.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Q
+from social_media_api.sharding import on_shard
+
+from .models import Notification
+
+
+def get_cache():
+    return caches[getattr(settings, 'NOTIFICATION_STATS_CACHE', 'shared')]
+
+
+def stats_cache_key(user_id):
+    return f'notification-stats:{user_id}'
+
+
+def get_notification_stats(user):
+    """Return {'total_notifications', 'unread_notifications'} for a user"""
+    cache = get_cache()
+    key = stats_cache_key(user.pk)
+    stats = cache.get(key)
+    if stats is None:
+        # One pass over the recipient's rows instead of two separate COUNT(*)s
+        stats = on_shard(Notification, user.pk).filter(recipient=user).aggregate(
+            total_notifications=Count('id'),
+            unread_notifications=Count('id', filter=Q(read=False)),
+        )
+        cache.set(key, stats, getattr(settings, 'NOTIFICATION_STATS_TTL', 300))
+    return stats
+
+
+def invalidate_notification_stats(user_ids):
+    """Drop cached counters after notifications of these users changed"""
+    get_cache().delete_many([stats_cache_key(user_id) for user_id in set(user_ids)])
+
+
+def stats_etag(stats):
+    digest = hashlib.md5(
+        f"{stats['total_notifications']}:{stats['unread_notifications']}".encode()
+    ).hexdigest()
+    return f'"{digest}"'
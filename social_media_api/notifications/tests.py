@@ -0,0 +1,261 @@
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.management import CommandError, call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from accounts.authentication import token_cache
+from posts.models import Post
+from social_media_api.instrumentation import QueryBudgetTestMixin
+from .archive import COLUMNS, open_archive, read_archive
+from .dispatcher import NotificationDispatcher, notify
+from .models import Notification
+from .pubsub import get_backend, user_channel
+from .stats import get_cache as get_stats_cache, stats_cache_key
+
+User = get_user_model()
+
+@override_settings(SECURE_SSL_REDIRECT=False, NOTIFICATION_DELIVERY='sync')
+class NotificationQueryBudgetTest(QueryBudgetTestMixin, TestCase):
+    """Notification reads stay within their query_budget with every cache cold"""
+    
+    def setUp(self):
+        self.addCleanup(cache.clear)
+        self.addCleanup(get_stats_cache().clear)
+        self.user = User.objects.create_user(username='user', password='12345')
+        for i in range(15):
+            notify(self.user, User.objects.create_user(username=f'actor{i}', password='12345'), 'follow')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.user).key}')
+    
+    def test_reads(self):
+        notification = self.user.notifications.first()
+        for path in ['/api/notifications/', '/api/notifications/?cursor=', '/api/notifications/?page=2',
+                     f'/api/notifications/{notification.pk}/', '/api/notifications/stats/']:
+            for clear in (cache.clear, get_stats_cache().clear, token_cache.clear):
+                clear()
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertWithinQueryBudget(response)
+
+@override_settings(SECURE_SSL_REDIRECT=False, NOTIFICATION_DELIVERY='sync')
+class NotificationStatsCacheTest(TestCase):
+    """Stats cached by one worker are invalidated by writes anywhere else"""
+    
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        # A cache outside the process, as every worker and command would share it
+        self.enterContext(override_settings(CACHES=dict(settings.CACHES, shared={
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location})))
+        self.other_worker = FileBasedCache(location, {})
+        self.user = User.objects.create_user(username='user', password='12345')
+        self.actor = User.objects.create_user(username='actor', password='12345')
+        notify(self.user, self.actor, 'follow')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+    
+    def stats(self, etag=None):
+        return self.client.get('/api/notifications/stats/', HTTP_IF_NONE_MATCH=etag)
+    
+    def test_invalidations_reach_every_worker(self):
+        etag = self.stats()['ETag']
+        self.assertIsNotNone(self.other_worker.get(stats_cache_key(self.user.pk)))
+        self.assertEqual(self.stats(etag).status_code, 304)
+        
+        # A new notification delivered by the dispatcher
+        notify(self.user, self.actor, 'like')
+        self.assertIsNone(self.other_worker.get(stats_cache_key(self.user.pk)))
+        response = self.stats(etag)
+        self.assertEqual(response.data, {'total_notifications': 2, 'unread_notifications': 2})
+        
+        self.client.post('/api/notifications/mark-all-read/')
+        self.assertEqual(self.stats(response['ETag']).data['unread_notifications'], 0)
+        
+        # prune_notifications runs in a process of its own
+        Notification.objects.update(timestamp=timezone.now() - timedelta(days=100))
+        self.stats()
+        call_command('prune_notifications', stdout=open(os.devnull, 'w'))
+        self.assertIsNone(self.other_worker.get(stats_cache_key(self.user.pk)))
+        self.assertEqual(self.stats().data['total_notifications'], 0)
+
+@override_settings(NOTIFICATION_DELIVERY='async')
+class NotificationDispatcherTest(TransactionTestCase):
+    """Delivery by worker threads, which only see committed rows"""
+    
+    def setUp(self):
+        self.addCleanup(get_stats_cache().clear)
+        self.author = User.objects.create_user(username='author', password='12345')
+        self.fans = [User.objects.create_user(username=f'fan{i}', password='12345') for i in range(2)]
+        self.posts = [Post.objects.create(title=f'Post {i}', content='Test content', author=self.author)
+                      for i in range(2)]
+        self.dispatcher = NotificationDispatcher(workers=1, flush_interval=1)
+    
+    def test_events_in_one_window_are_coalesced(self):
+        self.dispatcher.notify(self.author, self.fans[0], 'like', target=self.posts[0])
+        self.dispatcher.notify(self.author, self.fans[1], 'like', target=self.posts[0])
+        self.dispatcher.notify(self.author, self.fans[1], 'like', target=self.posts[1])
+        self.dispatcher.notify(self.author, self.author, 'like', target=self.posts[1])
+        self.assertFalse(Notification.objects.exists())
+        self.dispatcher.flush()
+        
+        # "fan1 and 1 other liked your post", and a separate one for the other post
+        first, second = Notification.objects.order_by('target_object_id')
+        self.assertEqual((first.target, first.actor, first.actor_count), (self.posts[0], self.fans[1], 2))
+        self.assertEqual((second.target, second.actor, second.actor_count), (self.posts[1], self.fans[1], 1))
+        
+        # A later window is a new notification
+        self.dispatcher.notify(self.author, self.fans[0], 'like', target=self.posts[0])
+        self.dispatcher.flush()
+        self.assertEqual(Notification.objects.filter(target_object_id=self.posts[0].pk).count(), 2)
+    
+    def test_queued_events_are_delivered_at_exit(self):
+        # A process that queues a notification and exits straight away, with deliver() reporting instead of writing
+        script = textwrap.dedent("""
+            import django
+            django.setup()
+            from django.contrib.auth import get_user_model
+            from notifications import dispatcher
+            dispatcher.deliver = lambda events: print(f'delivered {len(events)}', flush=True)
+            User = get_user_model()
+            dispatcher.notify(User(pk=1), User(pk=2), 'follow')
+            dispatcher.notify(User(pk=1), User(pk=3), 'follow')
+        """)
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='social_media_api.settings', NOTIFICATION_DELIVERY='async')
+        result = subprocess.run([sys.executable, '-c', script], cwd=settings.BASE_DIR, env=env,
+                                capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout, 'delivered 2\n')
+
+@override_settings(NOTIFICATION_DELIVERY='sync')
+class NotificationArchiveTest(TestCase):
+    def setUp(self):
+        self.addCleanup(get_stats_cache().clear)
+        self.user = User.objects.create_user(username='user', password='12345')
+        actors = [User.objects.create_user(username=f'actor{i}', password='12345') for i in range(2)]
+        post = Post.objects.create(title='Post', content='Test content', author=self.user)
+        notify(self.user, actors[0], 'follow')
+        notify(self.user, actors[0], 'like', target=post)
+        notify(self.user, actors[1], 'comment', target=post)
+        notify(actors[0], self.user, 'follow')
+        self.follow, self.like, self.comment, self.other = Notification.objects.order_by('id')
+        self.archive = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'archive.jsonl.gz')
+    
+    def age(self, notification, days, read=True):
+        Notification.objects.filter(pk=notification.pk).update(timestamp=timezone.now() - timedelta(days=days), read=read)
+    
+    def prune(self, *args):
+        call_command('prune_notifications', *args, stdout=open(os.devnull, 'w'))
+    
+    def test_retention_cutoff(self):
+        self.age(self.follow, 100)
+        self.age(self.like, 100, read=False)
+        self.age(self.comment, 40)
+        self.age(self.other, 10)
+        
+        self.prune('--dry-run')
+        self.assertEqual(Notification.objects.count(), 4)
+        # Only read notifications past the cutoff go; unread ones are kept however old
+        self.prune()
+        self.assertCountEqual(Notification.objects.values_list('pk', flat=True),
+                              [self.like.pk, self.comment.pk, self.other.pk])
+        self.prune('--days', '30', '--batch-size', '1')
+        self.assertCountEqual(Notification.objects.values_list('pk', flat=True), [self.like.pk, self.other.pk])
+    
+    def test_archive_and_restore_round_trip(self):
+        for notification in (self.follow, self.like, self.comment):
+            self.age(notification, 100)
+        expected = list(Notification.objects.order_by('id').values(*COLUMNS))
+        
+        self.prune('--archive', self.archive, '--batch-size', '2')
+        self.assertEqual(list(Notification.objects.values_list('pk', flat=True)), [self.other.pk])
+        with open_archive(self.archive, 'r') as archive:
+            self.assertEqual([notification.pk for notification in read_archive(archive)],
+                             [self.follow.pk, self.like.pk, self.comment.pk])
+        
+        # Twice: rows keep their ids, so a repeated import adds nothing
+        for _ in range(2):
+            call_command('import_notifications', self.archive, stdout=open(os.devnull, 'w'))
+        self.assertEqual(list(Notification.objects.order_by('id').values(*COLUMNS)), expected)
+    
+    def test_bad_archive_and_partitioning_on_sqlite(self):
+        with open(self.archive[:-3], 'w') as fp:
+            fp.write('{"format": "something-else"}\n')
+        with self.assertRaises(CommandError):
+            call_command('import_notifications', self.archive[:-3], stdout=open(os.devnull, 'w'))
+        with self.assertRaisesMessage(CommandError, 'only supported on PostgreSQL'):
+            call_command('partition_notifications', stdout=open(os.devnull, 'w'))
+
+@override_settings(SECURE_SSL_REDIRECT=False, NOTIFICATION_DELIVERY='sync',
+                   NOTIFICATION_PUBSUB_BACKEND='notifications.pubsub.InProcessBackend')
+class NotificationStreamTest(TestCase):
+    def setUp(self):
+        self.addCleanup(token_cache.clear)
+        self.user = User.objects.create_user(username='user', password='12345')
+        self.actor = User.objects.create_user(username='actor', password='12345')
+        self.token = Token.objects.create(user=self.user).key
+    
+    async def open_stream(self, **headers):
+        response = await self.async_client.get('/api/notifications/stream/',
+                                               headers={'Authorization': f'Token {self.token}', **headers})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await self.next_chunk(stream), ': connected\n\n')
+        return stream
+    
+    async def next_chunk(self, stream):
+        chunk = await asyncio.wait_for(anext(stream), timeout=5)
+        return chunk.decode() if isinstance(chunk, bytes) else chunk
+    
+    async def next_event(self, stream):
+        fields = dict(line.split(': ', 1) for line in (await self.next_chunk(stream)).strip().split('\n'))
+        self.assertEqual(fields['event'], 'notification')
+        data = json.loads(fields['data'])
+        self.assertEqual(int(fields['id']), data['id'])
+        return data
+    
+    async def test_unauthenticated(self):
+        response = await self.async_client.get('/api/notifications/stream/')
+        self.assertEqual(response.status_code, 401)
+    
+    async def test_published_notification_is_pushed(self):
+        stream = await self.open_stream()
+        try:
+            self.assertTrue(get_backend().has_subscribers(user_channel(self.user.pk)))
+            await sync_to_async(notify)(self.user, self.actor, 'follow')
+            event = await self.next_event(stream)
+            notification = await Notification.objects.aget()
+            self.assertEqual(event['id'], notification.pk)
+            self.assertEqual(event['verb'], 'follow')
+        finally:
+            await stream.aclose()
+    
+    async def test_reconnect_replays_after_last_event_id(self):
+        for verb in ('follow', 'like', 'comment'):
+            await sync_to_async(notify)(self.user, self.actor, verb)
+        first, *missed = [pk async for pk in Notification.objects.order_by('id').values_list('id', flat=True)]
+        
+        stream = await self.open_stream(**{'Last-Event-ID': str(first)})
+        try:
+            self.assertEqual([(await self.next_event(stream))['id'] for _ in missed], missed)
+            # Then live events, without repeating the replayed ones
+            await sync_to_async(notify)(self.user, self.actor, 'follow')
+            latest = await Notification.objects.alatest('id')
+            self.assertEqual((await self.next_event(stream))['id'], latest.pk)
+        finally:
+            await stream.aclose()
@@ -1,8 +1,10 @@
 from django.urls import path
-from .views import NotificationListView, NotificationDetailView, notification_stats, mark_all_read
+from .views import (NotificationListView, NotificationDetailView, notification_stats, mark_all_read,
+                    notification_stream)
 
 urlpatterns = [
     path('', NotificationListView.as_view(), name='notification-list'),
+    path('stream/', notification_stream, name='notification-stream'),
     path('stats/', notification_stats, name='notification-stats'),
     path('mark-all-read/', mark_all_read, name='mark-all-read'),
     path('<int:pk>/', NotificationDetailView.as_view(), name='notification-detail'),
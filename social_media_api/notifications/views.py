@@ -1,36 +1,128 @@
-from rest_framework import generics, status, permissions
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework import generics, status, permissions, exceptions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
+from accounts.authentication import CachingTokenAuthentication
+from social_media_api.instrumentation import InstrumentedViewMixin, query_budget
+from social_media_api.pagination import KeysetPagination
+from social_media_api.sharding import on_shard, with_related
+from social_media_api.sparse_fields import SparseFieldsViewMixin
 from .models import Notification
+from .pubsub import get_backend, user_channel
 from .serializers import NotificationSerializer, NotificationUpdateSerializer
+from .stats import get_notification_stats, invalidate_notification_stats, stats_etag
 
-class NotificationListView(generics.ListAPIView):
+class NotificationListView(InstrumentedViewMixin, SparseFieldsViewMixin, generics.ListAPIView):
     serializer_class = NotificationSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-timestamp', '-id')
+    # Page-number requests (?page=) add a COUNT
+    query_budget = 3
     
     def get_queryset(self):
-        return Notification.objects.filter(recipient=self.request.user).select_related('actor')
+        notifications = on_shard(Notification, self.request.user.pk).filter(recipient=self.request.user)
+        return with_related(notifications, 'actor')
 
-class NotificationDetailView(generics.RetrieveUpdateAPIView):
+class NotificationDetailView(InstrumentedViewMixin, generics.RetrieveUpdateAPIView):
     serializer_class = NotificationUpdateSerializer
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = {'get': 2}
     
     def get_queryset(self):
-        return Notification.objects.filter(recipient=self.request.user)
+        return on_shard(Notification, self.request.user.pk).filter(recipient=self.request.user)
+    
+    def perform_update(self, serializer):
+        serializer.save()
+        invalidate_notification_stats([self.request.user.pk])
 
+@query_budget(2)
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def notification_stats(request):
-    total = Notification.objects.filter(recipient=request.user).count()
-    unread = Notification.objects.filter(recipient=request.user, read=False).count()
+    stats = get_notification_stats(request.user)
+    etag = stats_etag(stats)
+    
+    # Unchanged since the client's last poll: answer from the cache with no body
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
     
     return Response({
-        'total_notifications': total,
-        'unread_notifications': unread
-    })
+        'total_notifications': stats['total_notifications'],
+        'unread_notifications': stats['unread_notifications']
+    }, headers={'ETag': etag})
 
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def mark_all_read(request):
-    Notification.objects.filter(recipient=request.user, read=False).update(read=True)
+    on_shard(Notification, request.user.pk).filter(recipient=request.user, read=False).update(read=True)
+    invalidate_notification_stats([request.user.pk])
     return Response({'message': 'All notifications marked as read'})
+
+async def notification_stream(request):
+    """
+    Server-Sent Events stream of the authenticated user's new notifications.
+    
+    Holds the connection open (serve under ASGI) and pushes each notification
+    as it is delivered. Reconnecting clients send Last-Event-ID and first
+    receive anything they missed.
+    """
+    try:
+        auth = await sync_to_async(CachingTokenAuthentication().authenticate)(request)
+    except exceptions.AuthenticationFailed as exc:
+        return JsonResponse({'detail': str(exc.detail)}, status=status.HTTP_401_UNAUTHORIZED)
+    if auth is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'},
+                            status=status.HTTP_401_UNAUTHORIZED)
+    user = auth[0]
+    
+    # Subscribe before looking up what was missed, so nothing published in
+    # between is lost; _event_stream drops what arrives both ways
+    subscription = get_backend().subscribe(user_channel(user.pk))
+    missed = []
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id and last_event_id.isdigit():
+        try:
+            missed = await sync_to_async(_notifications_after)(user, int(last_event_id))
+        except BaseException:
+            subscription.close()
+            raise
+    
+    response = StreamingHttpResponse(
+        _event_stream(subscription, missed), content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def _notifications_after(user, last_id):
+    notifications = on_shard(Notification, user.pk).filter(recipient=user, id__gt=last_id)
+    notifications = with_related(notifications, 'actor').order_by('id')[:100]
+    return [NotificationSerializer(notification).data for notification in notifications]
+
+def _format_event(message):
+    return f"id: {message['id']}\nevent: notification\ndata: {json.dumps(message)}\n\n"
+
+async def _event_stream(subscription, missed):
+    keepalive = getattr(settings, 'NOTIFICATION_STREAM_KEEPALIVE', 15)
+    try:
+        yield ': connected\n\n'
+        for message in missed:
+            yield _format_event(message)
+        sent_ids = {message['id'] for message in missed}
+        while True:
+            try:
+                message = await asyncio.wait_for(subscription.get(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                # Comment line keeps proxies from closing an idle connection
+                yield ': keep-alive\n\n'
+                continue
+            if message['id'] not in sent_ids:
+                yield _format_event(message)
+    finally:
+        subscription.close()
@@ -0,0 +1,308 @@
+"""
+Bulk NDJSON import and export of posts, comments and likes.
+
+Every line is one JSON object tagged with its type:
+
+    {"type": "post", "id": 7, "author": "alice", "title": "...", "content": "...", "created_at": "..."}
+    {"type": "comment", "id": 9, "post": 7, "author": "bob", "content": "...", "created_at": "..."}
+    {"type": "like", "post": 7, "user": "carol", "created_at": "..."}
+
+Users are referenced by username so a stream can move between databases.
+Exports write every post before any comment or like. On import, post ids
+seen earlier in the same stream are mapped to the newly created rows, and
+rows referring to a stream post that failed to import are rejected. Any
+other post id is rejected too, unless the import is told to take it as the
+id of a post already in this database (local_post_ids, --local-post-ids):
+in a dump from elsewhere the same number is an unrelated post.
+
+Imports validate with PostCreateSerializer/CommentCreateSerializer and
+insert with bulk_create, one transaction per batch of lines; imported posts
+are fanned out to their authors' followers' timelines, and imported likes
+and comments update the posts' counters and trending scores. Exports read
+with iterator(), so memory stays flat however many rows there are.
+"""
+import json
+from collections import Counter
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from notifications.archive import encode_value
+from social_media_api.sharding import each_shard, group_objects, scatter_gather, using_shard
+
+from .models import Comment, Like, Post, recount_posts
+from .response_cache import invalidate_posts
+from .search import get_post_search
+from .serializers import CommentCreateSerializer, PostCreateSerializer
+from .timeline import fan_out_posts
+from .trending import record_events
+
+User = get_user_model()
+
+EXPORT_TYPES = ('post', 'comment', 'like')
+# Errors reported back in full; later ones are only counted
+MAX_REPORTED_ERRORS = 100
+
+
+def dump_line(row):
+    return json.dumps(row, default=encode_value, separators=(',', ':')) + '\n'
+
+
+def export_lines(types=EXPORT_TYPES, chunk_size=2000):
+    """Yield NDJSON lines for every post, comment and like of the requested types"""
+    if 'post' in types:
+        posts = Post.objects.order_by('pk').values_list(
+            'pk', 'author__username', 'title', 'content', 'created_at', 'updated_at')
+        for pk, author, title, content, created_at, updated_at in posts.iterator(chunk_size=chunk_size):
+            yield dump_line({'type': 'post', 'id': pk, 'author': author, 'title': title,
+                             'content': content, 'created_at': created_at, 'updated_at': updated_at})
+    if 'comment' in types:
+        comments = Comment.objects.order_by('pk').values_list(
+            'pk', 'post_id', 'author__username', 'content', 'created_at', 'updated_at')
+        for pk, post_id, author, content, created_at, updated_at in comments.iterator(chunk_size=chunk_size):
+            yield dump_line({'type': 'comment', 'id': pk, 'post': post_id, 'author': author,
+                             'content': content, 'created_at': created_at, 'updated_at': updated_at})
+    if 'like' in types:
+        # Usernames are looked up per chunk: sharded likes can't be joined with users
+        for manager in each_shard(Like):
+            likes = (manager.order_by('pk').values_list('post_id', 'user_id', 'created_at')
+                     .iterator(chunk_size=chunk_size))
+            while chunk := list(islice(likes, chunk_size)):
+                usernames = dict(User.objects.filter(pk__in={user_id for _, user_id, _ in chunk})
+                                 .values_list('pk', 'username'))
+                for post_id, user_id, created_at in chunk:
+                    yield dump_line({'type': 'like', 'post': post_id, 'user': usernames[user_id],
+                                     'created_at': created_at})
+
+
+class InvalidRow(Exception):
+    pass
+
+
+class BulkImporter:
+    """Import NDJSON lines in batches; rows that fail validation are reported and skipped"""
+
+    def __init__(self, default_author=None, batch_size=500, local_post_ids=False):
+        self.default_author = default_author
+        self.batch_size = batch_size
+        # Whether post ids not in the stream refer to posts in this database
+        self.local_post_ids = local_post_ids
+        # Post ids in the stream -> ids of the posts created for them
+        self.post_ids = {}
+        # Post ids in the stream whose rows failed to import
+        self.failed_post_ids = set()
+        self.imported = Counter({row_type: 0 for row_type in EXPORT_TYPES})
+        self.errors = []
+        self.error_count = 0
+        self.line_number = 0
+
+    def feed(self, lines):
+        lines = iter(lines)
+        while True:
+            batch = list(islice(lines, self.batch_size))
+            if not batch:
+                return self
+            self.import_batch(batch)
+
+    def report(self):
+        return {'imported': dict(self.imported), 'error_count': self.error_count, 'errors': self.errors}
+
+    def error(self, line, errors):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'errors': errors})
+
+    def parse(self, batch):
+        rows = {row_type: [] for row_type in EXPORT_TYPES}
+        for raw in batch:
+            self.line_number += 1
+            try:
+                if isinstance(raw, bytes):
+                    raw = raw.decode('utf-8')
+                if not raw.strip():
+                    continue
+                row = json.loads(raw)
+            except ValueError:
+                self.error(self.line_number, 'Invalid JSON')
+                continue
+            if not isinstance(row, dict) or row.get('type') not in rows:
+                self.error(self.line_number, f'"type" must be one of {", ".join(EXPORT_TYPES)}')
+                continue
+            rows[row['type']].append((self.line_number, row))
+        return rows
+
+    def import_batch(self, batch):
+        rows = self.parse(batch)
+        names = {row.get(key) for items in rows.values() for _, row in items for key in ('author', 'user')
+                 if isinstance(row.get(key), str)}
+        users = User.objects.in_bulk(names, field_name='username')
+
+        with transaction.atomic():
+            post_pks = self.import_posts(rows['post'], users)
+            comments = self.import_comments(rows['comment'], users)
+            likes = self.import_likes(rows['like'], users)
+
+            touched = {comment.post_id for comment in comments} | {like.post_id for like in likes}
+            if touched:
+                recount_posts(touched)
+                record_events([(comment.post_id, 'comment', comment.created_at) for comment in comments]
+                              + [(like.post_id, 'like', like.created_at) for like in likes])
+            get_post_search(Post).update_many(Post, post_pks)
+            get_post_search(Comment).update_many(Comment, [comment.pk for comment in comments])
+            transaction.on_commit(lambda: invalidate_posts(touched, listing=bool(post_pks)))
+
+    def validate(self, serializer_class, items):
+        """Return [((line, row), validated_data)] for the rows `serializer_class` accepts"""
+        if not items:
+            return []
+        serializer = serializer_class(data=[row for _, row in items], many=True)
+        if serializer.is_valid():
+            return list(zip(items, serializer.validated_data))
+        # Per-row errors come as a list, or as {index: errors} from newer DRF releases
+        errors = serializer.errors
+        if not isinstance(errors, dict):
+            errors = dict(enumerate(errors))
+        valid = []
+        for index, item in enumerate(items):
+            if errors.get(index):
+                self.error(item[0], errors[index])
+            else:
+                valid.append(item)
+        return self.validate(serializer_class, valid)
+
+    def user(self, row, key, users):
+        name = row.get(key)
+        if name is None and self.default_author is not None:
+            return self.default_author
+        if not isinstance(name, str) or name not in users:
+            raise InvalidRow({key: f'Unknown user {name!r}'})
+        return users[name]
+
+    def timestamps(self, row):
+        """Return (created_at, updated_at) from the row, or (None, None) to keep now()"""
+        values = []
+        for key in ('created_at', 'updated_at'):
+            value = row.get(key)
+            if value is not None:
+                try:
+                    value = parse_datetime(value)
+                except (TypeError, ValueError):
+                    value = None
+                if value is None:
+                    raise InvalidRow({key: 'Invalid datetime'})
+                if timezone.is_naive(value):
+                    value = timezone.make_aware(value)
+            values.append(value)
+        created_at, updated_at = values
+        return created_at, updated_at or created_at
+
+    def post_id(self, row, existing):
+        ref = row.get('post')
+        if not isinstance(ref, int):
+            raise InvalidRow({'post': 'A post id is required'})
+        if ref in self.post_ids:
+            return self.post_ids[ref]
+        if ref in self.failed_post_ids:
+            raise InvalidRow({'post': f'Post {ref!r} of this stream was not imported'})
+        if ref in existing:
+            return ref
+        raise InvalidRow({'post': f'Unknown post {ref!r}'})
+
+    def existing_posts(self, items):
+        """Ids of the local posts `items` may refer to: none unless local_post_ids is set"""
+        if not self.local_post_ids:
+            return set()
+        refs = {row.get('post') for _, row in items
+                if isinstance(row.get('post'), int) and row.get('post') not in self.post_ids}
+        return set(Post.objects.filter(pk__in=refs - self.failed_post_ids).values_list('pk', flat=True))
+
+    def restore_timestamps(self, model, objects, stamps, fields):
+        """bulk_create applies auto_now(_add); write the imported timestamps back in one UPDATE"""
+        changed = []
+        for obj, (created_at, updated_at) in zip(objects, stamps):
+            if created_at is not None:
+                obj.created_at = created_at
+                if 'updated_at' in fields:
+                    obj.updated_at = updated_at
+                changed.append(obj)
+        if changed:
+            for alias, group in group_objects(model, changed).items():
+                using_shard(model, alias).bulk_update(group, fields, batch_size=self.batch_size)
+
+    def import_posts(self, items, users):
+        posts, stamps, refs = [], [], []
+        for (line, row), data in self.validate(PostCreateSerializer, items):
+            try:
+                author = self.user(row, 'author', users)
+                stamps.append(self.timestamps(row))
+            except InvalidRow as exc:
+                self.error(line, exc.args[0])
+                continue
+            posts.append(Post(author=author, **data))
+            refs.append(row.get('id'))
+
+        Post.objects.bulk_create(posts, batch_size=self.batch_size)
+        self.restore_timestamps(Post, posts, stamps, ['created_at', 'updated_at'])
+        fan_out_posts(posts, batch_size=self.batch_size)
+        for ref, post in zip(refs, posts):
+            if isinstance(ref, int):
+                self.post_ids[ref] = post.pk
+        self.failed_post_ids.update(
+            row['id'] for _, row in items if isinstance(row.get('id'), int) and row['id'] not in self.post_ids
+        )
+        self.imported['post'] += len(posts)
+        return [post.pk for post in posts]
+
+    def import_comments(self, items, users):
+        existing = self.existing_posts(items)
+        comments, stamps = [], []
+        for (line, row), data in self.validate(CommentCreateSerializer, items):
+            try:
+                author = self.user(row, 'author', users)
+                post_id = self.post_id(row, existing)
+                stamps.append(self.timestamps(row))
+            except InvalidRow as exc:
+                self.error(line, exc.args[0])
+                continue
+            comments.append(Comment(author=author, post_id=post_id, **data))
+
+        Comment.objects.bulk_create(comments, batch_size=self.batch_size)
+        self.restore_timestamps(Comment, comments, stamps, ['created_at', 'updated_at'])
+        self.imported['comment'] += len(comments)
+        return comments
+
+    def import_likes(self, items, users):
+        existing = self.existing_posts(items)
+        # (user_id, post_id) -> (Like, timestamps); repeated rows collapse into one like
+        likes = {}
+        for line, row in items:
+            try:
+                user = self.user(row, 'user', users)
+                post_id = self.post_id(row, existing)
+                stamps = self.timestamps(row)
+            except InvalidRow as exc:
+                self.error(line, exc.args[0])
+                continue
+            likes.setdefault((user.pk, post_id), (Like(user=user, post_id=post_id), stamps))
+        if not likes:
+            return []
+
+        # Skip likes that already exist, so the rest can be created with their ids returned
+        user_ids = {user_id for user_id, _ in likes}
+
+        def present(manager, post_ids):
+            return list(manager.filter(post_id__in=post_ids, user_id__in=user_ids).values_list('user_id', 'post_id'))
+        for found in scatter_gather(Like, present, keys={post_id for _, post_id in likes}):
+            for pair in found:
+                likes.pop(pair, None)
+        new_likes = [like for like, _ in likes.values()]
+
+        # Each shard's rows are committed with it, ahead of the batch on the primary
+        for alias, group in group_objects(Like, new_likes).items():
+            using_shard(Like, alias).bulk_create(group, batch_size=self.batch_size)
+        self.restore_timestamps(Like, new_likes, [stamps for _, stamps in likes.values()], ['created_at'])
+        self.imported['like'] += len(new_likes)
+        return new_likes
@@ -0,0 +1,118 @@
+"""
+The single write path for likes.
+
+Liking is one INSERT ... ON CONFLICT DO NOTHING RETURNING and unliking one
+DELETE ... RETURNING, so concurrent double-taps can't hit the unique
+(user, post) constraint and the returned rows tell us exactly which likes
+changed. likes_count and the trending score are adjusted in the same
+transaction for those rows only.
+Both functions take many post ids so the batch endpoint shares this path.
+
+With sharded likes (social_media_api.sharding) each shard holding the posts
+gets its own statement and transaction, committed just before the counters
+on the primary; if that commit then fails, `recount_counters` repairs them.
+"""
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from notifications.dispatcher import notify
+from social_media_api.sharding import group_by_shard, using_shard, write_alias
+
+from .models import Like, Post
+from .response_cache import invalidate_posts
+from .trending import record_activity
+
+User = get_user_model()
+
+
+def supports_returning(connection):
+    # ON CONFLICT and RETURNING: PostgreSQL, and SQLite from 3.35
+    return connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_columns_from_insert
+
+
+def _insert_likes(user, post_ids, created_at, alias):
+    connection = connections[write_alias(alias)]
+    if not supports_returning(connection):
+        created = []
+        for post_id in post_ids:
+            try:
+                with transaction.atomic(using=connection.alias):
+                    like = using_shard(Like, alias).create(user=user, post_id=post_id)
+            except IntegrityError:
+                continue
+            created.append(like)
+        return created
+
+    table = Like._meta.db_table
+    value = connection.ops.adapt_datetimefield_value(created_at)
+    rows = ', '.join(['(%s, %s, %s)'] * len(post_ids))
+    params = []
+    for post_id in post_ids:
+        params += [user.pk, post_id, value]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} (user_id, post_id, created_at) VALUES {rows} '
+            f'ON CONFLICT (user_id, post_id) DO NOTHING RETURNING id, post_id',
+            params,
+        )
+        return [Like(id=like_id, user=user, post_id=post_id, created_at=created_at)
+                for like_id, post_id in cursor.fetchall()]
+
+
+def _delete_likes(user, post_ids, alias):
+    connection = connections[write_alias(alias)]
+    if not supports_returning(connection):
+        likes = list(using_shard(Like, alias).filter(user=user, post_id__in=post_ids).values_list('pk', 'post_id'))
+        # One DELETE per like: its row count tells whether this request or a racing one removed it
+        return [post_id for pk, post_id in likes if using_shard(Like, alias).filter(pk=pk).delete()[0]]
+
+    table = Like._meta.db_table
+    placeholders = ', '.join(['%s'] * len(post_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {table} WHERE user_id = %s AND post_id IN ({placeholders}) RETURNING post_id',
+            [user.pk, *post_ids],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def like_posts(user, posts):
+    """Like each of `posts` (loaded with author_id) for `user`; return the Likes actually created"""
+    if not posts:
+        return []
+    by_id = {post.pk: post for post in posts}
+    now = timezone.now()
+    with transaction.atomic():
+        likes = []
+        for alias, post_ids in group_by_shard(Like, by_id).items():
+            # Joins the transaction above unless the likes are on a shard
+            with transaction.atomic(using=write_alias(alias), savepoint=False):
+                likes += _insert_likes(user, post_ids, now, alias)
+        liked_ids = [like.post_id for like in likes]
+        Post.objects.filter(pk__in=liked_ids).update(likes_count=F('likes_count') + 1)
+        record_activity(liked_ids, 'like', now)
+        transaction.on_commit(lambda: invalidate_posts(liked_ids))
+
+    for like in likes:
+        post = by_id[like.post_id]
+        like.post = post
+        # Queue notification for post author (skipped when liking own post)
+        notify(User(pk=post.author_id), user, 'like', target=post)
+    return likes
+
+
+def unlike_posts(user, post_ids):
+    """Remove `user`'s likes on `post_ids`; return the ids of posts that were liked"""
+    post_ids = list(set(post_ids))
+    if not post_ids:
+        return []
+    with transaction.atomic():
+        unliked = []
+        for alias, shard_post_ids in group_by_shard(Like, post_ids).items():
+            with transaction.atomic(using=write_alias(alias), savepoint=False):
+                unliked += _delete_likes(user, shard_post_ids, alias)
+        Post.objects.filter(pk__in=unliked, likes_count__gte=1).update(likes_count=F('likes_count') - 1)
+        transaction.on_commit(lambda: invalidate_posts(unliked))
+    return unliked
@@ -0,0 +1,31 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from notifications.archive import open_archive
+from posts.bulk import EXPORT_TYPES, export_lines
+
+class Command(BaseCommand):
+    help = 'Stream posts, comments and likes as NDJSON, for import_posts in another environment'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='-',
+                            help='File to write (.ndjson, or .gz to compress); "-" for stdout')
+        parser.add_argument('--types', default=','.join(EXPORT_TYPES),
+                            help='Comma-separated row types to export')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Rows fetched from the database at a time')
+
+    def handle(self, *args, **options):
+        types = [row_type.strip() for row_type in options['types'].split(',') if row_type.strip()]
+        unknown = set(types) - set(EXPORT_TYPES)
+        if unknown:
+            raise CommandError(f'Unknown types: {", ".join(sorted(unknown))}')
+
+        lines = export_lines(types, chunk_size=options['chunk_size'])
+        if options['output'] == '-':
+            sys.stdout.writelines(lines)
+            return
+        
+        with open_archive(options['output'], 'w') as output:
+            output.writelines(lines)
+        self.stdout.write(self.style.SUCCESS(f'Successfully exported {", ".join(types)} to {options["output"]}'))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from social_media_api.benchmark import DEFAULT_PREFIX, clear, generate
+
+class Command(BaseCommand):
+    help = 'Create a seeded benchmark dataset of users, follows, posts, comments, likes and notifications'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--follows-per-user', type=int, default=20,
+                            help='Mean follows per user; followers concentrate on a few popular users')
+        parser.add_argument('--posts-per-user', type=int, default=5, help='Mean posts per user')
+        parser.add_argument('--comments-per-post', type=int, default=2, help='Mean comments per post')
+        parser.add_argument('--likes-per-post', type=int, default=5, help='Mean likes per post')
+        parser.add_argument('--days', type=int, default=30, help='Spread activity over this many past days')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default=DEFAULT_PREFIX, help='Username prefix of benchmark users')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per bulk_create')
+        parser.add_argument('--clear', action='store_true',
+                            help='Delete existing benchmark users with the prefix first')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            self.stdout.write(f'Deleted {clear(options["prefix"])} rows of earlier benchmark data')
+        
+        created = generate(
+            users=options['users'], follows_per_user=options['follows_per_user'],
+            posts_per_user=options['posts_per_user'], comments_per_post=options['comments_per_post'],
+            likes_per_post=options['likes_per_post'], days=options['days'], seed=options['seed'],
+            prefix=options['prefix'], batch_size=options['batch_size'],
+        )
+        for name, count in created.items():
+            self.stdout.write(f'{name}: {count}')
+        self.stdout.write(self.style.SUCCESS('Successfully generated benchmark data'))
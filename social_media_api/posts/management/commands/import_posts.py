@@ -0,0 +1,45 @@
+import json
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from notifications.archive import open_archive
+from posts.bulk import BulkImporter
+
+User = get_user_model()
+
+class Command(BaseCommand):
+    help = 'Import posts, comments and likes from an NDJSON stream written by export_posts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='NDJSON file (.gz is decompressed); "-" for stdin')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Lines validated and inserted per transaction')
+        parser.add_argument('--author', help='Username for rows that name no author')
+        parser.add_argument('--local-post-ids', action='store_true',
+                            help='Take post ids not in the stream as ids of posts in this database')
+
+    def handle(self, *args, **options):
+        author = None
+        if options['author']:
+            author = User.objects.filter(username=options['author']).first()
+            if author is None:
+                raise CommandError(f'Unknown user {options["author"]}')
+
+        importer = BulkImporter(default_author=author, batch_size=options['batch_size'],
+                                local_post_ids=options['local_post_ids'])
+        try:
+            if options['path'] == '-':
+                importer.feed(sys.stdin)
+            else:
+                with open_archive(options['path'], 'r') as stream:
+                    importer.feed(stream)
+        except OSError as exc:
+            raise CommandError(str(exc))
+
+        for error in importer.errors:
+            self.stderr.write(f'Line {error["line"]}: {json.dumps(error["errors"])}')
+        if importer.error_count > len(importer.errors):
+            self.stderr.write(f'... and {importer.error_count - len(importer.errors)} more errors')
+        imported = ', '.join(f'{count} {row_type}s' for row_type, count in importer.imported.items())
+        self.stdout.write(self.style.SUCCESS(f'Successfully imported {imported}'))
@@ -0,0 +1,37 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from social_media_api.sharding import SHARD_KEYS, get_shards, rebalance
+
+class Command(BaseCommand):
+    help = ('Move sharded likes and notifications to the shard their key maps to, after shards were '
+            'added to DATABASE_SHARDS (or to shard the data of an unsharded database). Run '
+            'recount_counters afterwards if the site took likes meanwhile.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='sources', action='append', metavar='ALIAS',
+                            help='Database to move misplaced rows out of; repeatable. Defaults to every '
+                                 'shard. Use "default" to shard rows written before sharding was enabled')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows examined per batch; each batch is copied and deleted in its own transactions')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many rows would move')
+
+    def handle(self, *args, **options):
+        if not get_shards():
+            raise CommandError('DATABASE_SHARDS is empty; there is nothing to rebalance')
+        sources = options['sources'] or get_shards()
+        unknown = [alias for alias in sources if alias not in settings.DATABASES]
+        if unknown:
+            raise CommandError(f'Unknown database: {", ".join(unknown)}')
+        
+        verb = 'would move' if options['dry_run'] else 'moved'
+        total = 0
+        for label in SHARD_KEYS:
+            model = apps.get_model(label)
+            for source in sources:
+                moved = rebalance(model, source, batch_size=options['batch_size'], dry_run=options['dry_run'])
+                self.stdout.write(f'{source}: {verb} {moved} {model._meta.verbose_name_plural}')
+                total += moved
+        
+        self.stdout.write(self.style.SUCCESS(f'Successfully rebalanced shards ({total} rows {verb})'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from posts.timeline import rebuild_timelines
+
+class Command(BaseCommand):
+    help = 'Refill home timelines from the follow graph; run once for follows made before timelines existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+                            help='Only rebuild the timeline of this user id (repeatable)')
+
+    def handle(self, *args, **options):
+        count = rebuild_timelines(options['user_ids'])
+        self.stdout.write(self.style.SUCCESS(f'Successfully rebuilt {count} timelines'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from posts.trending import rebuild
+
+class Command(BaseCommand):
+    help = 'Recompute trending scores from recent likes and comments; run periodically, e.g. hourly'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows inserted per bulk_create')
+
+    def handle(self, *args, **options):
+        count = rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Successfully rebuilt trending scores for {count} posts'))
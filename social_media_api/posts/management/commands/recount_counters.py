@@ -0,0 +1,76 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Q
+from posts.models import Post, Comment, Like, count_of, like_counts, store_likes_counts
+from social_media_api.sharding import is_sharded
+
+User = get_user_model()
+Follow = User.followers.through
+
+class Command(BaseCommand):
+    help = 'Recompute stored like, comment and follow counters in chunked batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of rows recounted per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        
+        counters = {'comments_count': count_of(Comment.objects.all(), 'post')}
+        if not is_sharded(Like):
+            counters['likes_count'] = count_of(Like.objects.all(), 'post')
+        fixed = self.recount(Post, batch_size, counters)
+        self.stdout.write(f'Repaired {fixed} posts')
+        if is_sharded(Like):
+            fixed = self.recount_sharded_likes(batch_size)
+            self.stdout.write(f'Repaired likes_count of {fixed} posts')
+        
+        # "a follows b" is stored as (from_customuser=a, to_customuser=b)
+        fixed = self.recount(User, batch_size, {
+            'followers_count': count_of(Follow.objects.all(), 'to_customuser'),
+            'following_count': count_of(Follow.objects.all(), 'from_customuser'),
+        })
+        self.stdout.write(f'Repaired {fixed} users')
+        
+        self.stdout.write(self.style.SUCCESS('Successfully recounted counters'))
+
+    def recount(self, model, batch_size, counters):
+        """Walk the table in primary key ranges, updating only rows that drifted"""
+        fixed = 0
+        last_pk = 0
+        while True:
+            pks = list(model.objects.filter(pk__gt=last_pk).order_by('pk')
+                       .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return fixed
+            last_pk = pks[-1]
+            
+            actual = {f'actual_{field}': expression for field, expression in counters.items()}
+            drifted = Q()
+            for field in counters:
+                drifted |= ~Q(**{field: F(f'actual_{field}')})
+            
+            with transaction.atomic():
+                stale_pks = list(model.objects.filter(pk__gte=pks[0], pk__lte=last_pk)
+                                 .annotate(**actual).filter(drifted)
+                                 .values_list('pk', flat=True))
+                if stale_pks:
+                    model.objects.filter(pk__in=stale_pks).update(**counters)
+            fixed += len(stale_pks)
+
+    def recount_sharded_likes(self, batch_size):
+        """Likes on other databases can't be counted in a subquery; gather the counts per batch instead"""
+        fixed = 0
+        last_pk = 0
+        while True:
+            stored = dict(Post.objects.filter(pk__gt=last_pk).order_by('pk')
+                          .values_list('pk', 'likes_count')[:batch_size])
+            if not stored:
+                return fixed
+            last_pk = max(stored)
+            
+            drifted = {pk: total for pk, total in like_counts(list(stored)).items() if stored[pk] != total}
+            store_likes_counts(drifted)
+            fixed += len(drifted)
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from social_media_api.benchmark import (
+    DEFAULT_PREFIX, SCENARIOS, ClientTransport, HTTPTransport, dump_report, run
+)
+
+class Command(BaseCommand):
+    help = 'Run benchmark scenarios against generate_benchmark_data users and report latency and queries as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f'Comma-separated subset of: {", ".join(SCENARIOS)}')
+        parser.add_argument('--requests', type=int, default=200, help='Measured requests per scenario')
+        parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests per scenario')
+        parser.add_argument('--concurrency', type=int, default=1, help='Worker threads per scenario')
+        parser.add_argument('--url', help='Base URL of a running server; without it the test client is used')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default=DEFAULT_PREFIX, help='Username prefix of benchmark users')
+        parser.add_argument('--output', '-o', help='Write the JSON report here instead of stdout')
+
+    def handle(self, *args, **options):
+        scenarios = [name.strip() for name in options['scenarios'].split(',') if name.strip()]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+        
+        transport = HTTPTransport(options['url']) if options['url'] else ClientTransport()
+        try:
+            report = run(transport, scenarios, requests=options['requests'], concurrency=options['concurrency'],
+                         warmup=options['warmup'], seed=options['seed'], prefix=options['prefix'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(dump_report(report))
+            self.stdout.write(self.style.SUCCESS(f'Successfully wrote benchmark report to {options["output"]}'))
+        else:
+            self.stdout.write(dump_report(report), ending='')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from posts.search import SEARCH_FIELDS, get_post_search
+
+class Command(BaseCommand):
+    help = ('Create the post and comment full-text indexes (tsvector GIN on PostgreSQL, '
+            'FTS5 tables on SQLite) and index existing rows')
+
+    def handle(self, *args, **options):
+        for model in SEARCH_FIELDS:
+            backend = get_post_search(model, require_installed=False)
+            backend.install(model)
+            self.stdout.write(f'Indexed {model._meta.db_table} with {backend.__class__.__name__}')
+        self.stdout.write(self.style.SUCCESS(f'Successfully set up post search on {connection.vendor}'))
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from posts.timeline import trim_timelines
+
+class Command(BaseCommand):
+    help = 'Trim home timelines that grew past TIMELINE_MAX_LENGTH; run periodically, e.g. hourly'
+
+    def handle(self, *args, **options):
+        count = trim_timelines()
+        self.stdout.write(self.style.SUCCESS(f'Successfully trimmed {count} timelines'))
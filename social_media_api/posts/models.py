@@ -1,28 +1,117 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, Exists, F, OuterRef, Prefetch, Subquery, Value
+from django.db.models.functions import Coalesce
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.postgres.search import SearchVectorField
+from social_media_api.sharding import is_sharded, on_shard, scatter_gather
 
 User = get_user_model()
 
+def count_of(queryset, field):
+    """Correlated COUNT(*) of `queryset` rows whose `field` points at the outer row"""
+    totals = (queryset.filter(**{field: OuterRef('pk')}).order_by()
+              .values(field).annotate(total=Count('pk')).values('total'))
+    return Coalesce(Subquery(totals), 0)
+
+class PostQuerySet(models.QuerySet):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._liked_by = None
+    
+    def _clone(self):
+        clone = super()._clone()
+        clone._liked_by = self._liked_by
+        return clone
+    
+    def _fetch_all(self):
+        fill_liked = self._result_cache is None and self._liked_by is not None
+        super()._fetch_all()
+        if fill_liked:
+            posts = [post for post in self._result_cache if isinstance(post, Post)]
+            liked = liked_post_ids(self._liked_by, [post.pk for post in posts])
+            for post in posts:
+                post.is_liked = post.pk in liked
+    
+    def with_engagement(self, user=None):
+        """
+        Annotate is_liked (for `user`) as an EXISTS subquery in the main
+        SELECT. Like and comment totals are stored on the post itself.
+        With sharded likes is_liked is set after the fetch instead, with one
+        query per shard holding the fetched posts.
+        """
+        if user is not None and user.is_authenticated:
+            if is_sharded(Like):
+                clone = self._chain()
+                clone._liked_by = user
+                return clone
+            is_liked = Exists(Like.objects.filter(post=OuterRef('pk'), user=user))
+        else:
+            is_liked = Value(False, output_field=models.BooleanField())
+        
+        return self.annotate(is_liked=is_liked)
+    
+    def with_comments(self, limit=None):
+        """
+        Prefetch comments with their authors. With `limit`, only the latest
+        `limit` comments of each post are fetched, newest first, in one
+        ROW_NUMBER() window query, into Post.latest_comments.
+        """
+        comments = Comment.objects.select_related('author')
+        if limit is None:
+            return self.prefetch_related(Prefetch('comments', queryset=comments))
+        comments = comments.order_by('-created_at', '-id')[:limit]
+        return self.prefetch_related(Prefetch('comments', queryset=comments, to_attr='latest_comments'))
+
 class Post(models.Model):
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='posts')
     title = models.CharField(max_length=255)
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Denormalized counters, incremented by PostViewSet and decremented by
+    # the post_delete signals in posts.signals; `recount_counters` repairs drift
+    likes_count = models.PositiveIntegerField(default=0)
+    comments_count = models.PositiveIntegerField(default=0)
+    # Weighted title/content tsvector on PostgreSQL, see posts.search; unused elsewhere
+    search_vector = SearchVectorField(null=True, editable=False)
+    
+    objects = PostQuerySet.as_manager()
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Keyset pagination on (created_at, id), globally and per author
+            models.Index(fields=['-created_at', '-id'], name='post_recent_idx'),
+            models.Index(fields=['author', '-created_at', '-id'], name='post_author_recent_idx'),
+        ]
     
     def __str__(self):
         return f"{self.title} by {self.author.username}"
     
+    @property
+    def embedded_comments(self):
+        """The comments to embed in API responses: the latest few if with_comments(limit) ran, else all"""
+        if hasattr(self, 'latest_comments'):
+            return self.latest_comments
+        return self.comments.all()
+    
     def get_likes_count(self):
-        return self.likes.count()
+        return self.likes_count
+    
+    def adjust_counter(self, field, delta):
+        """Atomically add delta to one of the stored counters, never going below zero"""
+        posts = Post.objects.filter(pk=self.pk)
+        if delta < 0:
+            posts = posts.filter(**{f'{field}__gte': -delta})
+        posts.update(**{field: F(field) + delta})
+        
+        from .response_cache import invalidate_posts
+        transaction.on_commit(lambda: invalidate_posts([self.pk]))
     
     def is_liked_by(self, user):
-        return self.likes.filter(user=user).exists()
+        return on_shard(Like, self.pk).filter(post=self, user=user).exists()
 
 class Comment(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='comments')
@@ -30,16 +119,23 @@ class Comment(models.Model):
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    search_vector = SearchVectorField(null=True, editable=False)
     
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='comment_created_idx'),
+            models.Index(fields=['post', 'created_at', 'id'], name='comment_post_created_idx'),
+        ]
     
     def __str__(self):
         return f"Comment by {self.author.username} on {self.post.title}"
 
 class Like(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='likes')
-    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='likes')
+    # No database constraints: with DATABASE_SHARDS likes live on another
+    # database than users and posts (see social_media_api.sharding)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='likes', db_constraint=False)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='likes', db_constraint=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
@@ -48,3 +144,75 @@ class Like(models.Model):
     
     def __str__(self):
         return f"{self.user.username} likes {self.post.title}"
+
+def liked_post_ids(user, post_ids):
+    """The ids among `post_ids` of posts `user` likes, with one query per shard holding them"""
+    def query(likes, ids):
+        return list(likes.filter(user=user, post_id__in=ids).values_list('post_id', flat=True))
+    return {post_id for found in scatter_gather(Like, query, keys=post_ids) for post_id in found}
+
+def like_counts(post_ids):
+    """{post_id: number of likes} for `post_ids`, with one query per shard holding them"""
+    def query(likes, ids):
+        return list(likes.filter(post_id__in=ids).order_by().values('post_id')
+                    .annotate(total=Count('pk')).values_list('post_id', 'total'))
+    counts = dict.fromkeys(post_ids, 0)
+    for found in scatter_gather(Like, query, keys=post_ids):
+        counts.update(found)
+    return counts
+
+def store_likes_counts(counts):
+    """Write {post_id: likes_count}, one UPDATE per distinct count"""
+    by_count = {}
+    for post_id, total in counts.items():
+        by_count.setdefault(total, []).append(post_id)
+    for total, post_ids in by_count.items():
+        Post.objects.filter(pk__in=post_ids).update(likes_count=total)
+
+def recount_posts(post_ids):
+    """Recompute the stored likes_count and comments_count of `post_ids` from their rows"""
+    post_ids = list(post_ids)
+    counters = {'comments_count': count_of(Comment.objects.all(), 'post')}
+    if is_sharded(Like):
+        store_likes_counts(like_counts(post_ids))
+    else:
+        counters['likes_count'] = count_of(Like.objects.all(), 'post')
+    Post.objects.filter(pk__in=post_ids).update(**counters)
+
+class TimelineEntry(models.Model):
+    """
+    A post materialized into a follower's home timeline (fan-out-on-write).
+    created_at mirrors the post's so timelines are read pre-sorted from one index.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='timeline_entries')
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='timeline_entries')
+    created_at = models.DateTimeField()
+    
+    class Meta:
+        unique_together = ['user', 'post']
+        ordering = ['-created_at', '-post_id']
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-post'], name='timeline_user_recent_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Post {self.post_id} in timeline of user {self.user_id}"
+
+class TrendingScore(models.Model):
+    """
+    A post's time-decayed like/comment activity, maintained by posts.trending.
+    score is stored in log2 space against a fixed epoch, so events only ever
+    raise it and /api/posts/trending/ reads the top rows from one index.
+    """
+    post = models.OneToOneField(Post, on_delete=models.CASCADE, primary_key=True, related_name='trending')
+    score = models.FloatField()
+    last_activity_at = models.DateTimeField()
+    
+    class Meta:
+        ordering = ['-score', '-post_id']
+        indexes = [
+            models.Index(fields=['-score', '-post'], name='trending_score_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Post {self.post_id} trending score {self.score:.3f}"
@@ -0,0 +1,184 @@
+"""
+Shared response cache for PostViewSet list and retrieve.
+
+Bodies are built as if for an anonymous user and cached under the request
+URL (query params sorted), so every reader shares one entry; authenticated
+requests only overlay their own `is_liked` flags with one query (one per
+shard holding the posts when likes are sharded).
+
+Entries are tagged with `posts` (the set of posts changed) and `post:<id>`
+for each post they contain. Writes retire tags by giving them a new version
+token, the same scheme as accounts.follow_graph, and an entry whose tag
+versions no longer match is rebuilt. Past RESPONSE_CACHE_TTL an entry is
+still served for RESPONSE_CACHE_STALE_TTL seconds while one background
+thread rebuilds it (stale-while-revalidate).
+
+The cache used is CACHES['responses'], so it can be pointed at a shared
+file or Redis cache when running several processes.
+"""
+import copy
+import hashlib
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.db import close_old_connections
+from rest_framework.response import Response
+
+from social_media_api.replicas import use_primary
+
+from .models import liked_post_ids
+
+logger = logging.getLogger(__name__)
+
+LIST_TAG = 'posts'
+
+_revalidator = ThreadPoolExecutor(max_workers=2, thread_name_prefix='response-cache')
+
+
+def get_cache():
+    return caches['responses' if 'responses' in settings.CACHES else 'default']
+
+
+def post_tag(post_id):
+    return f'post:{post_id}'
+
+
+def _tag_key(tag):
+    return f'response-tag:{tag}'
+
+
+def _tag_versions(tags):
+    """Return {tag: version} for `tags`, creating versions for tags not seen yet"""
+    cache = get_cache()
+    stored = cache.get_many([_tag_key(tag) for tag in tags])
+    versions = {}
+    for tag in tags:
+        version = stored.get(_tag_key(tag))
+        if version is None:
+            version = uuid.uuid4().hex
+            if not cache.add(_tag_key(tag), version, None):
+                version = cache.get(_tag_key(tag), version)
+        versions[tag] = version
+    return versions
+
+
+def invalidate_tags(tags):
+    """Retire every cached response tagged with any of `tags`"""
+    get_cache().set_many({_tag_key(tag): uuid.uuid4().hex for tag in set(tags)}, None)
+
+
+def invalidate_posts(post_ids, listing=False):
+    """Retire responses containing these posts; `listing` also retires every list page"""
+    tags = [post_tag(post_id) for post_id in post_ids]
+    if listing:
+        tags.append(LIST_TAG)
+    invalidate_tags(tags)
+
+
+def response_cache_key(request):
+    params = urlencode(sorted(request.query_params.lists()), doseq=True)
+    url = f'{request.get_host()}{request.path}?{params}'
+    return f'response:{hashlib.md5(url.encode()).hexdigest()}'
+
+
+def _posts_in(data, listing):
+    return data['results'] if listing else [data]
+
+
+class CachedResponseMixin:
+    """Serve list/retrieve from the shared response cache; mix into a ModelViewSet of posts"""
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(lambda view: super(CachedResponseMixin, view).list(view.request, *args, **kwargs),
+                                    listing=True)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(lambda view: super(CachedResponseMixin, view).retrieve(view.request, *args, **kwargs),
+                                    listing=False)
+
+    def shared_view(self):
+        """A copy of this view acting as an anonymous user, for building shared bodies"""
+        request = copy.copy(self.request)
+        request._request = copy.copy(self.request._request)
+        request.user = AnonymousUser()
+        view = copy.copy(self)
+        view.request = request
+        # Paginators keep per-request state; let the copy build its own
+        view.__dict__.pop('_paginator', None)
+        return view
+
+    def build_entry(self, build, listing):
+        view = self.shared_view()
+        # Read tag versions before building, so a write racing the build retires this entry
+        versions = _tag_versions([LIST_TAG] if listing else [])
+        # From the primary: a lagging replica could cache data older than the versions just read
+        with use_primary():
+            response = build(view)
+        if response.status_code != 200:
+            return None, response
+        data = response.data
+        # A write to one of these posts between the build and here is only caught by the TTL
+        versions.update(_tag_versions([post_tag(post['id']) for post in _posts_in(data, listing)]))
+        entry = {
+            'data': data,
+            'tags': versions,
+            'fresh_until': time.time() + getattr(settings, 'RESPONSE_CACHE_TTL', 30),
+        }
+        timeout = getattr(settings, 'RESPONSE_CACHE_TTL', 30) + getattr(settings, 'RESPONSE_CACHE_STALE_TTL', 300)
+        get_cache().set(response_cache_key(view.request), entry, timeout)
+        return entry, response
+
+    def revalidate(self, build, listing):
+        lock_key = f'{response_cache_key(self.request)}:revalidating'
+        if not get_cache().add(lock_key, 1, 60):
+            return
+
+        def run():
+            try:
+                self.build_entry(build, listing)
+            except Exception:
+                logger.exception('Failed to revalidate %s', self.request.path)
+            finally:
+                get_cache().delete(lock_key)
+                close_old_connections()
+
+        _revalidator.submit(run)
+
+    def cached_response(self, build, listing):
+        entry = get_cache().get(response_cache_key(self.request))
+        state = 'HIT'
+        if entry is None or _tag_versions(list(entry['tags'])) != entry['tags']:
+            state = 'MISS'
+            entry, response = self.build_entry(build, listing)
+            if entry is None:
+                return response
+        elif time.time() >= entry['fresh_until']:
+            state = 'STALE'
+            self.revalidate(build, listing)
+
+        response = Response(self.overlay_is_liked(entry['data'], listing))
+        response['X-Cache'] = state
+        return response
+
+    def overlay_is_liked(self, data, listing):
+        """Return `data` with is_liked set for the requesting user"""
+        user = self.request.user
+        if not user.is_authenticated:
+            return data
+
+        posts = _posts_in(data, listing)
+        if not posts or 'is_liked' not in posts[0]:
+            # Left out by ?fields=
+            return data
+        liked = liked_post_ids(user, [post['id'] for post in posts])
+        if not liked:
+            return data
+        # Copy only what changes; the cached body is shared
+        overlaid = [dict(post, is_liked=post['id'] in liked) for post in posts]
+        return dict(data, results=overlaid) if listing else overlaid[0]
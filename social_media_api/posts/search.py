@@ -0,0 +1,232 @@
+"""
+Full-text search for posts and comments.
+
+FullTextSearchFilter replaces DRF's SearchFilter (LIKE '%q%' on every
+search field) with an index-backed backend chosen from the database
+vendor, or POST_SEARCH_BACKEND:
+
+* PostgreSQL: a stored `search_vector` tsvector column with a GIN index,
+  refreshed on save.
+* SQLite: an FTS5 shadow table per model, kept in sync by triggers.
+* Anything else, or before `manage.py setup_post_search` has been run:
+  icontains, like SearchFilter.
+
+Matches are annotated with `search_rank` (higher is better) and
+`search_snippet` (the best fragment) and ordered by rank unless the client
+asked for an explicit ?ordering=. The database marks matched terms with
+control characters; render_snippet() HTML-escapes the fragment and only then
+turns those marks into <mark> tags, so post content can't inject markup.
+"""
+import html
+import re
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import F, FloatField, Q, TextField, Value
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+from rest_framework.filters import BaseFilterBackend
+from rest_framework.settings import api_settings
+
+from .models import Comment, Post
+
+# Searchable text per model; the first field weighs most and the last one is used for snippets
+SEARCH_FIELDS = {
+    Post: ('title', 'content'),
+    Comment: ('content',),
+}
+
+# Marks around matched terms in raw snippets, replaced by render_snippet()
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_STOP = '\x03'
+HIGHLIGHTED = re.compile(f'{HIGHLIGHT_START}([^{HIGHLIGHT_START}{HIGHLIGHT_STOP}]*){HIGHLIGHT_STOP}')
+
+
+def render_snippet(snippet):
+    """HTML for a raw snippet: escaped text with matched terms in <mark>, or None"""
+    if snippet is None:
+        return None
+    snippet = HIGHLIGHTED.sub(r'<mark>\1</mark>', html.escape(snippet))
+    # Stray marks can only come from the content itself
+    return snippet.replace(HIGHLIGHT_START, '').replace(HIGHLIGHT_STOP, '')
+
+
+class IContainsSearch:
+    """Portable fallback matching DRF's SearchFilter; unranked, no snippets"""
+
+    def is_installed(self, model):
+        return True
+
+    def install(self, model):
+        pass
+
+    def update(self, instance):
+        pass
+
+    def update_many(self, model, pks):
+        pass
+
+    def search(self, queryset, term):
+        condition = Q()
+        for field in SEARCH_FIELDS[queryset.model]:
+            condition |= Q(**{f'{field}__icontains': term})
+        return queryset.filter(condition).annotate(
+            search_rank=Value(0.0, output_field=FloatField()),
+            search_snippet=Value(None, output_field=TextField()),
+        )
+
+
+class PostgresSearch(IContainsSearch):
+    weights = ('A', 'B', 'C', 'D')
+
+    def index_name(self, model):
+        return f'{model._meta.db_table}_search_vector_gin'
+
+    def vector(self, model):
+        fields = SEARCH_FIELDS[model]
+        vector = SearchVector(fields[0], weight=self.weights[0])
+        for field, weight in zip(fields[1:], self.weights[1:]):
+            vector += SearchVector(field, weight=weight)
+        return vector
+
+    def is_installed(self, model):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s", [self.index_name(model)])
+            return cursor.fetchone() is not None
+
+    def install(self, model):
+        table = connection.ops.quote_name(model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {self.index_name(model)} '
+                           f'ON {table} USING gin (search_vector)')
+        model.objects.filter(search_vector__isnull=True).update(search_vector=self.vector(model))
+
+    def update(self, instance):
+        self.update_many(instance.__class__, [instance.pk])
+
+    def update_many(self, model, pks):
+        model.objects.filter(pk__in=pks).update(search_vector=self.vector(model))
+
+    def search(self, queryset, term):
+        query = SearchQuery(term, search_type='websearch')
+        snippet_field = SEARCH_FIELDS[queryset.model][-1]
+        return queryset.filter(search_vector=query).annotate(
+            search_rank=SearchRank(F('search_vector'), query),
+            search_snippet=SearchHeadline(
+                snippet_field, query, start_sel=HIGHLIGHT_START, stop_sel=HIGHLIGHT_STOP,
+                max_words=24, min_words=8,
+            ),
+        )
+
+
+class SQLiteSearch(IContainsSearch):
+    def fts_table(self, model):
+        return f'{model._meta.db_table}_fts'
+
+    def is_installed(self, model):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+                           [self.fts_table(model)])
+            return cursor.fetchone() is not None
+
+    def install(self, model):
+        table = model._meta.db_table
+        fts = self.fts_table(model)
+        columns = ', '.join(SEARCH_FIELDS[model])
+        new_values = ', '.join(f'new.{field}' for field in SEARCH_FIELDS[model])
+        old_values = ', '.join(f'old.{field}' for field in SEARCH_FIELDS[model])
+        statements = [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+            f"{columns}, content='{table}', content_rowid='id')",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new_values}); END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old_values}); END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {columns} ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old_values}); "
+            f"INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new_values}); END",
+            f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+        ]
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+    def fts_query(self, term):
+        # Quote every word so user input can't inject FTS syntax
+        words = re.findall(r'[^\W_]+', term)
+        return ' '.join(f'"{word}"' for word in words)
+
+    def search(self, queryset, term):
+        query = self.fts_query(term)
+        if not query:
+            return queryset.none()
+
+        model = queryset.model
+        table = model._meta.db_table
+        fts = self.fts_table(model)
+        fields = SEARCH_FIELDS[model]
+        # Earlier fields weigh more, e.g. bm25(posts_post_fts, 2.0, 1.0) for title, content
+        weights = ', '.join(str(float(len(fields) - index)) for index in range(len(fields)))
+        match = f'FROM {fts} WHERE {fts} MATCH %s AND rowid = "{table}"."id"'
+        return (queryset
+                .filter(pk__in=RawSQL(f'SELECT rowid FROM {fts} WHERE {fts} MATCH %s', [query]))
+                .annotate(
+                    # bm25 is lower-is-better; negate it so rank sorts like PostgreSQL's
+                    search_rank=RawSQL(f'SELECT -bm25({fts}, {weights}) {match}', [query],
+                                       output_field=FloatField()),
+                    search_snippet=RawSQL(
+                        f"SELECT snippet({fts}, {len(fields) - 1}, %s, %s, '…', 24) {match}",
+                        [HIGHLIGHT_START, HIGHLIGHT_STOP, query], output_field=TextField(),
+                    ),
+                ))
+
+
+BACKENDS = {
+    'postgresql': PostgresSearch,
+    'sqlite': SQLiteSearch,
+}
+
+_installed = set()
+
+
+def get_post_search(model=None, require_installed=True):
+    """Return the search backend for the current database (and `model`, if given)"""
+    path = getattr(settings, 'POST_SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)()
+
+    backend = BACKENDS.get(connection.vendor, IContainsSearch)()
+    if model is None or not require_installed or (connection.vendor, model) in _installed:
+        return backend
+    # Until setup_post_search has created the index, fall back to icontains
+    if backend.is_installed(model):
+        _installed.add((connection.vendor, model))
+        return backend
+    return IContainsSearch()
+
+
+class FullTextSearchFilter(BaseFilterBackend):
+    """
+    Drop-in replacement for SearchFilter using the ?search= parameter.
+    List it after OrderingFilter so relevance order wins over the view's default.
+    """
+    search_param = 'search'
+
+    def filter_queryset(self, request, queryset, view):
+        term = request.query_params.get(self.search_param, '').strip()
+        if not term or queryset.model not in SEARCH_FIELDS:
+            return queryset
+        queryset = get_post_search(queryset.model).search(queryset, term)
+        if api_settings.ORDERING_PARAM in request.query_params:
+            return queryset
+        return queryset.order_by('-search_rank', '-pk')
+
+    def get_schema_operation_parameters(self, view):
+        return [{
+            'name': self.search_param,
+            'required': False,
+            'in': 'query',
+            'description': 'Full-text search, ranked by relevance',
+            'schema': {'type': 'string'},
+        }]
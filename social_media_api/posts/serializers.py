@@ -1,21 +1,34 @@
 from rest_framework import serializers
 from .models import Post, Comment, Like
+from .search import render_snippet
 from django.contrib.auth import get_user_model
+from social_media_api.sparse_fields import SparseFieldsMixin
 
 User = get_user_model()
 
-class UserSerializer(serializers.ModelSerializer):
+class SearchResultMixin:
+    """Include search_rank and search_snippet when the row came from posts.search"""
+    
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if hasattr(instance, 'search_rank'):
+            data['search_rank'] = instance.search_rank
+            data['search_snippet'] = render_snippet(instance.search_snippet)
+        return data
+
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'username', 'email')
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(SearchResultMixin, SparseFieldsMixin, serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
     
     class Meta:
         model = Comment
         fields = ('id', 'post', 'author', 'content', 'created_at', 'updated_at')
         read_only_fields = ('id', 'author', 'created_at', 'updated_at')
+        expandable_fields = ('author',)
 
 class LikeSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
@@ -25,28 +38,36 @@ class LikeSerializer(serializers.ModelSerializer):
         fields = ('id', 'user', 'post', 'created_at')
         read_only_fields = ('id', 'user', 'created_at')
 
-class PostSerializer(serializers.ModelSerializer):
+class BatchLikeSerializer(serializers.Serializer):
+    like = serializers.ListField(child=serializers.IntegerField(min_value=1), max_length=100, required=False, default=list)
+    unlike = serializers.ListField(child=serializers.IntegerField(min_value=1), max_length=100, required=False, default=list)
+    
+    def validate(self, data):
+        if set(data['like']) & set(data['unlike']):
+            raise serializers.ValidationError('A post cannot be both liked and unliked')
+        return data
+
+class PostSerializer(SearchResultMixin, SparseFieldsMixin, serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
-    comments = CommentSerializer(many=True, read_only=True)
-    comments_count = serializers.SerializerMethodField()
-    likes_count = serializers.SerializerMethodField()
+    comments = CommentSerializer(source='embedded_comments', many=True, read_only=True)
     is_liked = serializers.SerializerMethodField()
     
     class Meta:
         model = Post
         fields = ('id', 'author', 'title', 'content', 'created_at', 'updated_at', 
                  'comments', 'comments_count', 'likes_count', 'is_liked')
-        read_only_fields = ('id', 'author', 'created_at', 'updated_at', 'comments')
-    
-    def get_comments_count(self, obj):
-        return obj.comments.count()
-    
-    def get_likes_count(self, obj):
-        return obj.get_likes_count()
+        read_only_fields = ('id', 'author', 'created_at', 'updated_at', 'comments',
+                            'comments_count', 'likes_count')
+        expandable_fields = ('author', 'comments')
+        # Columns behind computed fields, for sparse_queryset(); None needs none
+        field_sources = {'comments': 'comments', 'is_liked': None}
     
     def get_is_liked(self, obj):
         request = self.context.get('request')
         if request and request.user.is_authenticated:
+            # Prefer the value annotated by Post.objects.with_engagement()
+            if hasattr(obj, 'is_liked'):
+                return obj.is_liked
             return obj.is_liked_by(request.user)
         return False
 
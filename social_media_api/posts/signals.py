@@ -0,0 +1,64 @@
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from social_media_api.sharding import delete_shard_rows, scatter_gather
+from .models import Comment, Like, Post, recount_posts
+from .response_cache import invalidate_posts
+from .trending import record_activity
+
+# Likes and comments have no delete receivers, so cascades from a deleted
+# post or user remove them in bulk instead of one by one. unlike_posts() and
+# CommentViewSet.perform_destroy adjust the counters they change; a deleted
+# user's likes and comments on other posts are recounted once per post below.
+# Anything else (the admin, the shell) leaves them to `recount_counters`.
+
+@receiver(pre_delete, sender=get_user_model())
+def remember_engaged_posts(sender, instance, **kwargs):
+    def liked(likes):
+        return list(likes.filter(user=instance).values_list('post_id', flat=True))
+    post_ids = set(Comment.objects.filter(author=instance).values_list('post_id', flat=True))
+    for found in scatter_gather(Like, liked):
+        post_ids.update(found)
+    instance._engaged_post_ids = post_ids
+
+@receiver(post_delete, sender=Post)
+@receiver(post_delete, sender=get_user_model())
+def cascade_to_shards(sender, instance, **kwargs):
+    # Sharded likes and notifications aren't on the database the cascade ran on
+    delete_shard_rows(instance)
+
+@receiver(post_delete, sender=get_user_model())
+def recount_engaged_posts(sender, instance, **kwargs):
+    # After cascade_to_shards, so sharded likes are gone too
+    post_ids = getattr(instance, '_engaged_post_ids', None)
+    if post_ids:
+        recount_posts(post_ids)
+        transaction.on_commit(lambda: invalidate_posts(post_ids))
+
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=Comment)
+def update_search_vector(sender, instance, update_fields=None, **kwargs):
+    # SQLite's FTS5 table is maintained by triggers; only PostgreSQL stores a vector
+    if connection.vendor != 'postgresql':
+        return
+    if update_fields and not {'title', 'content'} & set(update_fields):
+        return
+    from .search import get_post_search
+    get_post_search(sender, require_installed=False).update(instance)
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def invalidate_post_responses(sender, instance, **kwargs):
+    # Creates, deletes and edits (which may reorder ?ordering=updated_at) change list pages
+    transaction.on_commit(lambda: invalidate_posts([instance.pk], listing=True))
+
+@receiver(post_save, sender=Comment)
+def invalidate_comment_responses(sender, instance, **kwargs):
+    # Deletes are covered by the comments_count decrement in CommentViewSet.perform_destroy
+    transaction.on_commit(lambda: invalidate_posts([instance.post_id]))
+
+@receiver(post_save, sender=Comment)
+def record_comment_activity(sender, instance, created, **kwargs):
+    if created:
+        record_activity([instance.post_id], 'comment', instance.created_at)
@@ -0,0 +1,934 @@
+import json
+import math
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from social_media_api import benchmark
+from social_media_api.instrumentation import QueryBudgetTestMixin
+from . import search
+from .bulk import BulkImporter, export_lines
+from .likes import like_posts
+from .models import Comment, Like, Post, TrendingScore
+from .response_cache import get_cache
+from .serializers import CommentSerializer, PostSerializer
+from .timeline import backfill_timeline, fan_out_post
+from .trending import event_score, log_add, rebuild as rebuild_trending, record_activity, trending_page
+from accounts.authentication import token_cache
+from accounts.follow_graph import get_cache as get_follow_graph_cache
+from notifications.models import Notification
+from social_media_api.replicas import PIN_COOKIE, ReplicaRoutingMiddleware
+from social_media_api.sharding import ShardKeyRequired, on_shard, shard_for
+from social_media_api.pagination import decode_score_cursor
+from social_media_api.sparse_fields import sparse_queryset
+from social_media_api.throttling import CacheBucketStore, LocalBucketStore, local_store, take_token
+
+User = get_user_model()
+
+@override_settings(SECURE_SSL_REDIRECT=False, NOTIFICATION_DELIVERY='sync')
+class LikeConcurrencyTest(TransactionTestCase):
+    threads = 16
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('Threads cannot write to an in-memory SQLite test database')
+        self.author = User.objects.create_user(username='author', password='12345')
+        self.post = Post.objects.create(title='Test Post', content='Test content', author=self.author)
+
+    def hammer(self, path, users):
+        """POST `path` from one thread per user, all released at once; return the status codes"""
+        tokens = [Token.objects.get_or_create(user=user)[0].key for user in users]
+        barrier = threading.Barrier(len(tokens))
+        statuses = []
+        errors = []
+
+        def worker(key):
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Token {key}')
+            try:
+                barrier.wait()
+                statuses.append(client.post(path).status_code)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker, args=(key,)) for key in tokens]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+        return statuses
+
+    def test_double_taps_create_one_like(self):
+        fan = User.objects.create_user(username='fan', password='12345')
+        statuses = self.hammer(f'/api/posts/{self.post.id}/like/', [fan] * self.threads)
+
+        self.assertEqual(sorted(statuses), [200] * (self.threads - 1) + [201])
+        self.assertEqual(Like.objects.filter(post=self.post).count(), 1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.likes_count, 1)
+
+    def test_many_users_like_and_unlike(self):
+        fans = [User.objects.create_user(username=f'fan{i}', password='12345') for i in range(self.threads)]
+        self.hammer(f'/api/posts/{self.post.id}/like/', fans)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.likes_count, self.threads)
+
+        self.hammer(f'/api/posts/{self.post.id}/unlike/', fans + fans)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.likes_count, 0)
+        self.assertFalse(Like.objects.filter(post=self.post).exists())
+
+@override_settings(SECURE_SSL_REDIRECT=False, NOTIFICATION_DELIVERY='sync')
+class BenchmarkTest(TransactionTestCase):
+    def test_post_like_leaves_the_dataset_unchanged(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('Threads cannot write to an in-memory SQLite test database')
+        self.addCleanup(get_cache().clear)
+        benchmark.generate(users=20, posts_per_user=3, likes_per_post=2)
+        
+        def snapshot():
+            return (sorted(Like.objects.values_list('user_id', 'post_id')),
+                    sorted(Post.objects.values_list('pk', 'likes_count')), Notification.objects.count())
+        before = snapshot()
+        report = benchmark.run(benchmark.ClientTransport(), ['post_like'], requests=30, concurrency=2, warmup=5)
+        self.assertEqual(report['scenarios']['post_like']['errors'], 0)
+        self.assertEqual(snapshot(), before)
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class BatchLikeTest(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.posts = [Post.objects.create(title=f'Post {i}', content='Test content', author=self.user)
+                      for i in range(3)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_batch_like_and_unlike(self):
+        ids = [post.id for post in self.posts]
+        response = self.client.post('/api/posts/batch-like/', {'like': ids + [9999]}, format='json')
+        self.assertEqual(response.data, {'liked': ids, 'unliked': []})
+
+        response = self.client.post('/api/posts/batch-like/', {'like': ids[:1], 'unlike': ids[1:]}, format='json')
+        self.assertEqual(response.data, {'liked': [], 'unliked': ids[1:]})
+        self.assertEqual([Post.objects.get(pk=pk).likes_count for pk in ids], [1, 0, 0])
+
+    def test_rejects_overlap(self):
+        response = self.client.post('/api/posts/batch-like/', {'like': [1], 'unlike': [1]}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+@override_settings(SECURE_SSL_REDIRECT=False, NOTIFICATION_DELIVERY='sync')
+class QueryBudgetTest(QueryBudgetTestMixin, TestCase):
+    """Full pages of posts with comments and likes stay within each view's query_budget, caches cold"""
+    
+    def setUp(self):
+        get_cache().clear()
+        # Follow graphs cached here would outlive the rolled-back rows
+        self.addCleanup(get_follow_graph_cache().clear)
+        users = [User.objects.create_user(username=f'user{i}', password='12345') for i in range(4)]
+        self.user = users[0]
+        for author in users:
+            self.user.follow(author)
+            for i in range(5):
+                post = Post.objects.create(title=f'Post {i}', content='Test content', author=author)
+                for commenter in users:
+                    Comment.objects.create(post=post, author=commenter, content='Test comment')
+                like_posts(self.user, [post])
+            backfill_timeline(self.user, author)
+        self.post = post
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.user).key}')
+    
+    def cold_get(self, path):
+        for clear in (cache.clear, get_follow_graph_cache().clear, get_cache().clear, token_cache.clear):
+            clear()
+        return self.client.get(path)
+    
+    def test_post_reads(self):
+        for path in ['/api/posts/', '/api/posts/?page=2', f'/api/posts/{self.post.id}/', '/api/posts/trending/',
+                     f'/api/posts/{self.post.id}/comments/', f'/api/posts/{self.post.id}/likes/',
+                     '/api/comments/', '/api/comments/?page=2', f'/api/comments/{self.post.comments.first().pk}/']:
+            response = self.cold_get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertWithinQueryBudget(response)
+    
+    def test_feed(self):
+        for path in ['/api/feed/', '/api/feed/?cursor=', '/api/feed/?page=2']:
+            response = self.cold_get(path)
+            self.assertEqual(len(response.data['posts']), 10)
+            self.assertWithinQueryBudget(response)
+    
+    def test_server_timing_and_metrics(self):
+        self.assertNotIn('Server-Timing', self.client.get('/api/posts/'))
+        with self.settings(SERVER_TIMING=True):
+            response = self.cold_get('/api/posts/')
+        self.assertIn(f'desc="{response.metrics.queries} queries"', response['Server-Timing'])
+        self.assertIn('serialize;dur=', response['Server-Timing'])
+        
+        # Not even to a local peer, which is what a reverse proxy looks like
+        scraper = APIClient()
+        self.assertEqual(scraper.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
+        with self.settings(METRICS_TOKEN='scrape-secret'):
+            self.assertEqual(scraper.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            metrics = scraper.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertIn('http_requests_total{method="GET",status="200",view="post-list"}', metrics.content.decode())
+
+class CacheBucketStoreTest(TestCase):
+    def test_contended_lock_fails_closed(self):
+        self.addCleanup(cache.clear)
+        store = CacheBucketStore('default')
+        self.assertEqual(store.consume('throttle:test', 5, 1.0), 0)
+        # Another worker holds the bucket's lock
+        cache.add('throttle:test:lock', 1, 1)
+        self.assertGreater(store.consume('throttle:test', 5, 1.0), 0)
+        cache.delete('throttle:test:lock')
+        self.assertEqual(store.consume('throttle:test', 5, 1.0), 0)
+
+# Slow enough that no token is refilled while a test runs
+THROTTLE_SETTINGS = dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES={'login': '10/hour', 'follow': '30/hour'})
+
+@override_settings(SECURE_SSL_REDIRECT=False, NOTIFICATION_DELIVERY='sync', REST_FRAMEWORK=THROTTLE_SETTINGS)
+class TokenBucketThrottleTest(TestCase):
+    def setUp(self):
+        local_store.clear()
+        self.addCleanup(local_store.clear)
+        self.client = APIClient()
+    
+    def login(self, **extra):
+        return self.client.post('/api/accounts/login/', {'username': 'nobody', 'password': 'wrong'}, **extra)
+    
+    def test_refill(self):
+        # 10/min: an empty bucket regains one token every 6 seconds, up to 10
+        self.assertEqual(take_token((0, 100.0), 103.0, 10, 10 / 60), ((0.5, 103.0), 3.0))
+        self.assertEqual(take_token((0, 100.0), 106.0, 10, 10 / 60), ((0, 106.0), 0))
+        self.assertEqual(take_token((0, 100.0), 1000.0, 10, 10 / 60), ((9, 1000.0), 0))
+        
+        store = LocalBucketStore()
+        with mock.patch('social_media_api.throttling.time.monotonic', return_value=100.0):
+            self.assertEqual([store.consume('throttle:test', 2, 1.0) for _ in range(3)], [0, 0, 1.0])
+        with mock.patch('social_media_api.throttling.time.monotonic', return_value=101.0):
+            self.assertEqual(store.consume('throttle:test', 2, 1.0), 0)
+    
+    def test_exhausted_bucket_gives_429_with_retry_after(self):
+        for _ in range(10):
+            self.assertEqual(self.login().status_code, 400)
+        response = self.login()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn(int(response['Retry-After']), range(1, 361))
+        # A forged X-Forwarded-For is not a new client
+        self.assertEqual(self.login(HTTP_X_FORWARDED_FOR='198.51.100.7').status_code, 429)
+        self.assertEqual(self.login(REMOTE_ADDR='198.51.100.7').status_code, 400)
+    
+    def test_scopes_have_separate_buckets(self):
+        for _ in range(10):
+            self.login()
+        self.assertEqual(self.login().status_code, 429)
+        
+        user = User.objects.create_user(username='user', password='12345')
+        author = User.objects.create_user(username='author', password='12345')
+        self.client.force_authenticate(user)
+        self.assertEqual(self.client.post(f'/api/accounts/follow/{author.pk}/').status_code, 200)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.login().status_code, 429)
+    
+    @override_settings(REST_FRAMEWORK=dict(THROTTLE_SETTINGS, TOKEN_BUCKET_STORE='cache'))
+    def test_cache_store_uses_shared_cache(self):
+        self.addCleanup(caches['shared'].clear)
+        for _ in range(10):
+            self.login()
+        self.assertEqual(self.login().status_code, 429)
+        self.assertIsNotNone(caches['shared'].get('throttle:login:ip:127.0.0.1'))
+
+@override_settings(SECURE_SSL_REDIRECT=False, NOTIFICATION_DELIVERY='sync')
+class CommentCountTest(TestCase):
+    def test_comment_is_rolled_back_with_its_count(self):
+        self.addCleanup(get_cache().clear)
+        author = User.objects.create_user(username='author', password='12345')
+        post = Post.objects.create(title='Post', content='Test content', author=author)
+        client = APIClient()
+        client.force_authenticate(author)
+        path = f'/api/posts/{post.pk}/add_comment/'
+        with mock.patch.object(Post, 'adjust_counter', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                client.post(path, {'content': 'Lost'}, format='json')
+        self.assertFalse(post.comments.exists())
+        
+        self.assertEqual(client.post(path, {'content': 'Kept'}, format='json').status_code, 201)
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count, 1)
+
+@override_settings(SECURE_SSL_REDIRECT=False, NOTIFICATION_DELIVERY='sync')
+class CounterTest(TestCase):
+    def setUp(self):
+        self.addCleanup(get_cache().clear)
+        self.author = User.objects.create_user(username='author', password='12345')
+        self.fans = [User.objects.create_user(username=f'fan{i}', password='12345') for i in range(3)]
+        self.post = Post.objects.create(title='Post', content='Test content', author=self.author)
+        self.other = Post.objects.create(title='Other', content='Test content', author=self.fans[0])
+    
+    def counts(self, post=None):
+        post = post or self.post
+        post.refresh_from_db()
+        return post.likes_count, post.comments_count
+    
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+    
+    def test_like_unlike_comment_and_delete(self):
+        for fan in self.fans:
+            client = self.client_for(fan)
+            client.post(f'/api/posts/{self.post.pk}/like/')
+            client.post(f'/api/posts/{self.post.pk}/add_comment/', {'content': 'Nice'}, format='json')
+        self.assertEqual(self.counts(), (3, 3))
+        
+        fan = self.client_for(self.fans[0])
+        fan.post(f'/api/posts/{self.post.pk}/unlike/')
+        fan.post(f'/api/posts/{self.post.pk}/unlike/')
+        comment = self.post.comments.get(author=self.fans[0])
+        self.assertEqual(fan.delete(f'/api/comments/{comment.pk}/').status_code, 204)
+        self.assertEqual(self.counts(), (2, 2))
+        
+        # A deleted user's likes and comments leave every other post's counters
+        like_posts(self.fans[1], [self.other])
+        Comment.objects.create(post=self.other, author=self.fans[1], content='Nice')
+        Post.objects.filter(pk=self.other.pk).update(comments_count=1)
+        self.fans[1].delete()
+        self.assertEqual(self.counts(), (1, 1))
+        self.assertEqual(self.counts(self.other), (0, 0))
+    
+    def test_deleting_a_post_deletes_its_likes_in_bulk(self):
+        for fan in self.fans:
+            like_posts(fan, [self.post])
+            Comment.objects.create(post=self.post, author=fan, content='Nice')
+        with CaptureQueriesContext(connection) as queries:
+            self.post.delete()
+        self.assertFalse(Like.objects.exists())
+        self.assertFalse(Comment.objects.exists())
+        # No per-row counter updates of the post being deleted
+        self.assertFalse([query for query in queries if query['sql'].startswith('UPDATE "posts_post"')])
+    
+    def test_recount_counters_repairs_drift(self):
+        like_posts(self.fans[0], [self.post])
+        Comment.objects.create(post=self.post, author=self.fans[0], content='Nice')
+        Post.objects.filter(pk=self.post.pk).update(likes_count=7, comments_count=0)
+        User.objects.filter(pk=self.author.pk).update(followers_count=5)
+        call_command('recount_counters', stdout=open(os.devnull, 'w'))
+        self.assertEqual(self.counts(), (1, 1))
+        self.assertEqual(self.counts(self.other), (0, 0))
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.followers_count, 0)
+
+class PostSearchMixin:
+    def setUp(self):
+        self.addCleanup(get_cache().clear)
+        self.addCleanup(search._installed.clear)
+        author = User.objects.create_user(username='author', password='12345')
+        self.in_title = Post.objects.create(title='Gardening tips', content='Water daily', author=author)
+        self.in_content = Post.objects.create(title='Weekend', content='Some gardening and rest', author=author)
+        self.unsafe = Post.objects.create(title='Probe', content='hello <script>alert(1)</script> world',
+                                          author=author)
+        self.client = APIClient()
+    
+    def results(self, term):
+        return self.client.get('/api/posts/', {'search': term}).data['results']
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class PostSearchTest(PostSearchMixin, TestCase):
+    def test_icontains_fallback_before_setup(self):
+        search._installed.clear()
+        if connection.vendor == 'sqlite':
+            self.assertNotIsInstance(search.get_post_search(Post), search.SQLiteSearch)
+        # Substrings match, unranked and without snippets
+        results = self.results('arden')
+        self.assertEqual({post['id'] for post in results}, {self.in_title.id, self.in_content.id})
+        self.assertEqual({post['search_snippet'] for post in results}, {None})
+    
+    def test_render_snippet(self):
+        self.assertEqual(search.render_snippet('\x02a&b\x03 <i>\x02'), '<mark>a&amp;b</mark> &lt;i&gt;')
+        self.assertIsNone(search.render_snippet(None))
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class SQLitePostSearchTest(PostSearchMixin, TransactionTestCase):
+    """FTS5 tables can't be created inside a rolled-back test transaction, so they are dropped afterwards"""
+    
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Exercises the FTS5 backend')
+        super().setUp()
+        self.addCleanup(self.drop_fts)
+        call_command('setup_post_search', stdout=open(os.devnull, 'w'))
+    
+    def drop_fts(self):
+        with connection.cursor() as cursor:
+            for model in search.SEARCH_FIELDS:
+                fts = search.SQLiteSearch().fts_table(model)
+                for trigger in ('ai', 'ad', 'au'):
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {fts}_{trigger}')
+                cursor.execute(f'DROP TABLE IF EXISTS {fts}')
+    
+    def test_ranking_and_escaped_snippets(self):
+        self.assertIsInstance(search.get_post_search(Post), search.SQLiteSearch)
+        results = self.results('gardening')
+        # A title match outranks a content match
+        self.assertEqual([post['id'] for post in results], [self.in_title.id, self.in_content.id])
+        self.assertGreater(results[0]['search_rank'], results[1]['search_rank'])
+        self.assertEqual(results[1]['search_snippet'], 'Some <mark>gardening</mark> and rest')
+        
+        [result] = self.results('hello')
+        self.assertEqual(result['search_snippet'],
+                         '<mark>hello</mark> &lt;script&gt;alert(1)&lt;/script&gt; world')
+        # Whole words only: FTS5 doesn't match inside them
+        self.assertEqual(self.results('arden'), [])
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class OrderingPaginationTest(TestCase):
+    def test_ordering_param_is_honoured(self):
+        self.addCleanup(cache.clear)
+        self.addCleanup(get_cache().clear)
+        author = User.objects.create_user(username='author', password='12345')
+        posts = [Post.objects.create(title=f'Post {i}', content='Test content', author=author) for i in range(12)]
+        client = APIClient()
+        response = client.get('/api/posts/?ordering=created_at')
+        self.assertEqual([post['id'] for post in response.data['results']], [post.id for post in posts[:10]])
+        self.assertEqual(response.data['count'], 12)
+        self.assertEqual(client.get(response.data['next']).data['results'][-1]['id'], posts[-1].id)
+        self.assertEqual(client.get('/api/posts/').data['results'][0]['id'], posts[-1].id)
+    
+    def test_cursor_mode_is_opt_in(self):
+        self.addCleanup(cache.clear)
+        self.addCleanup(get_cache().clear)
+        author = User.objects.create_user(username='author', password='12345')
+        posts = [Post.objects.create(title=f'Post {i}', content='Test content', author=author) for i in range(12)]
+        client = APIClient()
+        response = client.get('/api/posts/')
+        self.assertEqual(list(response.data), ['count', 'next', 'previous', 'results'])
+        self.assertEqual(response.data['count'], 12)
+        
+        for url in ('/api/posts/?cursor=', '/api/posts/?pagination=cursor'):
+            response = client.get(url)
+            self.assertEqual(list(response.data), ['next', 'has_next', 'results'])
+            self.assertTrue(response.data['has_next'])
+            response = client.get(response.data['next'])
+            self.assertFalse(response.data['has_next'])
+            self.assertEqual([post['id'] for post in response.data['results']], [posts[1].id, posts[0].id])
+
+@override_settings(SECURE_SSL_REDIRECT=False, NOTIFICATION_DELIVERY='sync')
+class PostResponseCacheTest(TestCase):
+    def setUp(self):
+        get_cache().clear()
+        self.addCleanup(get_cache().clear)
+        self.addCleanup(local_store.clear)
+        self.author = User.objects.create_user(username='author', password='12345')
+        self.fan = User.objects.create_user(username='fan', password='12345')
+        self.other = User.objects.create_user(username='other', password='12345')
+        self.post = Post.objects.create(title='Post', content='Test content', author=self.author)
+        self.detail = f'/api/posts/{self.post.pk}/'
+    
+    def client_for(self, user=None):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+    
+    def test_hits_until_a_write(self):
+        anonymous = self.client_for()
+        for path in ('/api/posts/', self.detail):
+            self.assertEqual(anonymous.get(path)['X-Cache'], 'MISS')
+            with self.assertNumQueries(0):
+                self.assertEqual(anonymous.get(path)['X-Cache'], 'HIT')
+            # The same entry under reordered query params
+            self.assertEqual(anonymous.get(path, {'b': 1, 'a': 2})['X-Cache'], 'MISS')
+            self.assertEqual(anonymous.get(path, {'a': 2, 'b': 1})['X-Cache'], 'HIT')
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client_for(self.author).post('/api/posts/', {'title': 'New', 'content': 'Test content'})
+        self.assertEqual(response.status_code, 201)
+        response = anonymous.get('/api/posts/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['results'][0]['title'], 'New')
+        # A new post doesn't change another post's page
+        self.assertEqual(anonymous.get(self.detail)['X-Cache'], 'HIT')
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client_for(self.fan).post(f'{self.detail}like/')
+        response = anonymous.get(self.detail)
+        self.assertEqual((response['X-Cache'], response.data['likes_count']), ('MISS', 1))
+        self.assertEqual(anonymous.get('/api/posts/')['X-Cache'], 'MISS')
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client_for(self.fan).post(f'{self.detail}add_comment/', {'content': 'Nice'}, format='json')
+        response = anonymous.get(self.detail)
+        self.assertEqual((response['X-Cache'], response.data['comments_count']), ('MISS', 1))
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client_for(self.author).patch(self.detail, {'title': 'Edited'})
+        self.assertEqual(anonymous.get(self.detail).data['title'], 'Edited')
+    
+    def test_is_liked_is_per_user(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            like_posts(self.fan, [self.post])
+        # Whoever builds the entry, it is shared without their is_liked
+        for path, liked in (('/api/posts/', lambda data: data['results'][0]['is_liked']),
+                            (self.detail, lambda data: data['is_liked'])):
+            response = self.client_for(self.fan).get(path)
+            self.assertEqual(response['X-Cache'], 'MISS')
+            self.assertTrue(liked(response.data))
+            for user in (self.other, None):
+                response = self.client_for(user).get(path)
+                self.assertEqual(response['X-Cache'], 'HIT')
+                self.assertFalse(liked(response.data))
+            self.assertTrue(liked(self.client_for(self.fan).get(path).data))
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class SparseFieldsTest(TestCase):
+    def setUp(self):
+        self.addCleanup(get_cache().clear)
+        author = User.objects.create_user(username='author', email='author@example.com', password='12345')
+        self.post = Post.objects.create(title='Post', content='Test content', author=author)
+        self.comments = [Comment.objects.create(post=self.post, author=author, content=f'Comment {i}')
+                         for i in range(12)]
+        self.client = APIClient()
+    
+    def serializer(self, serializer_class, query):
+        request = Request(APIRequestFactory().get('/', query))
+        return serializer_class(context={'request': request})
+    
+    def loaded_columns(self, queryset):
+        return queryset.query.deferred_loading
+    
+    def test_fields_prune_nested_serializers(self):
+        results = self.client.get('/api/posts/', {'fields': 'title,author.username'}).data['results']
+        self.assertEqual(results, [{'id': self.post.pk, 'title': 'Post',
+                                    'author': {'id': self.post.author_id, 'username': 'author'}}])
+        
+        queryset = sparse_queryset(Post.objects.select_related('author').prefetch_related('comments'),
+                                   self.serializer(PostSerializer, {'fields': 'title,author.username'}))
+        only, defer = self.loaded_columns(queryset)
+        self.assertFalse(defer)
+        self.assertEqual(only, {'id', 'title', 'author', 'author__id', 'author__username'})
+        self.assertEqual(queryset.query.select_related, {'author': {}})
+        self.assertEqual(queryset._prefetch_related_lookups, ())
+    
+    def test_expand_collapses_other_relations(self):
+        post = self.client.get(f'/api/posts/{self.post.pk}/', {'expand': ''}).data
+        self.assertEqual(post['author'], self.post.author_id)
+        self.assertNotIn('comments', post)
+        post = self.client.get(f'/api/posts/{self.post.pk}/', {'expand': 'author', 'fields': 'author'}).data
+        self.assertEqual(post, {'id': self.post.pk, 'author': {'id': self.post.author_id, 'username': 'author',
+                                                               'email': 'author@example.com'}})
+        
+        # A collapsed author needs its id column only, not the join
+        queryset = sparse_queryset(Post.objects.select_related('author'), self.serializer(PostSerializer, {'expand': ''}))
+        self.assertFalse(queryset.query.select_related)
+        self.assertIn('author', self.loaded_columns(queryset)[0])
+    
+    def test_always_columns_keep_cursor_pagination_working(self):
+        path = f'/api/posts/{self.post.pk}/comments/'
+        response = self.client.get(path, {'fields': 'content', 'cursor': ''})
+        self.assertEqual(response.data['results'][0], {'id': self.comments[0].pk, 'content': 'Comment 0'})
+        response = self.client.get(response.data['next'])
+        self.assertEqual([comment['content'] for comment in response.data['results']], ['Comment 10', 'Comment 11'])
+        
+        queryset = sparse_queryset(Comment.objects.all(), self.serializer(CommentSerializer, {'fields': 'content'}),
+                                   always=['created_at'])
+        self.assertEqual(self.loaded_columns(queryset)[0], {'id', 'content', 'created_at'})
+    
+    def test_unknown_field_names(self):
+        response = self.client.get(f'/api/posts/{self.post.pk}/', {'fields': 'nonsense,author.nonsense'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'id': self.post.pk, 'author': {'id': self.post.author_id}})
+        self.assertEqual(self.client.get('/api/posts/', {'fields': 'nonsense'}).data['results'], [{'id': self.post.pk}])
+        
+        # A field the queryset can't map to a column loads every column rather than guessing
+        class LabelledPostSerializer(PostSerializer):
+            label = serializers.ReadOnlyField(source='__str__')
+            
+            class Meta(PostSerializer.Meta):
+                fields = ('id', 'title', 'label')
+        
+        queryset = sparse_queryset(Post.objects.all(), self.serializer(LabelledPostSerializer, {'fields': 'label'}))
+        self.assertEqual(self.loaded_columns(queryset), (frozenset(), True))
+
+@override_settings(SECURE_SSL_REDIRECT=False, NOTIFICATION_DELIVERY='sync', TRENDING_HALF_LIFE_HOURS=12)
+class TrendingTest(TestCase):
+    def setUp(self):
+        self.addCleanup(get_cache().clear)
+        self.author = User.objects.create_user(username='author', password='12345')
+        self.now = timezone.now()
+    
+    def create_posts(self, count):
+        return [Post.objects.create(title=f'Post {i}', content='Test content', author=self.author) for i in range(count)]
+    
+    def test_activity_decays_by_half_life(self):
+        self.assertAlmostEqual(event_score('like', self.now) - event_score('like', self.now - timedelta(hours=12)), 1)
+        self.assertAlmostEqual(event_score('comment', self.now) - event_score('like', self.now), math.log2(3))
+        self.assertAlmostEqual(log_add(5, 5), 6)
+        self.assertAlmostEqual(log_add(5000, 0), 5000)
+        
+        post = self.create_posts(1)[0]
+        record_activity([post.pk], 'like', self.now - timedelta(hours=12))
+        record_activity([post.pk], 'like', self.now - timedelta(hours=12))
+        # Two likes a half-life ago count as much as one now
+        [(post_id, score)], has_next = trending_page(10)
+        self.assertAlmostEqual(score, event_score('like', self.now))
+        self.assertFalse(has_next)
+    
+    def test_ranking_order(self):
+        likes, comment, old_likes, tied = self.create_posts(4)
+        for _ in range(2):
+            record_activity([likes.pk, tied.pk], 'like', self.now)
+        record_activity([comment.pk], 'comment', self.now)
+        for _ in range(3):
+            record_activity([old_likes.pk], 'like', self.now - timedelta(hours=48))
+        rows, _ = trending_page(10)
+        # 3 (a comment) > 2 likes (ties newest post first) > 3/16 (three likes four half-lives ago)
+        self.assertEqual([post_id for post_id, _ in rows], [comment.pk, tied.pk, likes.pk, old_likes.pk])
+        
+        # rebuild_trending recomputes the same order from the likes and comments themselves
+        for post in (likes, tied):
+            for fan in ('fan1', 'fan2'):
+                like_posts(User.objects.get_or_create(username=fan)[0], [post])
+        Comment.objects.create(post=comment, author=self.author, content='Test comment')
+        call_command('rebuild_trending', stdout=open(os.devnull, 'w'))
+        self.assertEqual([post_id for post_id, _ in trending_page(10)[0]], [comment.pk, tied.pk, likes.pk])
+    
+    def test_second_page_by_score_cursor(self):
+        posts = self.create_posts(12)
+        for count, post in enumerate(posts, 1):
+            for _ in range(count):
+                record_activity([post.pk], 'like', self.now)
+        client = APIClient()
+        first = client.get('/api/posts/trending/').data
+        self.assertTrue(first['has_next'])
+        self.assertEqual([post['id'] for post in first['results']], [post.pk for post in posts[:1:-1]])
+        cursor = first['next'].split('cursor=')[1]
+        self.assertEqual(decode_score_cursor(cursor)[1], posts[2].pk)
+        
+        second = client.get(first['next']).data
+        self.assertEqual([post['id'] for post in second['results']], [posts[1].pk, posts[0].pk])
+        self.assertFalse(second['has_next'])
+        self.assertEqual(client.get('/api/posts/trending/', {'cursor': 'garbage'}).status_code, 404)
+
+class BulkImportTest(TestCase):
+    def test_refs_to_failed_or_foreign_posts_are_rejected(self):
+        author = User.objects.create_user(username='author', password='12345')
+        local = Post.objects.create(title='Local', content='Test content', author=author)
+        lines = [
+            f'{{"type": "post", "id": {local.pk}, "author": "author", "content": "no title"}}',
+            f'{{"type": "comment", "post": {local.pk}, "author": "author", "content": "Lost"}}',
+            f'{{"type": "like", "post": {local.pk + 1}, "user": "author"}}',
+        ]
+        importer = BulkImporter().feed(lines)
+        self.assertEqual(importer.imported, {'post': 0, 'comment': 0, 'like': 0})
+        self.assertEqual([error['line'] for error in importer.errors], [1, 2, 3])
+        
+        importer = BulkImporter(local_post_ids=True).feed(lines[1:])
+        self.assertEqual(importer.imported, {'post': 0, 'comment': 1, 'like': 0})
+        self.assertEqual(local.comments.get().content, 'Lost')
+    
+    def test_mixed_import_updates_counters_and_trending(self):
+        for username in ('author', 'fan1', 'fan2'):
+            User.objects.create_user(username=username, password='12345')
+        now = timezone.now()
+        
+        def ago(**delta):
+            return json.dumps((now - timedelta(**delta)).isoformat())
+        lines = [
+            f'{{"type": "post", "id": 1, "author": "author", "title": "First", "content": "A",'
+            f' "created_at": {ago(days=2)}}}',
+            '{"type": "post", "id": 2, "author": "author", "title": "Second", "content": "B"}',
+            f'{{"type": "comment", "post": 1, "author": "fan1", "content": "Nice", "created_at": {ago(hours=1)}}}',
+            f'{{"type": "like", "post": 1, "user": "fan1", "created_at": {ago(hours=2)}}}',
+            '{"type": "like", "post": 1, "user": "fan2"}',
+            '{"type": "like", "post": 1, "user": "fan2"}',
+            # Older than the trending window
+            f'{{"type": "like", "post": 2, "user": "fan1", "created_at": {ago(days=30)}}}',
+            '{"type": "comment", "post": 3, "author": "fan1", "content": "Lost"}',
+        ]
+        # Small batches, so rows refer to posts imported by an earlier one
+        importer = BulkImporter(batch_size=2).feed(lines)
+        self.assertEqual(importer.imported, {'post': 2, 'comment': 1, 'like': 3})
+        self.assertEqual([error['line'] for error in importer.errors], [8])
+        
+        first, second = Post.objects.order_by('pk')
+        self.assertEqual(first.created_at, now - timedelta(days=2))
+        self.assertEqual((first.likes_count, first.comments_count), (2, 1))
+        self.assertEqual((second.likes_count, second.comments_count), (1, 0))
+        
+        # The scores the imported activity would have earned live, which rebuild_trending agrees with
+        imported = dict(TrendingScore.objects.values_list('post_id', 'score'))
+        self.assertEqual(list(imported), [first.pk])
+        rebuild_trending()
+        self.assertAlmostEqual(TrendingScore.objects.get().score, imported[first.pk])
+    
+    @override_settings(NOTIFICATION_DELIVERY='sync')
+    def test_export_round_trip(self):
+        author, fan = [User.objects.create_user(username=username, password='12345') for username in ('author', 'fan')]
+        posts = [Post.objects.create(title=f'Post {i}', content=f'Content {i}', author=author) for i in range(3)]
+        Comment.objects.create(post=posts[1], author=fan, content='Nice')
+        like_posts(fan, posts[:2])
+        like_posts(author, posts[2:])
+        
+        def normalized(lines):
+            # Ids differ between databases; posts are matched by title
+            rows = [json.loads(line) for line in lines]
+            titles = {row['id']: row['title'] for row in rows if row['type'] == 'post'}
+            for row in rows:
+                row.pop('id', None)
+                if 'post' in row:
+                    row['post'] = titles[row['post']]
+            return sorted(rows, key=json.dumps)
+        
+        exported = list(export_lines())
+        self.assertEqual([json.loads(line)['type'] for line in exported], ['post'] * 3 + ['comment'] + ['like'] * 3)
+        Post.objects.all().delete()
+        importer = BulkImporter().feed(exported)
+        self.assertEqual((importer.imported, importer.errors), ({'post': 3, 'comment': 1, 'like': 3}, []))
+        self.assertEqual(normalized(export_lines()), normalized(exported))
+        self.assertEqual(sorted(Post.objects.values_list('likes_count', 'comments_count')), [(1, 0), (1, 0), (1, 1)])
+
+@override_settings(TIMELINE_MAX_LENGTH=3)
+class TimelineTrimTest(TestCase):
+    def test_trim_timelines(self):
+        author = User.objects.create_user(username='author', password='12345')
+        followers = [User.objects.create_user(username=f'follower{i}', password='12345') for i in range(2)]
+        followers[0].follow(author)
+        posts = [Post.objects.create(title=f'Post {i}', content='Test content', author=author) for i in range(5)]
+        for post in posts:
+            fan_out_post(post)
+        followers[1].follow(author)
+        backfill_timeline(followers[1], author)
+        
+        # Fan-out leaves the trimming to the periodic command
+        self.assertEqual(followers[0].timeline_entries.count(), 5)
+        self.assertEqual(followers[1].timeline_entries.count(), 3)
+        call_command('trim_timelines', stdout=open(os.devnull, 'w'))
+        for follower in followers:
+            self.assertEqual(list(follower.timeline_entries.values_list('post_id', flat=True)),
+                             [post.pk for post in reversed(posts[2:])])
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class TimelineRebuildTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user(username='author', password='12345')
+        self.reader = User.objects.create_user(username='reader', password='12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+    
+    def feed_titles(self):
+        return [post['title'] for post in self.client.get('/api/feed/').data['posts']]
+    
+    def test_follows_from_before_timelines_are_rebuilt(self):
+        post = Post.objects.create(title='Old post', content='Test content', author=self.author)
+        # A follow row written before timelines existed, so never backfilled
+        User.followers.through.objects.create(from_customuser=self.reader, to_customuser=self.author)
+        self.assertEqual(self.feed_titles(), [])
+        call_command('rebuild_timelines', stdout=open(os.devnull, 'w'))
+        self.assertEqual(self.feed_titles(), [post.title])
+        # Rebuilding again doesn't duplicate entries
+        call_command('rebuild_timelines', '--user', str(self.reader.pk), stdout=open(os.devnull, 'w'))
+        self.assertEqual(self.reader.timeline_entries.count(), 1)
+    
+    def test_imported_posts_are_fanned_out(self):
+        self.reader.follow(self.author)
+        importer = BulkImporter().feed([
+            '{"type": "post", "id": 1, "author": "author", "title": "Imported", "content": "Test content"}',
+        ])
+        self.assertEqual(importer.imported['post'], 1)
+        self.assertEqual(self.feed_titles(), ['Imported'])
+
+# Pins must reach every worker, so they need a cache outside the process
+SHARED_FILE_CACHES = dict(settings.CACHES, shared={
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': os.path.join(tempfile.gettempdir(), 'social-media-api-test-shared-cache'),
+})
+
+@override_settings(SECURE_SSL_REDIRECT=False, DATABASE_REPLICAS=['replica'], CACHES=SHARED_FILE_CACHES)
+class ReplicaRoutingTest(TransactionTestCase):
+    """A second SQLite file plays a replica that lags until replicate() copies the primary over"""
+    
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Added after the test runner set up its databases, which it must not create or flush
+        handle, cls.replica_name = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        connections.settings['replica'] = dict(connections.settings['default'], NAME=cls.replica_name)
+        cls.databases = cls.databases | {'replica'}
+    
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        os.remove(cls.replica_name)
+        super().tearDownClass()
+    
+    def setUp(self):
+        if connection.vendor != 'sqlite' or connection.is_in_memory_db():
+            self.skipTest('Simulates replication by copying a file-backed SQLite database')
+        for alias in ('default', 'shared'):
+            caches[alias].clear()
+            self.addCleanup(caches[alias].clear)
+        self.alice = self.client_for(User.objects.create_user(username='alice', password='12345'))
+        self.bob = self.client_for(User.objects.create_user(username='bob', password='12345'))
+        self.replicate()
+    
+    def client_for(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=user).key}')
+        return client
+    
+    def replicate(self):
+        connection.ensure_connection()
+        connections['replica'].ensure_connection()
+        connection.connection.backup(connections['replica'].connection)
+    
+    def test_reads_your_writes(self):
+        response = self.alice.post('/api/posts/', {'title': 'Hello', 'content': 'World'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(PIN_COOKIE, response.cookies)
+        path = f'/api/posts/{Post.objects.get().id}/comments/'
+        
+        # The writer is pinned to the primary; everyone else reads the lagging replica
+        self.assertEqual(self.alice.get(path).status_code, 200)
+        self.assertEqual(self.bob.get(path).status_code, 404)
+        self.replicate()
+        self.assertEqual(self.bob.get(path).status_code, 200)
+    
+    def test_pinned_without_cookies(self):
+        self.alice.post('/api/posts/', {'title': 'Hello', 'content': 'World'}, format='json')
+        self.alice.cookies.clear()
+        response = self.alice.get(f'/api/posts/{Post.objects.get().id}/comments/')
+        self.assertEqual(response.status_code, 200)
+    
+    def test_token_not_yet_replicated(self):
+        carol = self.client_for(User.objects.create_user(username='carol', password='12345'))
+        self.assertEqual(carol.get('/api/posts/').status_code, 200)
+    
+    def test_per_process_pin_cache_refused(self):
+        with override_settings(CACHES=dict(settings.CACHES, shared={
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'})):
+            with self.assertRaises(ImproperlyConfigured):
+                ReplicaRoutingMiddleware(lambda request: None)
+
+@override_settings(SECURE_SSL_REDIRECT=False, DATABASE_SHARDS=['shard_a', 'shard_b', 'shard_c'],
+                   NOTIFICATION_DELIVERY='sync')
+class ShardingTest(TransactionTestCase):
+    """Likes and notifications on three SQLite shards"""
+    shards = ['shard_a', 'shard_b', 'shard_c']
+    
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Added after the test runner set up its databases, like ReplicaRoutingTest's replica
+        cls.databases = cls.databases | set(cls.shards)
+        cls.shard_names = []
+        for alias in cls.shards:
+            handle, name = tempfile.mkstemp(suffix='.sqlite3')
+            os.close(handle)
+            cls.shard_names.append(name)
+            connections.settings[alias] = dict(connections.settings['default'], NAME=name)
+            with connections[alias].schema_editor() as editor:
+                editor.create_model(Like)
+                editor.create_model(Notification)
+    
+    @classmethod
+    def tearDownClass(cls):
+        for alias, name in zip(cls.shards, cls.shard_names):
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+            os.remove(name)
+        super().tearDownClass()
+    
+    def setUp(self):
+        if connection.vendor != 'sqlite' or connection.is_in_memory_db():
+            self.skipTest('Shards are file-backed SQLite databases next to a file-backed default')
+        get_cache().clear()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.addCleanup(get_follow_graph_cache().clear)
+        self.author = User.objects.create_user(username='author', password='12345')
+        self.fan = User.objects.create_user(username='fan', password='12345')
+        # Enough posts for every shard to hold some of their likes
+        self.posts = []
+        while len({shard_for(Like, post.pk) for post in self.posts}) < len(self.shards):
+            self.posts.append(Post.objects.create(title='Post', content='Test content', author=self.author))
+        self.client = APIClient()
+        self.client.force_authenticate(self.fan)
+        response = self.client.post('/api/posts/batch-like/', {'like': [post.pk for post in self.posts]},
+                                    format='json')
+        self.assertEqual(len(response.data['liked']), len(self.posts))
+    
+    def likes_on(self, alias):
+        return set(Like.objects.using(alias).values_list('post_id', flat=True))
+    
+    def test_rows_live_on_their_shard(self):
+        for alias in self.shards:
+            self.assertEqual(self.likes_on(alias), {post.pk for post in self.posts if shard_for(Like, post.pk) == alias})
+        self.assertFalse(Like.objects.using('default').exists())
+        self.assertEqual(on_shard(Notification, self.author.pk).filter(recipient=self.author).count(), len(self.posts))
+        with self.assertRaises(ShardKeyRequired):
+            Like.objects.count()
+    
+    def test_reads(self):
+        post = self.posts[0]
+        response = self.client.get(f'/api/posts/{post.pk}/likes/')
+        self.assertEqual([like['user']['username'] for like in response.data], ['fan'])
+        self.assertTrue(all(post.is_liked for post in Post.objects.with_engagement(self.fan)))
+        self.assertFalse(any(post.is_liked for post in Post.objects.with_engagement(self.author)))
+        self.assertTrue(all(post['is_liked'] for post in self.client.get('/api/posts/').data['results']))
+        self.assertEqual([post.likes_count for post in Post.objects.all()], [1] * len(self.posts))
+        
+        self.client.force_authenticate(self.author)
+        response = self.client.get('/api/notifications/')
+        self.assertEqual({item['actor']['username'] for item in response.data['results']}, {'fan'})
+        self.assertEqual(self.client.get('/api/notifications/stats/').data['unread_notifications'], len(self.posts))
+    
+    def test_unlike_and_cascades(self):
+        self.client.post('/api/posts/batch-like/', {'unlike': [self.posts[0].pk]}, format='json')
+        self.assertEqual(Post.objects.get(pk=self.posts[0].pk).likes_count, 0)
+        self.assertFalse(on_shard(Like, self.posts[0].pk).filter(post=self.posts[0]).exists())
+        
+        deleted = self.posts[1].pk
+        self.posts[1].delete()
+        self.assertFalse(on_shard(Like, deleted).filter(post_id=deleted).exists())
+        self.fan.delete()
+        self.assertEqual(set().union(*(self.likes_on(alias) for alias in self.shards)), set())
+        self.assertFalse(on_shard(Notification, self.author.pk).filter(recipient=self.author).exists())
+        self.assertEqual([post.likes_count for post in Post.objects.all()], [0] * (len(self.posts) - 1))
+    
+    def test_rebalance(self):
+        liked_at = {like.post_id: like.created_at for alias in self.shards for like in Like.objects.using(alias)}
+        # Retire shard_c: its rows move to where two shards map them
+        with override_settings(DATABASE_SHARDS=self.shards[:2]):
+            call_command('rebalance_shards', '--from', 'shard_a', '--from', 'shard_b', '--from', 'shard_c',
+                         stdout=open(os.devnull, 'w'))
+            self.assertEqual(self.likes_on('shard_c'), set())
+            for alias in self.shards[:2]:
+                self.assertEqual(self.likes_on(alias),
+                                 {post.pk for post in self.posts if shard_for(Like, post.pk) == alias})
+                self.assertEqual(set(Notification.objects.using(alias).values_list('recipient_id', flat=True)),
+                                 {self.author.pk} if shard_for(Notification, self.author.pk) == alias else set())
+            moved = {like.post_id: like.created_at for alias in self.shards for like in Like.objects.using(alias)}
+            self.assertEqual(moved, liked_at)
+            self.assertEqual([post.likes_count for post in Post.objects.all()], [1] * len(self.posts))
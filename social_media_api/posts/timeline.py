@@ -0,0 +1,197 @@
+"""
+Materialized home timelines.
+
+When a post is created its id is pushed into a bounded timeline for every
+follower of the author (fan-out-on-write), so reading a feed is a pre-sorted
+slice of TimelineEntry rows instead of a join over everyone the user follows.
+Authors with more than TIMELINE_CELEBRITY_THRESHOLD followers are not fanned
+out; their posts are merged into the feed at read time (fan-out-on-read).
+
+Timelines only hold what fan-out and backfill wrote, so follows made before
+they existed (or imported some other way) need `manage.py
+rebuild_timelines` once, which refills every timeline from the follow
+graph. Bulk imports fan their posts out with fan_out_posts().
+
+Fan-out doesn't trim timelines to TIMELINE_MAX_LENGTH, which would scan
+every follower's timeline for each post; `manage.py trim_timelines` does,
+periodically. Until then a timeline runs over by the posts made since,
+which feeds don't notice as they read the newest entries first.
+"""
+import heapq
+from itertools import islice
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Count
+
+from social_media_api.pagination import keyset_filter
+
+from .models import Post, TimelineEntry
+
+User = get_user_model()
+
+# CustomUser.follow() stores "a follows b" as a row (from_customuser=a, to_customuser=b)
+Follow = User.followers.through
+
+
+def get_max_length():
+    return getattr(settings, 'TIMELINE_MAX_LENGTH', 800)
+
+
+def get_celebrity_threshold():
+    return getattr(settings, 'TIMELINE_CELEBRITY_THRESHOLD', 10000)
+
+
+def is_celebrity(user):
+    """Check if a user has too many followers to fan out to"""
+    return user.get_followers_count() >= get_celebrity_threshold()
+
+
+def followed_celebrity_ids(user):
+    """Ids of the celebrity authors a user follows"""
+    return list(
+        user.followers.filter(followers_count__gte=get_celebrity_threshold()).values_list('id', flat=True)
+    )
+
+
+def trim_timeline(user_id):
+    """Drop everything past the newest TIMELINE_MAX_LENGTH entries of one timeline"""
+    max_length = get_max_length()
+    entries = TimelineEntry.objects.filter(user_id=user_id)
+    # The last entry kept; one index seek rather than a scan of every entry
+    last_kept = list(entries.order_by('-created_at', '-post_id')
+                     .values_list('created_at', 'post_id')[max_length - 1:max_length])
+    if last_kept:
+        entries.filter(keyset_filter(('-created_at', '-post_id'), last_kept[0])).delete()
+
+
+def trim_timelines(user_ids=None):
+    """Trim the timelines of `user_ids` (default all) that are over TIMELINE_MAX_LENGTH; return how many"""
+    entries = TimelineEntry.objects.all() if user_ids is None else TimelineEntry.objects.filter(user_id__in=user_ids)
+    over_ids = list(
+        entries.order_by().values('user_id').annotate(total=Count('pk'))
+        .filter(total__gt=get_max_length()).values_list('user_id', flat=True)
+    )
+    for user_id in over_ids:
+        trim_timeline(user_id)
+    return len(over_ids)
+
+
+def fan_out_post(post):
+    """Push a new post into the timelines of the author's followers"""
+    if is_celebrity(post.author):
+        return
+
+    follower_ids = list(Follow.objects.filter(to_customuser=post.author).values_list('from_customuser', flat=True))
+    if not follower_ids:
+        return
+
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(user_id=user_id, post=post, created_at=post.created_at) for user_id in follower_ids],
+        ignore_conflicts=True,
+        batch_size=1000,
+    )
+
+
+def fan_out_posts(posts, batch_size=1000):
+    """Push many posts (with author_id and created_at) into their authors' followers' timelines"""
+    by_author = {}
+    for post in posts:
+        by_author.setdefault(post.author_id, []).append(post)
+    authors = User.objects.filter(pk__in=by_author, followers_count__lt=get_celebrity_threshold())
+    follows = list(Follow.objects.filter(to_customuser__in=authors).values_list('to_customuser', 'from_customuser'))
+    entries = (TimelineEntry(user_id=user_id, post=post, created_at=post.created_at)
+               for author_id, user_id in follows for post in by_author[author_id])
+    while batch := list(islice(entries, batch_size)):
+        TimelineEntry.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def rebuild_timeline(user_id):
+    """Refill one timeline with the newest TIMELINE_MAX_LENGTH posts of the non-celebrities it follows"""
+    posts = Post.objects.filter(
+        author__in=Follow.objects.filter(from_customuser_id=user_id).values('to_customuser'),
+        author__followers_count__lt=get_celebrity_threshold(),
+    ).order_by('-created_at', '-id').values_list('id', 'created_at')
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(user_id=user_id, post_id=post_id, created_at=created_at)
+         for post_id, created_at in posts[:get_max_length()]],
+        ignore_conflicts=True,
+        batch_size=1000,
+    )
+
+
+def rebuild_timelines(user_ids=None):
+    """Rebuild the timelines of `user_ids` (default everyone following someone); return how many"""
+    followers = Follow.objects.order_by().values_list('from_customuser', flat=True).distinct()
+    if user_ids is not None:
+        followers = followers.filter(from_customuser__in=user_ids)
+    user_ids = list(followers)
+    for user_id in user_ids:
+        rebuild_timeline(user_id)
+    return len(user_ids)
+
+
+def backfill_timeline(user, author):
+    """Copy an author's recent posts into a user's timeline after a follow"""
+    if is_celebrity(author):
+        return
+
+    recent_posts = Post.objects.filter(author=author).order_by('-created_at', '-id').values_list('id', 'created_at')
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(user=user, post_id=post_id, created_at=created_at)
+         for post_id, created_at in recent_posts[:get_max_length()]],
+        ignore_conflicts=True,
+        batch_size=1000,
+    )
+    trim_timeline(user.id)
+
+
+def prune_timeline(user, author):
+    """Remove an author's posts from a user's timeline after an unfollow"""
+    TimelineEntry.objects.filter(user=user, post__author=author).delete()
+
+
+def get_timeline(user, limit, offset=0, before=None):
+    """
+    Return (posts, has_next) for a slice of a user's home timeline, newest
+    first, merging in posts from followed celebrities. `before` is an optional
+    (created_at, post_id) keyset position to continue from.
+    """
+    celebrity_ids = followed_celebrity_ids(user)
+    entries = TimelineEntry.objects.filter(user=user)
+    pulled = Post.objects.filter(author_id__in=celebrity_ids).order_by('-created_at', '-id')
+    if before is not None:
+        entries = entries.filter(keyset_filter(('-created_at', '-post_id'), before))
+        pulled = pulled.filter(keyset_filter(('-created_at', '-id'), before))
+
+    # Both sources are already sorted newest first, so a lazy merge of their
+    # first rows is enough to produce the requested slice plus one lookahead row
+    end = offset + limit + 1
+    merged = heapq.merge(
+        entries.values_list('created_at', 'post_id')[:end],
+        pulled.values_list('created_at', 'id')[:end] if celebrity_ids else [],
+        reverse=True,
+    )
+    post_ids = []
+    seen = set()
+    for created_at, post_id in merged:
+        if post_id not in seen:
+            seen.add(post_id)
+            post_ids.append(post_id)
+    post_ids = post_ids[offset:end]
+    has_next = len(post_ids) > limit
+    post_ids = post_ids[:limit]
+
+    posts_by_id = (Post.objects.with_engagement(user).select_related('author')
+                   .with_comments(getattr(settings, 'POST_LIST_COMMENTS', 3)).in_bulk(post_ids))
+    posts = [posts_by_id[post_id] for post_id in post_ids if post_id in posts_by_id]
+    return posts, has_next
+
+
+def count_timeline(user):
+    """Total number of posts reachable in a user's home timeline"""
+    total = TimelineEntry.objects.filter(user=user).count()
+    celebrity_ids = followed_celebrity_ids(user)
+    if celebrity_ids:
+        total += Post.objects.filter(author_id__in=celebrity_ids).count()
+    return total
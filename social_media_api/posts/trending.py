@@ -0,0 +1,168 @@
+"""
+Trending posts, ranked by time-decayed like and comment activity.
+
+A post's score is the sum over its activity of
+
+    weight * 2 ** (-age_in_hours / TRENDING_HALF_LIFE_HOURS)
+
+Decaying every row as time passes would mean rewriting the whole table.
+Instead each event adds weight * 2 ** (hours since EPOCH / half-life):
+that differs from the decayed value by the same factor for every post, so
+the order is unchanged, and a row is only written when its post gets a
+like or comment. The sums grow without bound, so TrendingScore.score holds
+their log2, and adding an event is one UPDATE computing log2(2**a + 2**b).
+
+Imported likes and comments are added by record_events() at the times
+they happened, skipping any older than the trending window.
+
+/api/posts/trending/ is then a range scan over the (score, post) index,
+paged by cursor. Unlikes and deleted comments are not subtracted
+incrementally; `rebuild_trending`, run periodically, recomputes every
+score from the last TRENDING_WINDOW_DAYS of activity and drops posts with
+none.
+"""
+import math
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import DateTimeField, F, FloatField, Value
+from django.db.models.functions import Abs, Greatest, Log, Power
+from django.utils import timezone
+
+from social_media_api.pagination import keyset_filter
+from social_media_api.sharding import each_shard
+
+from .models import Comment, Like, TrendingScore
+
+# Scores are relative to this instant; changing it rescales every stored score
+EPOCH = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+
+DEFAULT_WEIGHTS = {'like': 1.0, 'comment': 3.0}
+
+ORDERING = ('-score', '-post_id')
+
+
+def get_half_life():
+    return getattr(settings, 'TRENDING_HALF_LIFE_HOURS', 12)
+
+
+def get_weight(kind):
+    return getattr(settings, 'TRENDING_WEIGHTS', DEFAULT_WEIGHTS)[kind]
+
+
+def get_window():
+    return timedelta(days=getattr(settings, 'TRENDING_WINDOW_DAYS', 7))
+
+
+def event_score(kind, at):
+    """log2 of the undecayed contribution of one `kind` event at `at`"""
+    hours = (at - EPOCH).total_seconds() / 3600
+    return hours / get_half_life() + math.log2(get_weight(kind))
+
+
+def log_add(a, b):
+    """log2(2**a + 2**b) without overflowing"""
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def add_to_score(score):
+    """An expression for log_add(F('score'), score)"""
+    added = Value(score, output_field=FloatField())
+    two = Value(2.0, output_field=FloatField())
+    # The same log_add() as above, in SQL, so concurrent events can't overwrite each other
+    return Greatest(F('score'), added) + Log(two, Value(1.0) + Power(two, -Abs(F('score') - added)))
+
+
+def record_activity(post_ids, kind, at=None):
+    """Add one `kind` event ('like' or 'comment') to the score of each of `post_ids`"""
+    post_ids = set(post_ids)
+    if not post_ids:
+        return
+    at = at or timezone.now()
+    score = event_score(kind, at)
+
+    with transaction.atomic():
+        rows = TrendingScore.objects.filter(post_id__in=post_ids)
+        if rows.update(score=add_to_score(score), last_activity_at=at) == len(post_ids):
+            return
+        missing = post_ids - set(rows.values_list('post_id', flat=True))
+        # A row created by a racing event in between loses this one; the next rebuild restores it
+        TrendingScore.objects.bulk_create(
+            [TrendingScore(post_id=post_id, score=score, last_activity_at=at) for post_id in missing],
+            ignore_conflicts=True,
+        )
+
+
+def record_events(events):
+    """
+    Add (post_id, kind, at) events that each carry their own time, such as
+    imported likes and comments. Events older than the trending window are
+    skipped, as rebuild() would drop them.
+    """
+    since = timezone.now() - get_window()
+    added = {}
+    for post_id, kind, at in events:
+        if at < since:
+            continue
+        score = event_score(kind, at)
+        if post_id in added:
+            current, last = added[post_id]
+            score, at = log_add(current, score), max(last, at)
+        added[post_id] = (score, at)
+    if not added:
+        return
+
+    with transaction.atomic():
+        existing = set(TrendingScore.objects.filter(post_id__in=added).values_list('post_id', flat=True))
+        # One UPDATE per post: each adds a different score
+        for post_id in existing:
+            score, at = added[post_id]
+            TrendingScore.objects.filter(post_id=post_id).update(
+                score=add_to_score(score),
+                last_activity_at=Greatest(F('last_activity_at'), Value(at, output_field=DateTimeField())),
+            )
+        TrendingScore.objects.bulk_create(
+            [TrendingScore(post_id=post_id, score=score, last_activity_at=at)
+             for post_id, (score, at) in added.items() if post_id not in existing],
+            ignore_conflicts=True,
+        )
+
+
+def compute_scores(since, chunk_size=2000):
+    """Return {post_id: (score, last_activity_at)} from the likes and comments made after `since`"""
+    scores = {}
+    for kind, model in (('like', Like), ('comment', Comment)):
+        # Every shard in turn when likes are sharded
+        for manager in each_shard(model):
+            events = manager.filter(created_at__gte=since).order_by().values_list('post_id', 'created_at')
+            for post_id, created_at in events.iterator(chunk_size=chunk_size):
+                score = event_score(kind, created_at)
+                if post_id in scores:
+                    current, last = scores[post_id]
+                    score, created_at = log_add(current, score), max(last, created_at)
+                scores[post_id] = (score, created_at)
+    return scores
+
+
+def rebuild(batch_size=1000):
+    """Replace every score with one recomputed from the trending window; return the number of rows"""
+    scores = compute_scores(timezone.now() - get_window())
+    with transaction.atomic():
+        TrendingScore.objects.all().delete()
+        TrendingScore.objects.bulk_create(
+            [TrendingScore(post_id=post_id, score=score, last_activity_at=at)
+             for post_id, (score, at) in scores.items()],
+            batch_size=batch_size,
+        )
+    return len(scores)
+
+
+def trending_page(page_size, after=None):
+    """Return ([(post_id, score)], has_next) for the page of trending posts following `after`"""
+    rows = TrendingScore.objects.order_by(*ORDERING)
+    if after is not None:
+        rows = rows.filter(keyset_filter(ORDERING, after))
+    rows = list(rows.values_list('post_id', 'score')[:page_size + 1])
+    return rows[:page_size], len(rows) > page_size
@@ -2,29 +2,54 @@ from rest_framework import viewsets, status, filters, generics
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticatedOrReadOnly
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework import permissions
 from django_filters.rest_framework import DjangoFilterBackend
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from .models import Post, Comment, Like
 from .serializers import (
     PostSerializer, PostCreateSerializer, 
     CommentSerializer, CommentCreateSerializer,
-    LikeSerializer
+    LikeSerializer, BatchLikeSerializer
 )
 from .permissions import IsAuthorOrReadOnly
-from notifications.models import Notification
+from .bulk import EXPORT_TYPES, BulkImporter, export_lines
+from .likes import like_posts, unlike_posts
+from .response_cache import CachedResponseMixin
+from .search import FullTextSearchFilter
+from .timeline import fan_out_post, get_timeline, count_timeline
+from .trending import trending_page
+from notifications.dispatcher import notify
+from social_media_api.instrumentation import InstrumentedViewMixin, query_budget
+from social_media_api.pagination import (
+    KeysetPagination, encode_cursor, decode_cursor, encode_score_cursor, decode_score_cursor
+)
+from social_media_api.sharding import on_shard, with_related
+from social_media_api.sparse_fields import SparseFieldsViewMixin, sparse_queryset
+from social_media_api.throttling import TokenBucketThrottle
 
-class PostViewSet(viewsets.ModelViewSet):
+class PostViewSet(InstrumentedViewMixin, CachedResponseMixin, SparseFieldsViewMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticatedOrReadOnly, IsAuthorOrReadOnly]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
-    search_fields = ['title', 'content']
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter, FullTextSearchFilter]
     filterset_fields = ['author']
     ordering_fields = ['created_at', 'updated_at']
     ordering = ['-created_at']
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-created_at', '-id')
+    # Set per write action below; see social_media_api.throttling
+    throttle_scope = None
+    # Uncached reads, including one query to authenticate the token; page-number lists (?page=) add a COUNT
+    query_budget = {'list': 5, 'retrieve': 4, 'trending': 4, 'comments': 4, 'likes': 4}
     
     def get_queryset(self):
-        return Post.objects.all().select_related('author').prefetch_related('comments__author', 'likes__user')
+        # List pages embed only the latest comments; the full thread is served by `comments`
+        limit = getattr(settings, 'POST_LIST_COMMENTS', 3) if self.action in ('list', 'trending') else None
+        return (Post.objects.with_engagement(self.request.user)
+                .select_related('author').with_comments(limit))
     
     def get_serializer_class(self):
         if self.action in ['create', 'update', 'partial_update']:
@@ -32,68 +57,148 @@ class PostViewSet(viewsets.ModelViewSet):
         return PostSerializer
     
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        post = serializer.save(author=self.request.user)
+        
+        # Push the new post into followers' home timelines
+        fan_out_post(post)
     
-    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticatedOrReadOnly])
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticatedOrReadOnly],
+            throttle_classes=[TokenBucketThrottle], throttle_scope='comment')
     def add_comment(self, request, pk=None):
         post = self.get_object()
         serializer = CommentCreateSerializer(data=request.data)
         
         if serializer.is_valid():
-            comment = serializer.save(post=post, author=request.user)
+            # A comment is never stored without being counted
+            with transaction.atomic():
+                comment = serializer.save(post=post, author=request.user)
+                post.adjust_counter('comments_count', 1)
             
-            # Create notification for post author (if not commenting on own post)
-            if post.author != request.user:
-                Notification.objects.create(
-                    recipient=post.author,
-                    actor=request.user,
-                    verb='comment',
-                    target=post
-                )
+            # Queue notification for post author (skipped when commenting on own post)
+            notify(post.author, request.user, 'comment', target=post)
             
             return Response(CommentSerializer(comment).data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
-    @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
+    @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated],
+            throttle_classes=[TokenBucketThrottle], throttle_scope='like')
     def like(self, request, pk=None):
-        post = generics.get_object_or_404(Post, pk=pk)
+        post = generics.get_object_or_404(Post.objects.only('id', 'author_id'), pk=pk)
         
-        if post.is_liked_by(request.user):
-            return Response({'error': 'You have already liked this post'}, status=status.HTTP_400_BAD_REQUEST)
+        # Idempotent: liking twice (or two racing double-taps) leaves one like
+        likes = like_posts(request.user, [post])
+        if not likes:
+            return Response({'message': 'You have already liked this post'}, status=status.HTTP_200_OK)
+        return Response(LikeSerializer(likes[0]).data, status=status.HTTP_201_CREATED)
+    
+    @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated],
+            throttle_classes=[TokenBucketThrottle], throttle_scope='like')
+    def unlike(self, request, pk=None):
+        try:
+            post_id = int(pk)
+        except ValueError:
+            raise Http404
         
-        like, created = Like.objects.get_or_create(user=request.user, post=post)
+        # One DELETE ... RETURNING; the post is only looked up to tell 404 from not-liked
+        if not unlike_posts(request.user, [post_id]):
+            generics.get_object_or_404(Post.objects.only('id'), pk=pk)
+            return Response({'message': 'You have not liked this post'}, status=status.HTTP_200_OK)
+        return Response({'message': 'Post unliked successfully'}, status=status.HTTP_200_OK)
+    
+    @action(detail=False, methods=['post'], url_path='batch-like', permission_classes=[permissions.IsAuthenticated],
+            throttle_classes=[TokenBucketThrottle], throttle_scope='batch_like')
+    def batch_like(self, request):
+        """Like and/or unlike many posts: {"like": [ids], "unlike": [ids]}"""
+        serializer = BatchLikeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
         
-        # Create notification for post author (if not liking own post)
-        if post.author != request.user:
-            Notification.objects.create(
-                recipient=post.author,
-                actor=request.user,
-                verb='like',
-                target=post
-            )
+        posts = Post.objects.filter(pk__in=serializer.validated_data['like']).only('id', 'author_id')
+        liked = like_posts(request.user, list(posts))
+        unliked = unlike_posts(request.user, serializer.validated_data['unlike'])
+        return Response({
+            'liked': sorted(like.post_id for like in liked),
+            'unliked': sorted(unliked),
+        })
+    
+    @action(detail=False, methods=['post'], url_path='import', permission_classes=[permissions.IsAdminUser])
+    def bulk_import(self, request):
+        """
+        Import an NDJSON body of posts, comments and likes (see posts.bulk);
+        ?local_post_ids=1 takes post ids not in the body as ids of existing posts
+        """
+        try:
+            batch_size = max(1, min(int(request.query_params.get('batch_size', 500)), 5000))
+        except ValueError:
+            batch_size = 500
+        local_post_ids = request.query_params.get('local_post_ids') in ('1', 'true')
         
-        return Response(LikeSerializer(like).data, status=status.HTTP_201_CREATED)
+        # Read the raw body line by line rather than through request.data
+        importer = BulkImporter(default_author=request.user, batch_size=batch_size,
+                                local_post_ids=local_post_ids).feed(request._request)
+        imported = sum(importer.imported.values())
+        if not imported and importer.error_count:
+            return Response(importer.report(), status=status.HTTP_400_BAD_REQUEST)
+        return Response(importer.report(), status=status.HTTP_201_CREATED if imported else status.HTTP_200_OK)
     
-    @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
-    def unlike(self, request, pk=None):
-        post = generics.get_object_or_404(Post, pk=pk)
+    @action(detail=False, methods=['get'], url_path='export', permission_classes=[permissions.IsAdminUser])
+    def bulk_export(self, request):
+        """Stream every post, comment and like as NDJSON; ?types=post,comment limits the row types"""
+        types = [row_type for row_type in request.query_params.get('types', ','.join(EXPORT_TYPES)).split(',')
+                 if row_type in EXPORT_TYPES]
+        response = StreamingHttpResponse(export_lines(types), content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="posts.ndjson"'
+        return response
+    
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticatedOrReadOnly])
+    def trending(self, request):
+        """Posts ranked by recent like and comment activity (see posts.trending), cursor-paginated"""
+        cursor = request.query_params.get('cursor')
+        rows, has_next = trending_page(KeysetPagination.page_size, decode_score_cursor(cursor) if cursor else None)
         
-        if not post.is_liked_by(request.user):
-            return Response({'error': 'You have not liked this post'}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = PostSerializer(context=self.get_serializer_context())
+        posts = sparse_queryset(self.get_queryset(), serializer).in_bulk([post_id for post_id, _ in rows])
+        # A post deleted since its row was read simply drops out of the page
+        page = [posts[post_id] for post_id, _ in rows if post_id in posts]
+        serializer = PostSerializer(page, many=True, context=self.get_serializer_context())
         
-        Like.objects.filter(user=request.user, post=post).delete()
-        return Response({'message': 'Post unliked successfully'}, status=status.HTTP_200_OK)
+        next_link = None
+        if has_next:
+            post_id, score = rows[-1]
+            next_link = replace_query_param(request.build_absolute_uri(), 'cursor', encode_score_cursor(score, post_id))
+        return Response({
+            'next': next_link,
+            'has_next': has_next,
+            'results': serializer.data
+        })
+    
+    @action(detail=True, methods=['get'], permission_classes=[IsAuthenticatedOrReadOnly])
+    def comments(self, request, pk=None):
+        """The full comment thread of a post, oldest first; send ?cursor= for keyset pages"""
+        post = generics.get_object_or_404(Post.objects.only('id'), pk=pk)
+        comments = Comment.objects.filter(post=post).select_related('author')
+        serializer = CommentSerializer(context={'request': request})
+        comments = sparse_queryset(comments, serializer, always=['created_at'])
+        
+        paginator = KeysetPagination()
+        paginator.ordering = ('created_at', 'id')
+        page = paginator.paginate_queryset(comments, request)
+        serializer = CommentSerializer(page, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
     
     @action(detail=True, methods=['get'], permission_classes=[IsAuthenticatedOrReadOnly])
     def likes(self, request, pk=None):
-        post = self.get_object()
-        likes = post.likes.select_related('user')
+        post = generics.get_object_or_404(Post.objects.only('id'), pk=pk)
+        likes = with_related(on_shard(Like, post.pk).filter(post=post), 'user')
         serializer = LikeSerializer(likes, many=True)
         return Response(serializer.data)
 
-class CommentViewSet(viewsets.ModelViewSet):
+class CommentViewSet(InstrumentedViewMixin, SparseFieldsViewMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticatedOrReadOnly, IsAuthorOrReadOnly]
     serializer_class = CommentSerializer
+    filter_backends = [FullTextSearchFilter]
+    pagination_class = KeysetPagination
+    keyset_ordering = ('created_at', 'id')
+    query_budget = {'list': 3, 'retrieve': 2}
     
     def get_queryset(self):
         return Comment.objects.all().select_related('author', 'post')
@@ -104,8 +209,16 @@ class CommentViewSet(viewsets.ModelViewSet):
         return CommentSerializer
     
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        with transaction.atomic():
+            comment = serializer.save(author=self.request.user)
+            comment.post.adjust_counter('comments_count', 1)
+    
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            instance.delete()
+            Post(pk=instance.post_id).adjust_counter('comments_count', -1)
 
+@query_budget(8)
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def user_feed(request):
@@ -115,28 +228,41 @@ def user_feed(request):
     if not request.user.is_authenticated:
         return Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
     
-    # Get posts from followed users using the exact required syntax
-    following_users = request.user.following.all()
-    feed_posts = Post.objects.filter(author__in=following_users).order_by('-created_at')
+    # Read the user's precomputed home timeline instead of joining over followed users
+    page_size = 10
+    
+    # Cursor mode: continue after the last (created_at, id) the client has seen
+    if 'cursor' in request.query_params:
+        cursor = request.query_params.get('cursor')
+        before = decode_cursor(cursor) if cursor else None
+        feed_posts, has_next = get_timeline(request.user, page_size, before=before)
+        serializer = PostSerializer(feed_posts, many=True, context={'request': request})
+        
+        next_cursor = None
+        if has_next:
+            next_cursor = encode_cursor(feed_posts[-1].created_at, feed_posts[-1].id)
+        return Response({
+            'posts': serializer.data,
+            'has_next': has_next,
+            'next_cursor': next_cursor
+        })
     
-    # Apply pagination
     page = request.query_params.get('page', 1)
-    page_size = 10
     
     try:
         page = int(page)
     except ValueError:
         page = 1
+    page = max(page, 1)
     
     start_index = (page - 1) * page_size
-    end_index = start_index + page_size
     
-    paginated_posts = feed_posts[start_index:end_index]
+    paginated_posts, has_next = get_timeline(request.user, page_size, offset=start_index)
     serializer = PostSerializer(paginated_posts, many=True, context={'request': request})
     
     return Response({
         'posts': serializer.data,
         'page': page,
-        'has_next': end_index < feed_posts.count(),
-        'total_posts': feed_posts.count()
+        'has_next': has_next,
+        'total_posts': count_timeline(request.user)
     })
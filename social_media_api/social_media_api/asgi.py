@@ -0,0 +1,12 @@
+"""
+ASGI config for social_media_api project.
+
+Serve with an ASGI server (e.g. `uvicorn social_media_api.asgi:application`)
+so long-lived connections such as the notification stream do not each tie
+up a worker thread.
+"""
+import os
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'social_media_api.settings')
+application = get_asgi_application()
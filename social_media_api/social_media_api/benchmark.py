@@ -0,0 +1,411 @@
+"""
+Benchmark harness: a reproducible data generator and scripted scenarios.
+
+`manage.py generate_benchmark_data` creates users named <prefix><n> with
+API tokens, a power-law follow graph (a few accounts gather most of the
+followers), posts, comments, likes, notifications and the home timelines
+that fan-out would have written. Everything is inserted with bulk_create
+and drawn from one seeded random generator, so a seed always produces the
+same dataset.
+
+`manage.py run_benchmark` runs each scenario in turn against that data, as
+random benchmark users. It uses the Django test client in process or HTTP
+requests to a running server, with concurrent workers, and writes a JSON
+report with p50/p95/p99 latency, throughput, status codes and query counts
+(from RequestMetricsMiddleware; over HTTP only when the server runs with
+SERVER_TIMING on) per scenario. The report records the git commit, so runs
+can be diffed across commits. Scenarios that write undo their writes after
+they are measured (see RESTORE), so every run with a seed measures the same
+data.
+"""
+import heapq
+import json
+import random
+import re
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import timedelta
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.test import Client
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from notifications.dispatcher import dispatcher
+from notifications.models import Notification
+from notifications.stats import invalidate_notification_stats
+from posts import trending
+from posts.likes import unlike_posts
+from posts.models import Comment, Like, Post, TimelineEntry
+from posts.search import get_post_search
+from posts.timeline import get_celebrity_threshold, get_max_length
+
+from .sharding import each_shard, group_objects, using_shard
+
+User = get_user_model()
+Follow = User.followers.through
+
+DEFAULT_PREFIX = 'bench_'
+# Popularity of the user with rank r is proportional to 1 / (r + 1) ** ZIPF_EXPONENT
+ZIPF_EXPONENT = 1.1
+
+
+def power_law_count(rng, mean):
+    """A heavy-tailed count (Pareto, shape 2) with the given mean"""
+    return int(mean / 2 * rng.paretovariate(2))
+
+
+def sample(rng, population, cum_weights, count, exclude=None):
+    """Up to `count` distinct items of `population` drawn by weight, never `exclude`"""
+    chosen = set()
+    for item in rng.choices(population, cum_weights=cum_weights, k=count * 2):
+        if item != exclude:
+            chosen.add(item)
+            if len(chosen) == count:
+                break
+    return chosen
+
+
+def clear(prefix=DEFAULT_PREFIX):
+    """Delete the benchmark users; their posts, likes and notifications cascade"""
+    deleted, _ = User.objects.filter(username__startswith=prefix).delete()
+    return deleted
+
+
+def generate(users=1000, follows_per_user=20, posts_per_user=5, comments_per_post=2, likes_per_post=5,
+             days=30, seed=0, prefix=DEFAULT_PREFIX, batch_size=1000):
+    """Create a benchmark dataset; return {model name: rows created}"""
+    rng = random.Random(seed)
+    now = timezone.now()
+    ranks = range(users)
+    popularity = []
+    total = 0.0
+    for rank in ranks:
+        total += 1 / (rank + 1) ** ZIPF_EXPONENT
+        popularity.append(total)
+
+    follows = []
+    for follower in ranks:
+        count = min(users - 1, power_law_count(rng, follows_per_user))
+        follows += [(follower, followed) for followed in sample(rng, ranks, popularity, count, exclude=follower)]
+    followers_count = [0] * users
+    following_count = [0] * users
+    for follower, followed in follows:
+        following_count[follower] += 1
+        followers_count[followed] += 1
+
+    with transaction.atomic():
+        password = make_password('benchmark')
+        people = User.objects.bulk_create([
+            User(username=f'{prefix}{rank}', email=f'{prefix}{rank}@example.com', password=password,
+                 followers_count=followers_count[rank], following_count=following_count[rank])
+            for rank in ranks
+        ], batch_size=batch_size)
+        ids = [person.pk for person in people]
+        Token.objects.bulk_create([Token(key=Token.generate_key(), user_id=user_id) for user_id in ids],
+                                  batch_size=batch_size)
+        Follow.objects.bulk_create([Follow(from_customuser_id=ids[follower], to_customuser_id=ids[followed])
+                                    for follower, followed in follows], batch_size=batch_size)
+
+        # Posts first; their counters and timestamps are filled in once comments and likes are known
+        posts = []
+        for rank in ranks:
+            for _ in range(power_law_count(rng, posts_per_user)):
+                posts.append(Post(author_id=ids[rank], title=f'Post {len(posts)} by {prefix}{rank}',
+                                  content=f'Benchmark post {len(posts)}'))
+        Post.objects.bulk_create(posts, batch_size=batch_size)
+
+        comments, likes, notifications = [], [], []
+        post_type = ContentType.objects.get_for_model(Post)
+        for post in posts:
+            post.created_at = post.updated_at = now - timedelta(seconds=rng.uniform(0, days * 86400))
+            age = (now - post.created_at).total_seconds()
+            commenters = [ids[rng.randrange(users)] for _ in range(power_law_count(rng, comments_per_post))]
+            for author_id in commenters:
+                comments.append(Comment(post=post, author_id=author_id, content='Benchmark comment',
+                                        created_at=post.created_at + timedelta(seconds=rng.uniform(0, age))))
+            likers = sample(rng, ids, None, min(users, power_law_count(rng, likes_per_post)))
+            for user_id in likers:
+                likes.append(Like(post=post, user_id=user_id,
+                                  created_at=post.created_at + timedelta(seconds=rng.uniform(0, age))))
+            post.comments_count, post.likes_count = len(commenters), len(likers)
+            for verb, events in (('comment', comments[-len(commenters):] if commenters else []),
+                                 ('like', likes[-len(likers):] if likers else [])):
+                for event in events:
+                    actor_id = getattr(event, 'author_id', None) or event.user_id
+                    if actor_id != post.author_id:
+                        notifications.append(Notification(
+                            recipient_id=post.author_id, actor_id=actor_id, verb=verb,
+                            target_content_type=post_type, target_object_id=post.pk,
+                            timestamp=event.created_at, read=rng.random() < 0.7))
+        for follower, followed in follows:
+            notifications.append(Notification(
+                recipient_id=ids[followed], actor_id=ids[follower], verb='follow',
+                timestamp=now - timedelta(seconds=rng.uniform(0, days * 86400)), read=rng.random() < 0.7))
+
+        Post.objects.bulk_update(posts, ['created_at', 'updated_at', 'comments_count', 'likes_count'],
+                                 batch_size=batch_size)
+        # auto_now_add overrides the planned timestamps on insert, so write them back afterwards
+        for model, rows, field in ((Comment, comments, 'created_at'), (Like, likes, 'created_at'),
+                                   (Notification, notifications, 'timestamp')):
+            fields = [field, 'updated_at'] if model is Comment else [field]
+            # Likes and notifications go to their shards when sharded
+            for alias, group in group_objects(model, rows).items():
+                planned = [getattr(row, field) for row in group]
+                using_shard(model, alias).bulk_create(group, batch_size=batch_size)
+                for row, value in zip(group, planned):
+                    for name in fields:
+                        setattr(row, name, value)
+                using_shard(model, alias).bulk_update(group, fields, batch_size=batch_size)
+
+        entries = timeline_entries(posts, follows, ids, followers_count)
+        TimelineEntry.objects.bulk_create(entries, batch_size=batch_size)
+        get_post_search(Post).update_many(Post, [post.pk for post in posts])
+        get_post_search(Comment).update_many(Comment, [comment.pk for comment in comments])
+    trending.rebuild(batch_size=batch_size)
+
+    return {
+        'users': len(people), 'follows': len(follows), 'posts': len(posts), 'comments': len(comments),
+        'likes': len(likes), 'notifications': len(notifications), 'timeline_entries': len(entries),
+    }
+
+
+def timeline_entries(posts, follows, ids, followers_count):
+    """The TimelineEntry rows fan-out on write would have created for these posts"""
+    by_author = {}
+    for post in sorted(posts, key=lambda post: (post.created_at, post.pk), reverse=True):
+        by_author.setdefault(post.author_id, []).append(post)
+    followed_by = {}
+    for follower, followed in follows:
+        # Celebrities are merged into feeds at read time instead
+        if followers_count[followed] < get_celebrity_threshold():
+            followed_by.setdefault(ids[follower], []).append(ids[followed])
+
+    entries = []
+    for user_id, authors in followed_by.items():
+        merged = heapq.merge(*(by_author.get(author, []) for author in authors),
+                             key=lambda post: (post.created_at, post.pk), reverse=True)
+        entries += [TimelineEntry(user_id=user_id, post=post, created_at=post.created_at)
+                    for post in islice(merged, get_max_length())]
+    return entries
+
+
+class BenchmarkData:
+    """The ids and tokens scenarios pick from, loaded from the generated dataset"""
+
+    def __init__(self, prefix=DEFAULT_PREFIX):
+        users = User.objects.filter(username__startswith=prefix)
+        self.user_ids = list(users.values_list('pk', flat=True))
+        self.tokens = list(Token.objects.filter(user__in=users).values_list('key', flat=True))
+        self.usernames = list(users.values_list('username', flat=True))
+        self.post_ids = list(Post.objects.filter(author__in=users).values_list('pk', flat=True))
+        if not self.tokens or not self.post_ids:
+            raise ValueError(f'No benchmark data for prefix {prefix!r}; run generate_benchmark_data first')
+
+    def sizes(self):
+        return {'users': len(self.usernames), 'posts': len(self.post_ids)}
+
+
+def _search_term(data, rng):
+    username = rng.choice(data.usernames)
+    return username[:rng.randint(len(username) - 2, len(username))]
+
+
+# name -> (method, path for a random request)
+SCENARIOS = {
+    'feed': lambda data, rng: ('GET', '/api/feed/'),
+    'post_list': lambda data, rng: ('GET', '/api/posts/'),
+    'post_retrieve': lambda data, rng: ('GET', f'/api/posts/{rng.choice(data.post_ids)}/'),
+    'post_like': lambda data, rng: ('POST', f'/api/posts/{rng.choice(data.post_ids)}/like/'),
+    'search_users': lambda data, rng: ('GET', f'/api/accounts/search/?username={_search_term(data, rng)}'),
+    'notification_stats': lambda data, rng: ('GET', '/api/notifications/stats/'),
+}
+
+
+def restore_likes(data, since):
+    """Remove the likes made since `since` by benchmark users, and their notifications"""
+    # Lets queued notifications land first: ours, and a server's within its batching window
+    dispatcher.flush()
+    time.sleep(getattr(settings, 'NOTIFICATION_FLUSH_INTERVAL', 0.5))
+    liked = {}
+    for likes in each_shard(Like):
+        for user_id, post_id in likes.filter(user_id__in=data.user_ids, created_at__gte=since).values_list(
+                'user_id', 'post_id'):
+            liked.setdefault(user_id, []).append(post_id)
+    for user_id, post_ids in liked.items():
+        unlike_posts(User(pk=user_id), post_ids)
+
+    recipient_ids = set()
+    for notifications in each_shard(Notification):
+        notifications = notifications.filter(verb='like', actor_id__in=data.user_ids, timestamp__gte=since)
+        recipient_ids.update(notifications.values_list('recipient_id', flat=True))
+        notifications.delete()
+    invalidate_notification_stats(recipient_ids)
+    trending.rebuild()
+
+
+# name -> restore(data, since), run after a scenario that writes
+RESTORE = {
+    'post_like': restore_likes,
+}
+
+QUERIES_PATTERN = re.compile(r'desc="(\d+) queries"')
+
+
+def queries_from_header(value):
+    match = QUERIES_PATTERN.search(value or '')
+    return int(match.group(1)) if match else None
+
+
+class ClientTransport:
+    """Requests through the Django test client, in this process"""
+    name = 'client'
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def request(self, method, path, token):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = Client(raise_request_exception=False)
+        response = client.generic(method, path, HTTP_AUTHORIZATION=f'Token {token}',
+                                  secure=getattr(settings, 'SECURE_SSL_REDIRECT', False))
+        metrics = getattr(response, 'metrics', None)
+        return response.status_code, metrics.queries if metrics is not None else None
+
+    def close(self):
+        connection.close()
+
+
+class HTTPTransport:
+    """Requests over HTTP to a running server"""
+    name = 'http'
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, method, path, token):
+        request = urllib.request.Request(self.base_url + path, method=method,
+                                         headers={'Authorization': f'Token {token}'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+                return response.status, queries_from_header(response.headers.get('Server-Timing'))
+        except urllib.error.HTTPError as exc:
+            return exc.code, queries_from_header(exc.headers.get('Server-Timing'))
+
+    def close(self):
+        pass
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of sorted `values`"""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(q / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def run_scenario(transport, data, scenario, requests, concurrency, warmup, rng):
+    """Run one scenario's requests on `concurrency` threads; return its report"""
+    since = timezone.now()
+    plan = [(*SCENARIOS[scenario](data, rng), rng.choice(data.tokens)) for _ in range(warmup + requests)]
+    for method, path, token in plan[:warmup]:
+        transport.request(method, path, token)
+
+    jobs = iter(plan[warmup:])
+    lock = threading.Lock()
+    results = []
+
+    def worker():
+        try:
+            while True:
+                with lock:
+                    job = next(jobs, None)
+                if job is None:
+                    return
+                started = time.perf_counter()
+                status, queries = transport.request(*job)
+                latency = time.perf_counter() - started
+                with lock:
+                    results.append((status, latency, queries))
+        finally:
+            transport.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    if scenario in RESTORE:
+        RESTORE[scenario](data, since)
+
+    latencies = sorted(latency * 1000 for _, latency, _ in results)
+    queries = sorted(count for _, _, count in results if count is not None)
+    statuses = {}
+    for status, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': len(results),
+        'errors': sum(1 for status, _, _ in results if status >= 400),
+        'status_codes': statuses,
+        'throughput_rps': round(len(results) / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else None,
+            'p50': _round(percentile(latencies, 50)),
+            'p95': _round(percentile(latencies, 95)),
+            'p99': _round(percentile(latencies, 99)),
+            'max': _round(latencies[-1] if latencies else None),
+        },
+        'queries': {
+            'mean': round(sum(queries) / len(queries), 2) if queries else None,
+            'p95': percentile(queries, 95),
+            'max': queries[-1] if queries else None,
+        },
+    }
+
+
+def _round(value):
+    return None if value is None else round(value, 3)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(settings.BASE_DIR), capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(transport, scenarios, requests=200, concurrency=1, warmup=10, seed=0, prefix=DEFAULT_PREFIX):
+    """Run `scenarios` one after another; return the JSON-serializable report"""
+    data = BenchmarkData(prefix)
+    rng = random.Random(seed)
+    report = {
+        'commit': git_commit(),
+        'started_at': timezone.now().isoformat(),
+        'transport': transport.name,
+        'database': connection.vendor,
+        'dataset': data.sizes(),
+        'settings': {'requests': requests, 'concurrency': concurrency, 'warmup': warmup, 'seed': seed},
+        'scenarios': {},
+    }
+    for scenario in scenarios:
+        report['scenarios'][scenario] = run_scenario(transport, data, scenario, requests, concurrency, warmup, rng)
+    return report
+
+
+def dump_report(report):
+    return json.dumps(report, indent=2, sort_keys=True) + '\n'
@@ -0,0 +1,293 @@
+"""
+Per-request query count and latency, exposed as Server-Timing headers and
+Prometheus metrics, with per-view query budgets.
+
+RequestMetricsMiddleware wraps every database connection with
+execute_wrapper() while a request runs. It counts queries and DB time
+without DEBUG and records the request in the process-wide registry that
+/metrics renders in Prometheus text format. Metrics are labelled by URL
+name and are per process; scrape every worker. /metrics answers staff
+users and scrapers sending `Authorization: Bearer <METRICS_TOKEN>`.
+
+With SERVER_TIMING on, responses also carry
+
+    Server-Timing: db;dur=3.1;desc="7 queries", serialize;dur=1.2, total;dur=9.8
+
+which shows any client how the server spends its time, so it is off by
+default.
+
+Views declare how many queries a request may take: DRF views through
+InstrumentedViewMixin.query_budget (an int, or one per action), function
+views with the @query_budget(n) decorator. Going over budget is logged and
+counted in production. Tests assert it with QueryBudgetTestMixin, so a
+change that adds queries to an endpoint fails CI. InstrumentedViewMixin also
+times serialization of what get_serializer() returns.
+"""
+import bisect
+import contextvars
+import hmac
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """What one request spent: queries and DB time, named timing spans and its query budget"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.spans = {}
+        self.budget = None
+        self.total = None
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper() hook
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - started
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and self.queries > self.budget
+
+    def server_timing(self):
+        entries = [f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries"']
+        entries += [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.spans.items()]
+        entries.append(f'total;dur={self.total * 1000:.1f}')
+        return ', '.join(entries)
+
+
+def current_metrics():
+    """The RequestMetrics of the request being handled on this thread, or None"""
+    return _current.get()
+
+
+@contextmanager
+def span(name):
+    """Add the time spent in the block to the current request's `name` timing"""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.spans[name] = metrics.spans.get(name, 0.0) + time.perf_counter() - started
+
+
+class Registry:
+    """Thread-safe counters and histograms, rendered in Prometheus text format"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets),
+                                                    'sum': 0.0, 'count': 0}
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(value, counts=list(value['counts'])))
+                                for key, value in self.histograms.items())
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self.help:
+                kind, text = self.help[name]
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+            described.add(name)
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f'{name}{_labels(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            header(name)
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'], histogram['counts']):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(labels + (("le", _number(bound)),))} {cumulative}')
+            lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {histogram["count"]}')
+            lines.append(f'{name}_sum{_labels(labels)} {_number(histogram["sum"])}')
+            lines.append(f'{name}_count{_labels(labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+registry = Registry()
+registry.describe('http_requests_total', 'counter', 'Requests handled, by view, method and status')
+registry.describe('http_request_duration_seconds', 'histogram', 'Time from middleware entry to response')
+registry.describe('http_request_db_seconds', 'histogram', 'Time spent executing SQL per request')
+registry.describe('http_request_serialize_seconds', 'histogram', 'Time spent serializing per request')
+registry.describe('http_request_queries', 'histogram', 'SQL queries executed per request')
+registry.describe('http_query_budget_exceeded_total', 'counter', 'Requests that ran more queries than their view allows')
+
+
+def record(metrics, view, method, status):
+    registry.inc('http_requests_total', {'view': view, 'method': method, 'status': status})
+    labels = {'view': view}
+    registry.observe('http_request_duration_seconds', labels, metrics.total, DURATION_BUCKETS)
+    registry.observe('http_request_db_seconds', labels, metrics.db_time, DURATION_BUCKETS)
+    registry.observe('http_request_serialize_seconds', labels, metrics.spans.get('serialize', 0.0),
+                     DURATION_BUCKETS)
+    registry.observe('http_request_queries', labels, metrics.queries, QUERY_BUCKETS)
+    if metrics.over_budget:
+        registry.inc('http_query_budget_exceeded_total', labels)
+        logger.warning('%s %s ran %d queries, over its budget of %d', method, view, metrics.queries, metrics.budget)
+
+
+class RequestMetricsMiddleware:
+    """Measure each request; list it first in MIDDLEWARE so the total covers the whole stack"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        request.metrics = metrics
+        token = _current.set(metrics)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        metrics.total = time.perf_counter() - metrics.started
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match.view_name or match.route) if match else 'unmatched'
+        record(metrics, view, request.method, response.status_code)
+        if getattr(settings, 'SERVER_TIMING', False):
+            response['Server-Timing'] = metrics.server_timing()
+        # Kept on the response for QueryBudgetTestMixin
+        response.metrics = metrics
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        budget = getattr(view_func, 'query_budget', None)
+        if budget is not None:
+            request.metrics.budget = budget
+
+
+def query_budget(queries):
+    """Declare the most queries a function view may run; put it above @api_view"""
+    def decorator(view):
+        view.query_budget = queries
+        return view
+    return decorator
+
+
+class InstrumentedViewMixin:
+    """
+    DRF view mixin: apply `query_budget` and time serialization. The budget
+    is an int, or a dict keyed by viewset action ('list') or, for other
+    views, lowercase method ('get').
+    """
+    query_budget = None
+
+    def get_query_budget(self):
+        if isinstance(self.query_budget, dict):
+            return self.query_budget.get(getattr(self, 'action', None) or self.request.method.lower())
+        return self.query_budget
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.budget = self.get_query_budget()
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        represent = serializer.to_representation
+
+        def timed(instance):
+            with span('serialize'):
+                return represent(instance)
+        serializer.to_representation = timed
+        return serializer
+
+
+class QueryBudgetTestMixin:
+    """TestCase mixin: assert a test client response stayed within its view's query budget"""
+
+    def assertWithinQueryBudget(self, response):
+        metrics = getattr(response, 'metrics', None)
+        self.assertIsNotNone(metrics, 'RequestMetricsMiddleware is not installed')
+        self.assertIsNotNone(metrics.budget, f'{response.wsgi_request.path} declares no query budget')
+        self.assertLessEqual(metrics.queries, metrics.budget,
+                             f'{response.wsgi_request.path} ran {metrics.queries} queries, '
+                             f'over its budget of {metrics.budget}')
+
+
+def has_metrics_token(request):
+    """
+    Whether the request sends `Authorization: Bearer <METRICS_TOKEN>`. The
+    peer address proves nothing behind a reverse proxy on the same host.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+    return bool(token) and scheme.lower() == 'bearer' and hmac.compare_digest(credentials.encode(), token.encode())
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint, for scrapers with METRICS_TOKEN or staff users"""
+    user = getattr(request, 'user', None)
+    if not has_metrics_token(request) and not (user is not None and user.is_staff):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,162 @@
+"""
+Keyset (cursor) pagination shared by the posts and notifications apps.
+
+Cursor mode is opt-in: a request sending ?cursor= (empty for the first
+page) or ?pagination=cursor gets {next, has_next, results}, and every other
+request the usual PageNumberPagination {count, next, previous, results}, so
+existing clients keep working. In cursor mode pages are addressed by an
+opaque cursor holding the (timestamp, id) of the last row served, so
+fetching a deep page is an index range scan instead of an OFFSET that reads
+and discards every earlier row, and rows created between page loads do not
+shift later pages.
+"""
+import base64
+import json
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+def _encode(position):
+    payload = json.dumps(position).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def _decode(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode()))
+
+
+def encode_cursor(timestamp, pk):
+    """Encode a (timestamp, id) position as an opaque url-safe string"""
+    return _encode([timestamp.isoformat(), pk])
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by encode_cursor, raising NotFound if it is malformed"""
+    try:
+        timestamp, pk = _decode(cursor)
+        timestamp = parse_datetime(timestamp)
+        if timestamp is None:
+            raise ValueError(cursor)
+        return timestamp, int(pk)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise NotFound('Invalid cursor')
+
+
+def encode_score_cursor(score, pk):
+    """Encode a (score, id) position, for rankings such as trending posts"""
+    return _encode([score, pk])
+
+
+def decode_score_cursor(cursor):
+    """Decode a cursor made by encode_score_cursor, raising NotFound if it is malformed"""
+    try:
+        score, pk = _decode(cursor)
+        if isinstance(score, bool) or not isinstance(score, (int, float)):
+            raise ValueError(cursor)
+        return float(score), int(pk)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise NotFound('Invalid cursor')
+
+
+def keyset_filter(ordering, position):
+    """
+    Build a Q selecting rows strictly after `position` for an ordering such as
+    ('-created_at', '-id') or ('-score', '-post_id'). Both fields must sort in
+    the same direction.
+    """
+    (time_field, id_field) = [field.lstrip('-') for field in ordering]
+    lookup = 'lt' if ordering[0].startswith('-') else 'gt'
+    timestamp, pk = position
+    return (
+        Q(**{f'{time_field}__{lookup}': timestamp})
+        | Q(**{time_field: timestamp, f'{id_field}__{lookup}': pk})
+    )
+
+
+def requested_ordering(request, view):
+    """Whether the request picks its own order through an OrderingFilter of `view` (?ordering=)"""
+    backends = getattr(view, 'filter_backends', None) or api_settings.DEFAULT_FILTER_BACKENDS
+    return any(
+        issubclass(backend, OrderingFilter) and request.query_params.get(backend.ordering_param)
+        for backend in backends
+    )
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination keyed on (timestamp, id).
+
+    Views may set `keyset_ordering` (default ('-created_at', '-id')) and should
+    have a composite index matching it. Only requests asking for cursor mode
+    are paginated by keyset; the rest are served by PageNumberPagination, as
+    are full-text search results, which are ordered by relevance rather than
+    time, and requests choosing their own order with ?ordering=.
+    """
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = 'cursor'
+    mode_query_param = 'pagination'
+    ordering = ('-created_at', '-id')
+
+    def wants_cursor(self, request):
+        return (self.cursor_query_param in request.query_params
+                or request.query_params.get(self.mode_query_param) == 'cursor')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.fallback = None
+        if (not self.wants_cursor(request) or 'page' in request.query_params
+                or 'search_rank' in queryset.query.annotations or requested_ordering(request, view)):
+            self.fallback = PageNumberPagination()
+            return self.fallback.paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.ordering = getattr(view, 'keyset_ordering', self.ordering)
+        queryset = queryset.order_by(*self.ordering)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(keyset_filter(self.ordering, decode_cursor(cursor)))
+
+        # Fetch one extra row to learn whether another page exists without a COUNT(*)
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        time_field, id_field = [field.lstrip('-') for field in self.ordering]
+        last = self.page[-1]
+        cursor = encode_cursor(getattr(last, time_field), getattr(last, id_field))
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        if self.fallback is not None:
+            return self.fallback.get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('has_next', self.has_next),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {'oneOf': [
+            PageNumberPagination().get_paginated_response_schema(schema),
+            {
+                'type': 'object',
+                'properties': {
+                    'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                    'has_next': {'type': 'boolean'},
+                    'results': schema,
+                },
+            },
+        ]}
@@ -0,0 +1,161 @@
+"""
+Read-replica routing with read-your-writes consistency.
+
+Replicas are configured with DATABASE_URL_REPLICA_<n> environment variables
+(see settings.DATABASE_REPLICAS). ReplicaRoutingMiddleware marks GET, HEAD
+and OPTIONS requests as replica-safe, and ReplicaRouter then sends their
+ORM reads to one replica picked per request. Everything else reads from
+the primary: unsafe requests, management commands, background threads, reads
+inside a transaction, and the rest of a request once it has written.
+
+A client that writes is pinned to the primary for REPLICA_PIN_SECONDS, so
+it never reads data older than its own write from a lagging replica.
+Browsers are pinned with a cookie. Token clients often drop cookies, so
+they are also pinned with a cache marker keyed by a hash of their
+Authorization header. The window should exceed the worst replication lag.
+
+The marker must be seen by whichever worker serves the client's next
+request, so REPLICA_PIN_CACHE has to name a cache shared by all workers
+(Redis, Memcached, a database cache); with replicas configured a
+per-process cache is refused.
+"""
+import contextvars
+import hashlib
+import random
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = 'primary_pin'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Cache backends that keep entries per process
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+_state = contextvars.ContextVar('replica_routing', default=None)
+
+
+def get_replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def get_pin_seconds():
+    return getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+
+
+def get_pin_cache_alias():
+    return getattr(settings, 'REPLICA_PIN_CACHE', 'shared')
+
+
+def check_pin_cache():
+    """Refuse a per-process pin cache when there are replicas to pin clients away from"""
+    alias = get_pin_cache_alias()
+    if get_replicas() and settings.CACHES.get(alias, {}).get('BACKEND') in PROCESS_LOCAL_CACHES:
+        raise ImproperlyConfigured(
+            f'REPLICA_PIN_CACHE ({alias!r}) must be a cache shared by every worker, such as Redis, '
+            f'when DATABASE_REPLICAS is set; otherwise clients read stale data after writing'
+        )
+
+
+class RoutingState:
+    """How the current request reads: from `replica`, or from the primary once `wrote` is set"""
+
+    def __init__(self, replica):
+        self.replica = replica
+        self.wrote = False
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper() hook on the primary. Statements are
+        # watched rather than db_for_write(), which Django also consults when
+        # a related object is merely assigned.
+        if not self.wrote and sql.lstrip()[:6].upper() != 'SELECT':
+            self.wrote = True
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def use_primary():
+    """Read from the primary inside the block, e.g. to build a response shared with other clients"""
+    token = _state.set(None)
+    try:
+        yield
+    finally:
+        _state.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or state.wrote or state.replica is None:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from the primary
+        if db in get_replicas():
+            return False
+        return None
+
+
+def _pin_key(request):
+    authorization = request.headers.get('Authorization')
+    if not authorization:
+        return None
+    return f'primary-pin:{hashlib.sha256(authorization.encode()).hexdigest()}'
+
+
+def is_pinned(request):
+    if PIN_COOKIE in request.COOKIES:
+        return True
+    key = _pin_key(request)
+    return key is not None and caches[get_pin_cache_alias()].get(key) is not None
+
+
+def pin(request, response):
+    """Keep this client on the primary for the next REPLICA_PIN_SECONDS"""
+    seconds = get_pin_seconds()
+    response.set_cookie(PIN_COOKIE, '1', max_age=seconds, httponly=True, samesite='Lax')
+    key = _pin_key(request)
+    if key is not None:
+        caches[get_pin_cache_alias()].set(key, 1, seconds)
+
+
+class ReplicaRoutingMiddleware:
+    """Route safe requests' reads to a replica unless the client wrote recently; pin clients that write"""
+
+    def __init__(self, get_response):
+        check_pin_cache()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        replicas = get_replicas()
+        replica = None
+        if replicas and request.method in SAFE_METHODS and not is_pinned(request):
+            replica = random.choice(replicas)
+        state = RoutingState(replica)
+        token = _state.set(state)
+        try:
+            with connections[DEFAULT_DB_ALIAS].execute_wrapper(state):
+                response = self.get_response(request)
+        finally:
+            _state.reset(token)
+
+        if replicas and (request.method not in SAFE_METHODS or state.wrote):
+            pin(request, response)
+        return response
@@ -29,6 +29,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover the whole stack (see social_media_api.instrumentation)
+    'social_media_api.instrumentation.RequestMetricsMiddleware',
+    # Before anything that reads the database (see social_media_api.replicas)
+    'social_media_api.replicas.ReplicaRoutingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -59,6 +63,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'social_media_api.wsgi.application'
+ASGI_APPLICATION = 'social_media_api.asgi.application'
 
 # Database configuration for production
 DATABASES = {
@@ -68,6 +73,43 @@ DATABASES = {
     )
 }
 
+# SQLite tests default to an in-memory database other threads can't write to;
+# use a file so the like concurrency tests in posts.tests can run
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default'].setdefault('TEST', {'NAME': str(BASE_DIR / 'test_db.sqlite3')})
+
+# Read replicas, from DATABASE_URL_REPLICA_1, DATABASE_URL_REPLICA_2, ...
+# Safe requests read from one of them unless the client wrote in the last
+# REPLICA_PIN_SECONDS (see social_media_api.replicas); keep that above the
+# worst replication lag
+DATABASE_REPLICAS = []
+for name, url in sorted(os.environ.items()):
+    if name.startswith('DATABASE_URL_REPLICA_') and url:
+        alias = f'replica_{name[len("DATABASE_URL_REPLICA_"):].lower()}'
+        DATABASES[alias] = dj_database_url.parse(url, conn_max_age=600)
+        # Tests see the primary through the replica alias
+        DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+        DATABASE_REPLICAS.append(alias)
+
+# Shards for the Like and Notification tables, from DATABASE_URL_SHARD_1,
+# DATABASE_URL_SHARD_2, ... (see social_media_api.sharding). Only append to
+# this list, and run `manage.py rebalance_shards` after changing it
+DATABASE_SHARDS = []
+for name, url in sorted(os.environ.items(), key=lambda item: (len(item[0]), item[0])):
+    if name.startswith('DATABASE_URL_SHARD_') and url:
+        alias = f'shard_{name[len("DATABASE_URL_SHARD_"):].lower()}'
+        DATABASES[alias] = dj_database_url.parse(url, conn_max_age=600)
+        DATABASE_SHARDS.append(alias)
+
+DATABASE_ROUTERS = [
+    # First: it decides for the sharded models and leaves the rest to the replica router
+    'social_media_api.sharding.ShardRouter',
+    'social_media_api.replicas.ReplicaRouter',
+]
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 5))
+# Cache holding the pins of token clients, which must be shared by every worker
+REPLICA_PIN_CACHE = 'shared'
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -97,13 +139,24 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Stream every upload to a temporary file in chunks rather than holding small ones in memory
+FILE_UPLOAD_HANDLERS = ['django.core.files.uploadhandler.TemporaryFileUploadHandler']
+
+# Profile pictures (see accounts.media): largest accepted upload, square thumbnail
+# sizes in pixels by name, thumbnail format (WEBP, or JPEG when Pillow lacks WebP),
+# and whether thumbnails are rendered by background worker threads ('async') or inline ('sync')
+PROFILE_PICTURE_MAX_SIZE = 10 * 1024 * 1024
+PROFILE_PICTURE_THUMBNAIL_SIZES = {'small': 48, 'medium': 160, 'large': 400}
+PROFILE_PICTURE_THUMBNAIL_FORMAT = 'WEBP'
+PROFILE_PICTURE_THUMBNAILS = os.environ.get('PROFILE_PICTURE_THUMBNAILS', 'async')
+PROFILE_PICTURE_WORKERS = 2
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Django REST Framework
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'accounts.authentication.CachingTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
@@ -115,11 +168,107 @@ REST_FRAMEWORK = {
         'rest_framework.filters.SearchFilter',
         'rest_framework.filters.OrderingFilter',
     ],
+    # Token buckets per scope and user (or IP when anonymous), see social_media_api.throttling
+    'DEFAULT_THROTTLE_RATES': {
+        'login': '10/min',
+        'follow': '30/min',
+        'like': '60/min',
+        'batch_like': '10/min',
+        'comment': '20/min',
+    },
+    # 'local' (per process) or 'cache' (TOKEN_BUCKET_CACHE, shared by all workers)
+    'TOKEN_BUCKET_STORE': os.environ.get('TOKEN_BUCKET_STORE', 'local'),
+    'TOKEN_BUCKET_CACHE': 'shared',
+    # Reverse proxies in front of the app. Anonymous buckets (login) are keyed on the client IP:
+    # 0 uses REMOTE_ADDR, N the address the Nth proxy from the right put in X-Forwarded-For.
+    # Left unset DRF would trust the whole client-supplied header, minting a bucket per request
+    'NUM_PROXIES': int(os.environ.get('NUM_PROXIES', 0)),
+}
+
+# Caches
+# 'responses' holds shared PostViewSet bodies (posts.response_cache); point it at a
+# file or Redis cache, e.g. RESPONSE_CACHE_BACKEND=django.core.cache.backends.redis.RedisCache
+# and RESPONSE_CACHE_LOCATION=redis://127.0.0.1:6379/1, when running several processes
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': os.environ.get('RESPONSE_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('RESPONSE_CACHE_LOCATION', 'post-responses'),
+    },
+    # State every worker must see alike, such as replica pins and follow graphs. With several processes
+    # point it at a shared cache, e.g. SHARED_CACHE_BACKEND=django.core.cache.backends.redis.RedisCache
+    # and SHARED_CACHE_LOCATION=redis://127.0.0.1:6379/2; DATABASE_REPLICAS requires that
+    'shared': {
+        'BACKEND': os.environ.get('SHARED_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('SHARED_CACHE_LOCATION', 'shared'),
+    },
 }
+# Seconds a cached post response is served as fresh
+RESPONSE_CACHE_TTL = 30
+# Further seconds it is served stale while being rebuilt in the background
+RESPONSE_CACHE_STALE_TTL = 300
 
 # Custom user model
 AUTH_USER_MODEL = 'accounts.CustomUser'
 
+# API tokens (see accounts.authentication): days until a token expires, days after
+# which login replaces it, and the per-process token -> user cache
+AUTH_TOKEN_EXPIRY_DAYS = 30
+AUTH_TOKEN_ROTATE_DAYS = 7
+AUTH_TOKEN_CACHE_TTL = 60
+AUTH_TOKEN_CACHE_SIZE = 10000
+# Cache holding per-user versions that revoke cached tokens in every worker
+AUTH_TOKEN_VERSION_CACHE = 'shared'
+
+# Cache holding each user's set of followed ids, which every worker must see invalidated
+FOLLOW_GRAPH_CACHE = 'shared'
+# Seconds such a set may live (it is also replaced on follow/unfollow)
+FOLLOW_GRAPH_CACHE_TTL = 300
+
+# Score weights for "people you may know" (see accounts.suggestions)
+FOLLOW_SUGGESTION_WEIGHTS = {'mutual': 1.0, 'co_like': 0.5}
+
+# Latest comments embedded per post in list responses and feeds (None embeds all);
+# the full thread is paginated at /api/posts/<id>/comments/
+POST_LIST_COMMENTS = 3
+
+# Trending posts (see posts.trending): hours for an event's weight to halve,
+# weight per event kind, and days of activity `rebuild_trending` recomputes from
+TRENDING_HALF_LIFE_HOURS = 12
+TRENDING_WEIGHTS = {'like': 1.0, 'comment': 3.0}
+TRENDING_WINDOW_DAYS = 7
+
+# Home timelines (fan-out-on-write)
+# Number of most recent posts kept per user timeline; fan-out lets timelines run over
+# until `manage.py trim_timelines` runs
+TIMELINE_MAX_LENGTH = int(os.environ.get('TIMELINE_MAX_LENGTH', 800))
+# Authors with at least this many followers are merged into feeds at read time instead
+TIMELINE_CELEBRITY_THRESHOLD = int(os.environ.get('TIMELINE_CELEBRITY_THRESHOLD', 10000))
+
+# Notifications are written by background worker threads ('async') or inline ('sync')
+NOTIFICATION_DELIVERY = os.environ.get('NOTIFICATION_DELIVERY', 'async')
+NOTIFICATION_WORKERS = 2
+NOTIFICATION_BATCH_SIZE = 500
+# Seconds a worker collects events for one batch; bursts inside it are coalesced
+NOTIFICATION_FLUSH_INTERVAL = 0.5
+# Cache holding the per-user total/unread counts, which every worker must see invalidated
+NOTIFICATION_STATS_CACHE = 'shared'
+# Seconds those counts may live before being recounted
+NOTIFICATION_STATS_TTL = 300
+# Pub/sub backend pushing new notifications to /api/notifications/stream/ connections
+NOTIFICATION_PUBSUB_BACKEND = 'notifications.pubsub.InProcessBackend'
+# Seconds between keep-alive comments on an idle stream
+NOTIFICATION_STREAM_KEEPALIVE = 15
+# Read notifications older than this many days are removed by `prune_notifications`
+NOTIFICATION_RETENTION_DAYS = 90
+
+# Bearer token that lets a scraper read /metrics without a staff login (unset: staff only)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Add Server-Timing headers (query counts and DB time) to every response; for debugging
+SERVER_TIMING = os.environ.get('SERVER_TIMING') == '1'
+
 # Security settings for production
 SECURE_BROWSER_XSS_FILTER = True
 X_FRAME_OPTIONS = 'DENY'
@@ -0,0 +1,274 @@
+"""
+Optional horizontal sharding of the Like and Notification tables.
+
+With DATABASE_SHARDS set (see settings; aliases come from
+DATABASE_URL_SHARD_<n> environment variables), likes live on the shard of
+their post_id and notifications on the shard of their recipient_id. A key is
+mapped to a shard with jump consistent hashing, so appending a shard moves
+only about 1/N of the rows. Rebalance after changing the list with
+`manage.py rebalance_shards`. Shards must only be appended: removing or
+reordering one moves most rows.
+
+Shards hold nothing but the sharded tables. Their foreign keys to users,
+posts and content types have no database constraint, and a deleted user or
+post is cascaded to its shard rows by posts.signals. A query can't join a
+sharded table with one on another database, so:
+
+    on_shard(Like, post.pk).filter(post=post)        rows of one shard key
+    scatter_gather(Like, query, keys=post_ids)       one query per shard holding keys
+    scatter_gather(Notification, query)              every shard, in parallel
+    each_shard(Like)                                 every shard in turn, for batch jobs
+    with_related(queryset, 'actor')                  select_related, or prefetch across databases
+
+ShardRouter sends saves and deletes of instances to their shard, and raises
+ShardKeyRequired for a query on a model manager that doesn't name its shard,
+so it fails loudly instead of reading the wrong database.
+Without DATABASE_SHARDS all of these fall back to a single database and the
+usual routing.
+"""
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from operator import attrgetter
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections, transaction
+
+# Sharded model (label_lower) -> the attribute its rows are sharded by
+SHARD_KEYS = {
+    'posts.like': 'post_id',
+    'notifications.notification': 'recipient_id',
+}
+
+_executor = None
+
+
+class ShardKeyRequired(Exception):
+    pass
+
+
+def get_shards():
+    return getattr(settings, 'DATABASE_SHARDS', [])
+
+
+def is_sharded(model):
+    return bool(get_shards()) and model._meta.label_lower in SHARD_KEYS
+
+
+def shard_key(model):
+    return SHARD_KEYS[model._meta.label_lower]
+
+
+def jump_hash(key, buckets):
+    """Lamping and Veach's jump consistent hash of an integer key onto range(buckets)"""
+    key &= 0xFFFFFFFFFFFFFFFF
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * (1 << 31) / ((key >> 33) + 1))
+    return bucket
+
+
+def shard_for(model, key):
+    """The alias holding `model` rows with shard key `key`, or None (usual routing) when not sharded"""
+    if not is_sharded(model):
+        return None
+    shards = get_shards()
+    return shards[jump_hash(int(key), len(shards))]
+
+
+def shard_aliases(model):
+    """Every alias holding `model` rows: the shards, or [None] (usual routing) when not sharded"""
+    return list(get_shards()) if is_sharded(model) else [None]
+
+
+def write_alias(alias):
+    """The database behind one of shard_aliases(), for transactions and raw SQL"""
+    return alias or DEFAULT_DB_ALIAS
+
+
+def using_shard(model, alias):
+    return model._default_manager.db_manager(alias)
+
+
+def on_shard(model, key):
+    """The manager of `model` rows with shard key `key`"""
+    return using_shard(model, shard_for(model, key))
+
+
+def group_by_shard(model, items, key=None):
+    """{alias: items} for `items` (shard keys, or objects `key` maps to one), in first-seen order"""
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(shard_for(model, key(item) if key else item), []).append(item)
+    return groups
+
+
+def group_objects(model, objects):
+    """{alias: objects} for `model` instances, saved or not, by their shard key"""
+    if not is_sharded(model):
+        return {None: list(objects)}
+    return group_by_shard(model, objects, key=attrgetter(shard_key(model)))
+
+
+def each_shard(model):
+    """Yield the manager of each alias holding `model` rows, one after another"""
+    for alias in shard_aliases(model):
+        yield using_shard(model, alias)
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'SHARD_QUERY_WORKERS', 8),
+                                       thread_name_prefix='shard-query')
+    return _executor
+
+
+def _run(query, args):
+    try:
+        return query(*args)
+    finally:
+        close_old_connections()
+
+
+def scatter_gather(model, query, keys=None):
+    """
+    Call query(manager) for each alias holding `model` rows, or
+    query(manager, keys on that alias) for the aliases owning `keys`, and
+    return the results as a list. Several shards are queried in parallel;
+    `query` should return evaluated results, not a lazy queryset.
+    """
+    if keys is None:
+        tasks = [(using_shard(model, alias),) for alias in shard_aliases(model)]
+    else:
+        tasks = [(using_shard(model, alias), group) for alias, group in group_by_shard(model, keys).items()]
+    if len(tasks) <= 1:
+        return [query(*args) for args in tasks]
+    # Copied per task, so the request's routing state and timing spans carry over
+    futures = [get_executor().submit(contextvars.copy_context().run, _run, query, args) for args in tasks]
+    return [future.result() for future in futures]
+
+
+def with_related(queryset, *fields):
+    """select_related(*fields), or prefetch_related() when the queryset is on a shard without those tables"""
+    if is_sharded(queryset.model):
+        return queryset.prefetch_related(*fields)
+    return queryset.select_related(*fields)
+
+
+def delete_shard_rows(instance):
+    """
+    Delete the sharded rows whose cascading foreign keys point at
+    `instance`, which Django's collector only looks for on the database the
+    instance was deleted from.
+    """
+    from django.apps import apps
+
+    if not get_shards():
+        return
+    for label in SHARD_KEYS:
+        model = apps.get_model(label)
+        for field in model._meta.concrete_fields:
+            if not field.is_relation or not isinstance(instance, field.related_model):
+                continue
+            if field.attname == shard_key(model):
+                managers = [on_shard(model, instance.pk)]
+            else:
+                managers = each_shard(model)
+            for manager in managers:
+                manager.filter(**{field.attname: instance.pk}).delete()
+
+
+@contextmanager
+def _keep_timestamps(model):
+    """Stop auto_now(_add) from overwriting the timestamps of copied rows"""
+    fields = [field for field in model._meta.concrete_fields if getattr(field, 'auto_now_add', False)]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def rebalance(model, source, batch_size=1000, dry_run=False):
+    """
+    Move the `model` rows on `source` (a shard, or a database they are
+    leaving such as 'default') that belong on another shard there, in
+    batches; return how many rows were (or with dry_run would be) moved.
+
+    Each batch is copied and committed, then deleted from `source`, so no row
+    is ever missing, though until its batch is deleted it can be read twice.
+    Moved rows get new ids. Copies skip rows that conflict with a unique
+    constraint (a like made on the new shard meanwhile), so an interrupted
+    run can be repeated; it may duplicate notifications of the batch that
+    was interrupted.
+    """
+    key = shard_key(model)
+    rows = model._default_manager.using(source)
+    quoted_table = connections[source].ops.quote_name(model._meta.db_table)
+    moved = 0
+    last_pk = 0
+    while True:
+        batch = list(rows.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+        if not batch:
+            return moved
+        last_pk = batch[-1].pk
+        misplaced = [obj for obj in batch if shard_for(model, getattr(obj, key)) != source]
+        moved += len(misplaced)
+        if dry_run or not misplaced:
+            continue
+
+        pks = [obj.pk for obj in misplaced]
+        for alias, group in group_objects(model, misplaced).items():
+            for obj in group:
+                obj.pk = None
+            with transaction.atomic(using=alias), _keep_timestamps(model):
+                using_shard(model, alias).bulk_create(group, ignore_conflicts=True)
+        # Raw, because model deletes would fire post_delete (and decrement likes_count)
+        with transaction.atomic(using=source), connections[source].cursor() as cursor:
+            cursor.execute(f'DELETE FROM {quoted_table} WHERE id IN ({", ".join(["%s"] * len(pks))})', pks)
+
+
+class ShardRouter:
+    """Route sharded models; list it before other routers, which see every other model"""
+
+    def _shard(self, model, hints):
+        if not is_sharded(model):
+            return None
+        instance = hints.get('instance')
+        if instance is None:
+            raise ShardKeyRequired(f'{model._meta.label} is sharded by {shard_key(model)}; query it '
+                                   f'through social_media_api.sharding (on_shard(), scatter_gather())')
+        if isinstance(instance, model):
+            key = getattr(instance, shard_key(model))
+            return shard_for(model, key) if key is not None else None
+        # post.likes and user.notifications, the managers of a shard key's
+        # target. Other reverse managers (user.likes, user.actions) are not
+        # routed correctly; use scatter_gather(). This is also consulted
+        # when a related object is assigned, which doesn't decide where the
+        # row is saved.
+        if isinstance(instance, model._meta.get_field(shard_key(model)).related_model):
+            return shard_for(model, instance.pk)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Sharded rows point at users and posts on the primary by design
+        if is_sharded(type(obj1)) or is_sharded(type(obj2)):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in get_shards():
+            return f'{app_label}.{model_name}' in SHARD_KEYS
+        return None
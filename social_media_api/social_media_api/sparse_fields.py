@@ -0,0 +1,177 @@
+"""
+Sparse fieldsets (?fields=) and relation expansion (?expand=), shared by the
+posts, accounts and notifications serializers.
+
+    ?fields=id,title,author.username   render only these fields; dotted names
+                                       prune nested serializers. `id` is always kept.
+    ?expand=author                     render only these relations (Meta.expandable_fields)
+                                       as nested objects; other foreign keys collapse
+                                       to their id and other nested lists are dropped.
+
+Without either parameter responses keep their full shape. sparse_queryset()
+applies the same choice to the queryset, so unrequested columns, joins and
+prefetches are never loaded.
+"""
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework import serializers
+
+FIELDS_PARAM = 'fields'
+EXPAND_PARAM = 'expand'
+
+
+def parse_field_tree(value):
+    """Parse 'id,author.username' into {'id': {}, 'author': {'username': {}}}"""
+    tree = OrderedDict()
+    for path in value.split(','):
+        node = tree
+        for name in path.strip().split('.'):
+            if name:
+                node = node.setdefault(name, OrderedDict())
+    return tree
+
+
+class SparseFieldsMixin:
+    """
+    Serializer mixin applying ?fields= and ?expand= from the request in the
+    context. Nested serializers using the mixin get their share of the
+    dotted names from their parent.
+    """
+    # (fields tree or None, expand tree or None) handed down by a parent serializer
+    sparse_spec = None
+
+    def is_root(self):
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        return parent is None
+
+    def get_sparse_spec(self):
+        if not self.is_root():
+            return self.sparse_spec
+        request = self.context.get('request')
+        if request is None:
+            return None
+        params = getattr(request, 'query_params', request.GET)
+        only = parse_field_tree(params[FIELDS_PARAM]) if FIELDS_PARAM in params else None
+        expand = parse_field_tree(params[EXPAND_PARAM]) if EXPAND_PARAM in params else None
+        if only is None and expand is None:
+            return None
+        return only, expand
+
+    def get_fields(self):
+        fields = super().get_fields()
+        spec = self.get_sparse_spec()
+        if spec is None:
+            return fields
+        only, expand = spec
+        expandable = getattr(self.Meta, 'expandable_fields', ())
+
+        pruned = OrderedDict()
+        for name, field in fields.items():
+            if only is not None and name not in only and name != 'id':
+                continue
+            subfields = (only or {}).get(name) or None
+            if name in expandable and expand is not None and name not in expand and not subfields:
+                if isinstance(field, serializers.ListSerializer):
+                    continue
+                field = serializers.PrimaryKeyRelatedField(read_only=True, source=field.source)
+            target = field.child if isinstance(field, serializers.ListSerializer) else field
+            if isinstance(target, SparseFieldsMixin):
+                target.sparse_spec = (subfields, None if expand is None else expand.get(name, {}))
+            pruned[name] = field
+        return pruned
+
+
+def _field_sources(serializer):
+    """Yield (field, source) for the fields `serializer` renders, honouring Meta.field_sources"""
+    overrides = getattr(getattr(serializer, 'Meta', None), 'field_sources', {})
+    for name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        yield field, overrides.get(name, field.source)
+
+
+def _concrete_columns(model, serializer):
+    """Column names of `model` backing `serializer`, or None if some field can't be mapped"""
+    columns = {model._meta.pk.name}
+    for field, source in _field_sources(serializer):
+        if source is None:
+            continue
+        try:
+            model_field = model._meta.get_field(source)
+        except FieldDoesNotExist:
+            return None
+        if model_field.is_relation and not model_field.concrete:
+            return None
+        columns.add(model_field.name)
+    return columns
+
+
+def sparse_queryset(queryset, serializer, always=()):
+    """
+    Restrict `queryset` to what `serializer` renders after ?fields=/?expand=:
+    select_related only the nested foreign keys, keep only the prefetches of
+    rendered relations and load only the needed columns with only().
+    `always` names extra columns to load, e.g. pagination keys.
+    """
+    if isinstance(serializer, serializers.ListSerializer):
+        serializer = serializer.child
+    if not isinstance(serializer, SparseFieldsMixin) or serializer.get_sparse_spec() is None:
+        return queryset
+
+    model = queryset.model
+    only = {model._meta.pk.name, *always}
+    select = []
+    relations = set()
+    restrict = True
+    for field, source in _field_sources(serializer):
+        if source is None:
+            # Annotations and values computed from other fields, see Meta.field_sources
+            continue
+        name = source.split('.')[0]
+        try:
+            model_field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            restrict = False
+            continue
+
+        if model_field.many_to_many or model_field.one_to_many:
+            relations.add(name)
+        elif model_field.is_relation:
+            only.add(name)
+            nested = field.child if isinstance(field, serializers.ListSerializer) else field
+            if isinstance(nested, serializers.BaseSerializer):
+                select.append(name)
+                columns = _concrete_columns(model_field.related_model, nested)
+                if columns is not None:
+                    only.update(f'{name}__{column}' for column in columns)
+        else:
+            only.add(name)
+
+    lookups = [
+        lookup for lookup in queryset._prefetch_related_lookups
+        if (lookup.prefetch_through if isinstance(lookup, Prefetch) else lookup).split('__')[0] in relations
+    ]
+    queryset = queryset.select_related(None).prefetch_related(None)
+    if select:
+        queryset = queryset.select_related(*select)
+    if lookups:
+        queryset = queryset.prefetch_related(*lookups)
+    if restrict:
+        queryset = queryset.only(*only)
+    return queryset
+
+
+class SparseFieldsViewMixin:
+    """Apply sparse_queryset() to the filtered queryset of GET list and retrieve requests"""
+    sparse_actions = (None, 'list', 'retrieve')
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.request.method != 'GET' or getattr(self, 'action', None) not in self.sparse_actions:
+            return queryset
+        always = [field.lstrip('-') for field in getattr(self, 'keyset_ordering', ())]
+        return sparse_queryset(queryset, self.get_serializer(), always)
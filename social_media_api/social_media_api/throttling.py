@@ -0,0 +1,153 @@
+"""
+Token-bucket rate limiting per endpoint scope and per user (or client IP
+for anonymous requests, taken from REMOTE_ADDR or, behind
+REST_FRAMEWORK['NUM_PROXIES'] proxies, from X-Forwarded-For).
+
+A scope such as 'like' or 'login' gets its rate from
+REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'] in DRF's '<requests>/<period>'
+form. Each (scope, client) pair has a bucket holding up to <requests>
+tokens, refilled continuously at <requests> per <period>; a request takes
+one token, so bursts up to the bucket size pass and sustained traffic is
+held to the rate. A throttled request gets 429 with Retry-After set to the
+time until the next token.
+
+Buckets live in REST_FRAMEWORK['TOKEN_BUCKET_STORE']:
+
+    'local'  a dict per process behind a lock; a check costs microseconds,
+             but with several workers each one grants the full rate.
+    'cache'  the cache named by REST_FRAMEWORK['TOKEN_BUCKET_CACHE'], shared
+             by every worker. Each check takes a short lock key with add(),
+             retrying for up to about LOCK_RETRIES * LOCK_RETRY_DELAY
+             seconds; a request that still can't get it is throttled, so a
+             client can't earn extra tokens by sending requests concurrently.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+LOCK_RETRIES = 10
+LOCK_RETRY_DELAY = 0.005
+
+
+def parse_rate(rate):
+    """Parse '60/min' into (60, 60): bucket size and the seconds it takes to refill"""
+    num, period = rate.split('/')
+    return int(num), PERIODS[period[0]]
+
+
+def take_token(bucket, now, capacity, refill_rate):
+    """
+    Refill `bucket` ((tokens, updated_at) or None for a full one) up to `now`
+    and take a token. Return (new bucket, seconds to wait or 0 if allowed).
+    """
+    tokens, updated_at = bucket if bucket is not None else (capacity, now)
+    tokens = min(capacity, tokens + max(now - updated_at, 0) * refill_rate)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) / refill_rate
+
+
+class LocalBucketStore:
+    """Buckets in a per-process LRU dict; the least recently used are dropped (as if full) past max_buckets"""
+
+    def __init__(self, max_buckets=100000):
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def consume(self, key, capacity, refill_rate):
+        with self.lock:
+            bucket, wait = take_token(self.buckets.get(key), time.monotonic(), capacity, refill_rate)
+            self.buckets[key] = bucket
+            self.buckets.move_to_end(key)
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class CacheBucketStore:
+    """Buckets in a shared Django cache, so every worker draws from the same bucket"""
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    def consume(self, key, capacity, refill_rate):
+        cache = caches[self.alias]
+        lock_key = f'{key}:lock'
+        for _ in range(LOCK_RETRIES):
+            if cache.add(lock_key, 1, 1):
+                break
+            time.sleep(LOCK_RETRY_DELAY)
+        else:
+            # Fail closed: the bucket is this busy only under concurrent requests
+            return 1 / refill_rate
+        try:
+            bucket, wait = take_token(cache.get(key), time.time(), capacity, refill_rate)
+            # An untouched bucket is full again after capacity / refill_rate seconds
+            cache.set(key, bucket, int(capacity / refill_rate) + 1)
+        finally:
+            cache.delete(lock_key)
+        return wait
+
+
+local_store = LocalBucketStore()
+_cache_stores = {}
+
+
+def get_store():
+    options = getattr(settings, 'REST_FRAMEWORK', {})
+    name = options.get('TOKEN_BUCKET_STORE', 'local')
+    if name == 'local':
+        return local_store
+    if name == 'cache':
+        alias = options.get('TOKEN_BUCKET_CACHE', 'shared')
+        if alias not in _cache_stores:
+            _cache_stores[alias] = CacheBucketStore(alias)
+        return _cache_stores[alias]
+    raise ImproperlyConfigured(f"TOKEN_BUCKET_STORE must be 'local' or 'cache', not {name!r}")
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Throttle a view by the token bucket of its scope: the view's
+    `throttle_scope` (also settable through @action kwargs) or, for function
+    views, a subclass made with for_scope(). Scopes without a configured
+    rate are not throttled.
+    """
+    scope = None
+
+    @classmethod
+    def for_scope(cls, scope):
+        return type(f'{scope.title().replace("_", "")}Throttle', (cls,), {'scope': scope})
+
+    def get_scope(self, view):
+        return getattr(view, 'throttle_scope', None) or self.scope
+
+    def get_client(self, request):
+        if request.user and request.user.is_authenticated:
+            return f'user:{request.user.pk}'
+        return f'ip:{self.get_ident(request)}'
+
+    def allow_request(self, request, view):
+        self.delay = 0
+        scope = self.get_scope(view)
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope) if scope else None
+        if rate is None:
+            return True
+        capacity, period = parse_rate(rate)
+        self.delay = get_store().consume(f'throttle:{scope}:{self.get_client(request)}', capacity, capacity / period)
+        return not self.delay
+
+    def wait(self):
+        return self.delay
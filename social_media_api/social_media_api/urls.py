@@ -2,13 +2,24 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from accounts.media import serve_profile_picture
+from .instrumentation import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/accounts/', include('accounts.urls')),
     path('api/', include('posts.urls')),
+    path('api/notifications/', include('notifications.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
 
+# Profile pictures and their thumbnails, under content-hashed names and with immutable
+# cache headers; a CDN or proxy in front should cache them rather than bypass them
+if settings.MEDIA_URL.startswith('/'):
+    urlpatterns.append(
+        path(f'{settings.MEDIA_URL[1:]}profile_pics/<path:path>', serve_profile_picture, name='profile-picture')
+    )
+
 # Serve media files in development
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)